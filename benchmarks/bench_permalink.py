@@ -0,0 +1,61 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Time encoding and decoding permalink tokens, and compare decoding with
+parsing the same scenarios from JSON through pydantic.
+
+Run from the top-level directory:
+$ python -m benchmarks.bench_permalink
+"""
+
+import timeit
+
+from cambio.utils.permalink import decode_scenarios, encode_scenarios
+from cambio.utils.schemas import CambioInputs
+
+
+def make_scenarios(count: int) -> dict[str, CambioInputs]:
+    """
+    Make scenarios that differ from the default in a few inputs
+    @param count  Number of scenarios
+    @returns  The inputs, by scenario id
+    """
+    return {
+        f"Scenario {i}": CambioInputs(
+            transition_year=2030 + i, long_term_emissions=0.5 * i, random_seed=i
+        )
+        for i in range(count)
+    }
+
+
+def time_per_scenario(func, count: int, number: int = 2000) -> float:
+    """
+    Time a function of a set of scenarios
+    @param func  The function, called with no arguments
+    @param count  Number of scenarios it handles
+    @param number  Number of calls to time
+    @returns  Time per scenario, in seconds
+    """
+    return min(timeit.repeat(func, number=number, repeat=5)) / number / count
+
+
+def main():
+    """Print the time per scenario to encode and decode"""
+    count = 8
+    scenarios = make_scenarios(count)
+    token = encode_scenarios(scenarios)
+    texts = [inputs.json() for inputs in scenarios.values()]
+
+    encode = time_per_scenario(lambda: encode_scenarios(scenarios), count)
+    decode = time_per_scenario(lambda: decode_scenarios(token), count)
+    parse = time_per_scenario(
+        lambda: [CambioInputs.from_json(text) for text in texts], count
+    )
+    print(f"Token for {count} scenarios:  {len(token)} characters")
+    print(f"Encode token:               {encode * 1e6:6.2f} us/scenario")
+    print(f"Decode token:               {decode * 1e6:6.2f} us/scenario")
+    print(f"Parse JSON (pydantic):      {parse * 1e6:6.2f} us/scenario")
+
+
+if __name__ == "__main__":
+    main()
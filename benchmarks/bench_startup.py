@@ -0,0 +1,163 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Time a cold start: from starting the server to the first byte of the
+main page.
+
+Starts the server on a free port of this machine, as it would be started
+after scaling to zero, and times how long it takes to listen, to send the
+first byte of /cambio/, and to answer a second request. It does this
+without warming up (CAMBIO_WARM_START off) and with it. gunicorn is used
+(with --preload, so the workers fork from the warmed master) if it is
+installed, and otherwise Django's runserver.
+
+Run from the top-level directory:
+$ python -m benchmarks.bench_startup
+$ python -m benchmarks.bench_startup --repeat 5
+"""
+
+import argparse
+import http.client
+import importlib.util
+import os
+import socket
+import subprocess
+import sys
+import time
+
+
+PATH = "/cambio/"
+
+
+def free_port() -> int:
+    """
+    Return a port on this machine that nothing is listening on
+    @returns  The port
+    """
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def server_command(port: int) -> list[str]:
+    """
+    Return the command that starts the server
+    @param port  The port to listen on
+    @returns  The command
+    """
+    if importlib.util.find_spec("gunicorn") is not None:
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "--preload",
+            "--workers",
+            "2",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "cambio_site.wsgi",
+        ]
+    return [
+        sys.executable,
+        "manage.py",
+        "runserver",
+        "--noreload",
+        f"127.0.0.1:{port}",
+    ]
+
+
+def wait_for_port(port: int, timeout: float) -> None:
+    """
+    Wait until the server accepts connections
+    @param port  The port
+    @param timeout  Longest time to wait, in seconds
+    @raises TimeoutError  If the server does not start in time
+    """
+    stop = time.perf_counter() + timeout
+    while time.perf_counter() < stop:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.1):
+                return
+        except OSError:
+            time.sleep(0.005)
+    raise TimeoutError(f"The server did not listen on port {port}")
+
+
+def first_byte(port: int) -> tuple[float, float]:
+    """
+    Request the main page
+    @param port  The port
+    @returns  Time to the first byte and to the whole response, in seconds
+    """
+    connection = http.client.HTTPConnection("127.0.0.1", port, timeout=60)
+    try:
+        start = time.perf_counter()
+        connection.request("GET", PATH)
+        response = connection.getresponse()
+        response.read(1)
+        to_first_byte = time.perf_counter() - start
+        response.read()
+        if response.status != 200:
+            raise RuntimeError(f"{PATH} returned {response.status}")
+        return to_first_byte, time.perf_counter() - start
+    finally:
+        connection.close()
+
+
+def time_start(warm: bool, timeout: float = 60.0) -> dict[str, float]:
+    """
+    Start the server, request the main page twice, and stop it
+    @param warm  If True, warm the server up as it starts
+    @param timeout  Longest time to wait for the server, in seconds
+    @returns  Times to listening, to the first byte, to the end of the first
+              response and for a second request, in seconds
+    """
+    port = free_port()
+    env = dict(os.environ, CAMBIO_WARM_START="true" if warm else "false")
+    env.setdefault("SECRET_KEY", "benchmark")
+    start = time.perf_counter()
+    server = subprocess.Popen(
+        server_command(port),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        wait_for_port(port, timeout)
+        listening = time.perf_counter() - start
+        first, whole = first_byte(port)
+        ttfb = listening + first
+        second, _ = first_byte(port)
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "listen": listening,
+        "ttfb": ttfb,
+        "first_request": whole,
+        "second_request": second,
+    }
+
+
+def main():
+    """Print the cold-start times, without and with warming up"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("--repeat", type=int, default=3, help="Starts of each")
+    args = parser.parse_args()
+
+    print(f"Server: {' '.join(server_command(0)[1:3])}")
+    print(f"{'':10} {'listen':>9} {'TTFB':>9} {'1st req':>9} {'2nd req':>9}")
+    for warm in (False, True):
+        runs = [time_start(warm) for _ in range(args.repeat)]
+        best = {name: min(run[name] for run in runs) for name in runs[0]}
+        print(
+            f"{'warm' if warm else 'cold':10} "
+            f"{best['listen'] * 1000:7.0f}ms "
+            f"{best['ttfb'] * 1000:7.0f}ms "
+            f"{best['first_request'] * 1000:7.0f}ms "
+            f"{best['second_request'] * 1000:7.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Time one step of propagate_climate_state with the NumPy-based
+ClimateParams diagnostics and with the math-based ScalarClimateParams.
+
+Run from the top-level directory:
+$ python -m benchmarks.bench_step
+"""
+
+import timeit
+
+from cambio.utils.cambio import propagate_climate_state
+from cambio.utils.climate_params import ClimateParams
+from cambio.utils.climate_state import ClimateState
+from cambio.utils.scalar_diagnostics import ScalarClimateParams
+
+
+def time_step(climateParams: ClimateParams, number: int = 20000) -> float:
+    """
+    Time one step of propagate_climate_state, with all the feedbacks on
+    @param climateParams  The climate params to use for the diagnostics
+    @param number  Number of steps to time
+    @returns  Time per step, in seconds
+    """
+    state = ClimateState(1)
+    state.set_initial("C_atm", 700.0)
+    state.set_initial("C_ocean", 400.0)
+    state.set_initial("albedo", 0.3)
+
+    def step():
+        propagate_climate_state(
+            state.buffer, 0, climateParams, 1.0, 10.0, True, True, 4.0, False, 3.9, True
+        )
+
+    return min(timeit.repeat(step, number=number, repeat=5)) / number
+
+
+def main():
+    """Print the time per step before and after"""
+    before = time_step(ClimateParams(0.0))
+    after = time_step(ScalarClimateParams(0.0))
+    print(f"ClimateParams (NumPy):      {before * 1e6:6.2f} us/step")
+    print(f"ScalarClimateParams (math): {after * 1e6:6.2f} us/step")
+    print(f"Speedup:                    {before / after:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
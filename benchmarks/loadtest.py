@@ -0,0 +1,356 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Load test for the main page.
+
+Replays recorded requests (query strings, with any cookies) for /cambio/
+from a number of threads at once, either straight into the WSGI
+application in this process, or over HTTP to a server on this machine
+(such as gunicorn). Reports the throughput, the latency percentiles, the
+status codes and the peak memory of the process serving the requests.
+
+Each line of the recorded requests is either a bare query string, or a
+JSON object with "query" and, optionally, "cookies" (a dictionary):
+    plot_scenario_Default=on&carbon=ppm
+    {"query": "plot_scenario_Mine=on", "cookies": {"Mine": "{...}"}}
+
+Scenarios in cookies are moved into a session by the server, so each
+thread keeps the session cookie it is given and sends it back with its
+later requests that have cookies: a load test makes one session per
+thread, not one per request, and the command deletes them at the end.
+
+Run it through the management command:
+$ python manage.py loadtest benchmarks/queries.txt --concurrency 4
+$ python manage.py loadtest benchmarks/queries.txt --url http://127.0.0.1:8000
+"""
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import http.client
+from http.cookies import CookieError, SimpleCookie
+import io
+import itertools
+import json
+import os
+from pathlib import Path
+import resource
+import threading
+import time
+from urllib.parse import urlsplit
+
+import numpy as np
+
+
+PATH = "/cambio/"
+
+
+class RecordedRequest:
+    """
+    A request to replay
+    """
+
+    def __init__(self, query: str, cookies: dict[str, str] | None = None) -> None:
+        """
+        Create an instance of the class
+
+        @param query  The query string, without the "?"
+        @param cookies  The cookies to send, by name
+        """
+        self.query = query.lstrip("?")
+        self.cookies = cookies or {}
+
+    def cookie_header(self) -> str:
+        """
+        Return the cookies as a Cookie header value
+        @returns  The header value ("" if there are no cookies)
+        """
+        return "; ".join(f"{name}={value}" for name, value in self.cookies.items())
+
+
+def load_requests(path: str | Path) -> list[RecordedRequest]:
+    """
+    Read recorded requests from a file
+    @param path  The file, with one request per line (blank lines and
+                 lines starting with # are skipped)
+    @returns  The requests
+    """
+    requests = []
+    with open(path, encoding="utf-8") as file:
+        for line in file:
+            line = line.strip()
+            if line == "" or line.startswith("#"):
+                continue
+            if line.startswith("{"):
+                record = json.loads(line)
+                requests.append(
+                    RecordedRequest(record.get("query", ""), record.get("cookies"))
+                )
+            else:
+                requests.append(RecordedRequest(line))
+    return requests
+
+
+class SessionCookies:
+    """
+    The session cookie given to each thread, and every session key given
+    """
+
+    def __init__(self, name: str = "sessionid") -> None:
+        """
+        Create an instance of the class
+
+        @param name  Name of the session cookie
+        """
+        self.name = name
+        self.local = threading.local()
+        self.keys: set[str] = set()
+        self.lock = threading.Lock()
+
+    def cookie_header(self, request: RecordedRequest) -> str:
+        """
+        Return the Cookie header for a request, with this thread's session
+        if the request has cookies
+        @param request  The request
+        @returns  The header value ("" if there are no cookies)
+        """
+        header = request.cookie_header()
+        key = getattr(self.local, "key", None)
+        if header and key is not None and self.name not in request.cookies:
+            header += f"; {self.name}={key}"
+        return header
+
+    def remember(self, set_cookies: list[str]) -> None:
+        """
+        Keep the session cookie, if the server set one
+        @param set_cookies  Values of the Set-Cookie headers
+        """
+        for value in set_cookies:
+            try:
+                cookie = SimpleCookie(value)
+            except CookieError:
+                continue
+            if self.name in cookie and cookie[self.name].value:
+                self.local.key = cookie[self.name].value
+                with self.lock:
+                    self.keys.add(self.local.key)
+
+
+class WSGISender:
+    """
+    Sends requests straight into a WSGI application in this process
+    """
+
+    def __init__(self, application, sessions: SessionCookies | None = None) -> None:
+        """
+        Create an instance of the class
+
+        @param application  The WSGI application
+        @param sessions  The session cookies of the threads
+        """
+        self.application = application
+        self.sessions = SessionCookies() if sessions is None else sessions
+
+    def __call__(self, request: RecordedRequest) -> int:
+        """
+        Send a request
+        @param request  The request
+        @returns  The status code
+        """
+        environ = {
+            "REQUEST_METHOD": "GET",
+            "SCRIPT_NAME": "",
+            "PATH_INFO": PATH,
+            "QUERY_STRING": request.query,
+            "SERVER_NAME": "localhost",
+            "SERVER_PORT": "80",
+            "SERVER_PROTOCOL": "HTTP/1.1",
+            "REMOTE_ADDR": "127.0.0.1",
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(),
+            "wsgi.errors": io.StringIO(),
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        }
+        if request.cookies:
+            environ["HTTP_COOKIE"] = self.sessions.cookie_header(request)
+
+        status = []
+
+        def start_response(status_line, headers, exc_info=None):
+            status.append(int(status_line.split(" ", 1)[0]))
+            self.sessions.remember(
+                [value for name, value in headers if name.lower() == "set-cookie"]
+            )
+
+        body = self.application(environ, start_response)
+        try:
+            for _ in body:
+                pass
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+        return status[0]
+
+
+class HTTPSender:
+    """
+    Sends requests over HTTP to a server on this machine, keeping one
+    connection open per thread
+    """
+
+    def __init__(self, url: str, sessions: SessionCookies | None = None) -> None:
+        """
+        Create an instance of the class
+
+        @param url  The server, such as http://127.0.0.1:8000
+        @param sessions  The session cookies of the threads
+        @raises ValueError  If the server is not on this machine
+        """
+        parts = urlsplit(url)
+        if parts.hostname not in ("localhost", "127.0.0.1", "::1"):
+            raise ValueError("The load test only runs against localhost")
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.local = threading.local()
+        self.sessions = SessionCookies() if sessions is None else sessions
+
+    def __call__(self, request: RecordedRequest) -> int:
+        """
+        Send a request
+        @param request  The request
+        @returns  The status code
+        """
+        headers = {}
+        if request.cookies:
+            headers["Cookie"] = self.sessions.cookie_header(request)
+        url = PATH + ("?" + request.query if request.query else "")
+        for attempt in range(2):
+            connection = getattr(self.local, "connection", None)
+            if connection is None:
+                connection = http.client.HTTPConnection(self.host, self.port)
+                self.local.connection = connection
+            try:
+                connection.request("GET", url, headers=headers)
+                response = connection.getresponse()
+                response.read()
+                self.sessions.remember(response.msg.get_all("Set-Cookie") or [])
+                return response.status
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed a kept-alive connection; reconnect once
+                connection.close()
+                self.local.connection = None
+                if attempt == 1:
+                    raise
+        return 0
+
+
+def peak_rss(pid: int | None = None) -> int | None:
+    """
+    Return the peak resident memory of a process and its children
+    @param pid  The process (None for this one)
+    @returns  The largest peak of any of them, in bytes, or None if it
+              can't be read
+    """
+    if pid is None:
+        # ru_maxrss is in kilobytes on Linux, and bytes on macOS
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if os.uname().sysname == "Darwin" else maxrss * 1024
+
+    peaks = []
+    pids = [pid]
+    children = Path(f"/proc/{pid}/task/{pid}/children")
+    if children.exists():
+        pids += [int(child) for child in children.read_text().split()]
+    for process in pids:
+        try:
+            status = Path(f"/proc/{process}/status").read_text()
+        except OSError:
+            continue
+        for line in status.splitlines():
+            if line.startswith("VmHWM:"):
+                peaks.append(int(line.split()[1]) * 1024)
+    return max(peaks) if peaks else None
+
+
+def run_load(
+    sender,
+    requests: list[RecordedRequest],
+    concurrency: int = 1,
+    count: int | None = None,
+    duration: float | None = None,
+    warmup: int = 0,
+) -> dict:
+    """
+    Replay requests from several threads at once
+    @param sender  Sends a request and returns its status code
+    @param requests  The requests, replayed in order and from the start
+                     again when they run out
+    @param concurrency  Number of threads sending requests
+    @param count  Number of requests to send (default: each once)
+    @param duration  If given, stop after this many seconds instead
+    @param warmup  Number of requests to send first, without timing them
+    @returns  Dictionary with the number of requests, the elapsed time,
+              the throughput, the latency percentiles (in seconds) and
+              the count of each status code
+    """
+    for request in itertools.islice(itertools.cycle(requests), warmup):
+        sender(request)
+
+    if count is None:
+        count = len(requests) if duration is None else None
+    upcoming = itertools.cycle(requests)
+    if count is not None:
+        upcoming = itertools.islice(upcoming, count)
+    lock = threading.Lock()
+    latencies: list[float] = []
+    statuses: Counter = Counter()
+    errors = 0
+
+    start = time.perf_counter()
+    stop = None if duration is None else start + duration
+
+    def worker() -> None:
+        nonlocal errors
+        while stop is None or time.perf_counter() < stop:
+            with lock:
+                request = next(upcoming, None)
+            if request is None:
+                return
+            sent = time.perf_counter()
+            try:
+                status = sender(request)
+            except Exception:
+                with lock:
+                    errors += 1
+                continue
+            latency = time.perf_counter() - sent
+            with lock:
+                latencies.append(latency)
+                statuses[status] += 1
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    percentiles = {}
+    if latencies:
+        values = np.percentile(latencies, [50, 90, 95, 99])
+        percentiles = {
+            "p50": values[0],
+            "p90": values[1],
+            "p95": values[2],
+            "p99": values[3],
+            "max": max(latencies),
+        }
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "concurrency": concurrency,
+        "elapsed": elapsed,
+        "throughput": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency": {name: float(value) for name, value in percentiles.items()},
+        "statuses": {str(status): n for status, n in sorted(statuses.items())},
+    }
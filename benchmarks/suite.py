@@ -0,0 +1,311 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Benchmark suite for the model, the plotting and the views.
+
+Each benchmark times one hot path: cambio over several time steps and
+horizons and with and without checkpoints, cambio_ensemble for a few
+sizes of ensemble, the emissions scenario builder, MakePlots.make for 1
+to 20 scenarios, and a whole request for the main page through the
+Django test client. The results can be saved as JSON and compared with a
+baseline saved earlier, flagging anything that got slower.
+
+Run it through the management command:
+$ python manage.py bench --output baseline.json
+$ python manage.py bench --compare baseline.json
+"""
+
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+import datetime
+import fnmatch
+import functools
+import itertools
+import os
+import platform
+import statistics
+import time
+
+from django.http import QueryDict
+from django.test import Client, override_settings
+import numpy as np
+
+from cambio.utils import kernels, result_cache
+import cambio.utils.cambio as model
+from cambio.utils.cambio import cambio, cambio_ensemble
+from cambio.utils.cambio_utils import (
+    _make_emissions_scenario_lte,
+    make_emissions_scenario_lte,
+)
+from cambio.utils.checkpoints import CheckpointCache, checkpoint_cache
+from cambio.utils.make_plots import MakePlots, get_panel_cache
+from cambio.utils.schemas import CambioInputs
+
+
+# Ratio to the baseline time above which a benchmark is a regression
+DEFAULT_THRESHOLD = 0.25
+
+REPEAT = 5
+
+
+def model_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield cambio runs over several time steps and horizons
+    @returns  Iterator of (name, function to time)
+    """
+    for dtime in (1.0, 0.5, 0.1):
+        for stop_year in (2200.0, 2500.0):
+            inputs = CambioInputs(dtime=dtime, stop_year=stop_year)
+            name = f"cambio[dtime={dtime:g},stop_year={stop_year:g}]"
+            yield name, functools.partial(cambio, inputs)
+
+
+def ensemble_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield cambio_ensemble for 1 to 40 scenarios, without the compiled
+    kernel (as where numba is not installed), so that one scenario, the
+    usual page, stays as fast as running it through cambio
+    @returns  Iterator of (name, function to time)
+    """
+
+    def run(inputs_list):
+        compiled = kernels.USE_COMPILED_KERNEL
+        kernels.USE_COMPILED_KERNEL = False
+        try:
+            return cambio_ensemble(inputs_list)
+        finally:
+            kernels.USE_COMPILED_KERNEL = compiled
+
+    for count in (1, 5, 40):
+        inputs_list = [CambioInputs(long_term_emissions=0.1 * i) for i in range(count)]
+        yield f"cambio_ensemble[{count},numpy]", functools.partial(run, inputs_list)
+
+
+def checkpoint_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield cambio for new scenarios that differ only in their long term
+    emissions, without the compiled kernel (which does not use the
+    checkpoints), with no checkpoints and with 128 earlier runs kept, to
+    show the net gain of resuming from them. The checkpoints are made the
+    first time one of these is called (the untimed call).
+    @returns  Iterator of (name, function to time)
+    """
+
+    @functools.lru_cache(maxsize=None)
+    def checkpoints(entries: int) -> CheckpointCache:
+        cache = CheckpointCache(max_entries=max(entries, 1))
+        cache.enabled = entries > 0
+        model.checkpoint_cache = cache
+        try:
+            for i in range(entries):
+                cambio(CambioInputs(long_term_emissions=0.02 * i))
+        finally:
+            model.checkpoint_cache = checkpoint_cache
+        return cache
+
+    def run(entries, counter):
+        compiled = kernels.USE_COMPILED_KERNEL
+        kernels.USE_COMPILED_KERNEL = False
+        try:
+            model.checkpoint_cache = checkpoints(entries)
+            return cambio(CambioInputs(long_term_emissions=3 + next(counter) * 1e-6))
+        finally:
+            model.checkpoint_cache = checkpoint_cache
+            kernels.USE_COMPILED_KERNEL = compiled
+
+    for entries in (0, 128):
+        yield f"cambio[checkpoints={entries},python]", functools.partial(
+            run, entries, itertools.count()
+        )
+
+
+def emissions_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield the emissions scenario builder, computed afresh and from its cache
+    @returns  Iterator of (name, function to time)
+    """
+    args = (1750.0, 2200.0, 1.0, 0.025, 2040.0, 20.0, 2.0)
+    yield "make_emissions_scenario_lte[fresh]", functools.partial(
+        _make_emissions_scenario_lte.__wrapped__, *args
+    )
+    yield "make_emissions_scenario_lte[cached]", functools.partial(
+        make_emissions_scenario_lte, *args
+    )
+
+
+def plot_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield MakePlots.make for 1 to 20 scenarios (without result hashes, so
+    the panels are drawn every time). The scenarios are only run the first
+    time one of these is called (the untimed call), so leaving them out
+    with a pattern costs nothing.
+    @returns  Iterator of (name, function to time)
+    """
+
+    @functools.lru_cache(maxsize=None)
+    def climates() -> list[dict]:
+        scenarios = []
+        for i in range(20):
+            climate, _ = cambio(CambioInputs(long_term_emissions=0.2 * i))
+            climate["scenario_id"] = f"Scenario {i}"
+            scenarios.append(climate)
+        return scenarios
+
+    def make(count):
+        return MakePlots(QueryDict()).make(climates()[:count])
+
+    for count in (1, 5, 10, 20):
+        yield f"MakePlots.make[{count}]", functools.partial(make, count)
+
+
+def view_benchmarks() -> Iterator[tuple[str, Callable[[], object]]]:
+    """
+    Yield requests for the main page, with the caches emptied first and
+    with them full
+    @returns  Iterator of (name, function to time)
+    """
+    client = Client()
+    params = {"plot_scenario_Default": "on"}
+
+    def cold():
+        result_cache.get_result_cache().clear()
+        get_panel_cache().clear()
+        return client.get("/cambio/", params)
+
+    def warm():
+        return client.get("/cambio/", params)
+
+    yield "views.index[cold]", cold
+    yield "views.index[warm]", warm
+
+
+GROUPS = (
+    model_benchmarks,
+    ensemble_benchmarks,
+    checkpoint_benchmarks,
+    emissions_benchmarks,
+    plot_benchmarks,
+    view_benchmarks,
+)
+
+
+def time_function(func: Callable[[], object], min_time: float) -> dict:
+    """
+    Time a function, calling it often enough that each of REPEAT rounds
+    takes at least min_time
+    @param func  The function
+    @param min_time  Shortest time for a round, in seconds
+    @returns  The fastest and median time per call, in seconds, and the
+              number of calls per round
+    """
+    func()
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        if elapsed <= 0:
+            number *= 10
+        else:
+            number = max(2 * number, int(number * min_time / elapsed * 1.2))
+
+    times = [elapsed / number]
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    return {
+        "min": min(times),
+        "median": statistics.median(times),
+        "number": number,
+        "repeat": REPEAT,
+    }
+
+
+@contextmanager
+def benchmark_environment() -> Iterator[None]:
+    """
+    Turn off what would make repeated runs free (the checkpoints) or touch
+    the shared and database stores, for the duration of the suite
+    """
+    enabled = checkpoint_cache.enabled
+    checkpoint_cache.enabled = False
+    try:
+        with override_settings(
+            CAMBIO_SHARED_CACHE_BYTES=0,
+            CAMBIO_RESULT_STORE_BYTES=0,
+            CAMBIO_SERVER_TIMING=False,
+            ALLOWED_HOSTS=["testserver"],
+        ):
+            yield
+    finally:
+        checkpoint_cache.enabled = enabled
+
+
+def run_suite(
+    pattern: str = "*",
+    min_time: float = 0.2,
+    report: Callable[[str, dict], None] | None = None,
+) -> dict:
+    """
+    Run the benchmarks
+    @param pattern  Only run benchmarks whose names match this glob
+    @param min_time  Shortest time for each round of calls, in seconds
+    @param report  If given, called with the name and timing of each
+                   benchmark as it finishes
+    @returns  The results, ready to be saved as JSON
+    """
+    results = {}
+    with benchmark_environment():
+        for group in GROUPS:
+            for name, func in group():
+                if not fnmatch.fnmatchcase(name, pattern):
+                    continue
+                results[name] = time_function(func, min_time)
+                if report is not None:
+                    report(name, results[name])
+    return {
+        "meta": {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "cpus": os.cpu_count(),
+            "min_time": min_time,
+        },
+        "results": results,
+    }
+
+
+def compare(results: dict, baseline: dict) -> list[tuple[str, float, float, float]]:
+    """
+    Compare results with a baseline
+    @param results  Results, from run_suite
+    @param baseline  Earlier results, from run_suite
+    @returns  List of (name, baseline time, time, ratio) for every
+              benchmark in both, using the fastest times
+    """
+    rows = []
+    for name, timing in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        before = baseline["results"][name]["min"]
+        after = timing["min"]
+        rows.append((name, before, after, after / before))
+    return rows
+
+
+def regressions(
+    rows: list[tuple[str, float, float, float]], threshold: float = DEFAULT_THRESHOLD
+) -> list[str]:
+    """
+    Return the benchmarks that got slower than the threshold allows
+    @param rows  Comparison, from compare
+    @param threshold  Slow-down, as a fraction
+    @returns  Names of the regressed benchmarks
+    """
+    return [name for name, _, _, ratio in rows if ratio > 1 + threshold]
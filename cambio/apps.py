@@ -1,6 +1,30 @@
 from django.apps import AppConfig
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+
+def enable_sqlite_wal(sender, connection, **kwargs):
+    """
+    Put SQLite databases in WAL mode, so that readers of stored results
+    are not blocked while another process writes one (the mode is saved in
+    the database file, so it is only set with CAMBIO_SQLITE_WAL)
+    """
+    if connection.vendor == "sqlite" and getattr(settings, "CAMBIO_SQLITE_WAL", False):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA journal_mode=WAL")
+            cursor.execute("PRAGMA synchronous=NORMAL")
 
 
 class CambioConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "cambio"
+
+    def ready(self):
+        connection_created.connect(enable_sqlite_wal)
+
+        # Do the work of the first request now, if so set (best with
+        # gunicorn --preload, so the workers share it)
+        if getattr(settings, "CAMBIO_WARM_START", False):
+            from cambio.utils.warmup import warm_up
+
+            warm_up()
@@ -0,0 +1,87 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Run the benchmark suite (see benchmarks.suite).
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.suite import DEFAULT_THRESHOLD, compare, regressions, run_suite
+
+
+def format_time(seconds: float) -> str:
+    """
+    Format a time with sensible units
+    @param seconds  The time, in seconds
+    @returns  The time, as text
+    """
+    if seconds < 1e-3:
+        return f"{seconds * 1e6:8.2f} us"
+    if seconds < 1:
+        return f"{seconds * 1e3:8.2f} ms"
+    return f"{seconds:8.2f} s "
+
+
+class Command(BaseCommand):
+    help = "Time the model, the plotting and the views"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "-k",
+            "--pattern",
+            default="*",
+            help="Only run benchmarks whose names match this glob",
+        )
+        parser.add_argument("-o", "--output", help="Save the results to this file")
+        parser.add_argument(
+            "-c", "--compare", help="Compare the results with this baseline file"
+        )
+        parser.add_argument(
+            "--threshold",
+            type=float,
+            default=DEFAULT_THRESHOLD,
+            help="Slow-down, as a fraction, that counts as a regression",
+        )
+        parser.add_argument(
+            "--min-time",
+            type=float,
+            default=0.2,
+            help="Shortest time for each round of calls, in seconds",
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"], encoding="utf-8") as file:
+                baseline = json.load(file)
+
+        def report(name, timing):
+            self.stdout.write(f"{name:45s} {format_time(timing['min'])}")
+
+        results = run_suite(options["pattern"], options["min_time"], report)
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump(results, file, indent=2)
+            self.stdout.write(f"Saved the results to {options['output']}")
+
+        if baseline is None:
+            return
+
+        rows = compare(results, baseline)
+        slower = regressions(rows, options["threshold"])
+        self.stdout.write("")
+        self.stdout.write(f"{'Benchmark':45s} {'baseline':>11s} {'now':>11s}  ratio")
+        for name, before, after, ratio in rows:
+            flag = "  SLOWER" if name in slower else ""
+            self.stdout.write(
+                f"{name:45s} {format_time(before)} {format_time(after)} "
+                f"{ratio:6.2f}{flag}"
+            )
+        if slower:
+            raise CommandError(
+                f"{len(slower)} benchmark(s) more than "
+                f"{options['threshold']:.0%} slower than the baseline"
+            )
@@ -0,0 +1,113 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Replay recorded requests for the main page (see benchmarks.loadtest).
+"""
+
+from importlib import import_module
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from benchmarks.loadtest import (
+    HTTPSender,
+    SessionCookies,
+    WSGISender,
+    load_requests,
+    peak_rss,
+    run_load,
+)
+
+
+def delete_sessions(keys) -> None:
+    """
+    Delete the sessions the load test was given
+    @param keys  The session keys
+    """
+    store = import_module(settings.SESSION_ENGINE).SessionStore
+    for key in keys:
+        store(session_key=key).delete()
+
+
+class Command(BaseCommand):
+    help = "Load test the main page by replaying recorded requests"
+
+    def add_arguments(self, parser):
+        parser.add_argument("requests", help="File of recorded requests")
+        parser.add_argument(
+            "--url",
+            help="Send the requests to this server on this machine, such as "
+            "http://127.0.0.1:8000 (default: to the app in this process)",
+        )
+        parser.add_argument(
+            "--server-pid",
+            type=int,
+            help="Process id of the server, to report its peak memory",
+        )
+        parser.add_argument(
+            "-c", "--concurrency", type=int, default=1, help="Number of threads"
+        )
+        parser.add_argument(
+            "-n", "--count", type=int, help="Number of requests to send"
+        )
+        parser.add_argument(
+            "-d", "--duration", type=float, help="Send requests for this many seconds"
+        )
+        parser.add_argument(
+            "--warmup", type=int, default=0, help="Requests to send before timing"
+        )
+        parser.add_argument("-o", "--output", help="Save the report to this file")
+
+    def handle(self, *args, **options):
+        requests = load_requests(options["requests"])
+        if not requests:
+            raise CommandError("No requests to replay")
+
+        sessions = SessionCookies(settings.SESSION_COOKIE_NAME)
+        if options["url"]:
+            try:
+                sender = HTTPSender(options["url"], sessions)
+            except ValueError as err:
+                raise CommandError(err) from err
+            pid = options["server_pid"]
+        else:
+            # Imported here so the app is only set up for in-process runs
+            from cambio_site.wsgi import application
+
+            sender = WSGISender(application, sessions)
+            pid = None
+
+        # The server shares this database (it is on this machine), so the
+        # sessions it made for the replayed cookies can be removed here
+        try:
+            report = run_load(
+                sender,
+                requests,
+                options["concurrency"],
+                options["count"],
+                options["duration"],
+                options["warmup"],
+            )
+        finally:
+            delete_sessions(sessions.keys)
+        report["sessions"] = len(sessions.keys)
+        if options["url"] is None or pid is not None:
+            report["peak_rss"] = peak_rss(pid)
+
+        self.stdout.write(
+            f"{report['requests']} requests ({report['errors']} errors) in "
+            f"{report['elapsed']:.2f} s from {report['concurrency']} threads: "
+            f"{report['throughput']:.1f} requests/s"
+        )
+        for name, seconds in report["latency"].items():
+            self.stdout.write(f"  {name:4s} {seconds * 1000:8.1f} ms")
+        statuses = ", ".join(f"{s}: {n}" for s, n in report["statuses"].items())
+        self.stdout.write(f"  status {statuses}")
+        self.stdout.write(f"  {report['sessions']} sessions made and deleted")
+        if report.get("peak_rss") is not None:
+            self.stdout.write(f"  peak RSS {report['peak_rss'] / 2**20:.1f} MiB")
+
+        if options["output"]:
+            with open(options["output"], "w", encoding="utf-8") as file:
+                json.dump(report, file, indent=2)
@@ -0,0 +1,261 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Middleware for timing, profiling and counting requests.
+
+Each of these works with both the sync and the async views, so with
+CAMBIO_ASYNC_VIEWS on Django can run the whole chain on the event loop
+rather than wrapping each middleware in an adapter thread.
+"""
+
+import asyncio
+import json
+import logging
+import random
+from typing import Callable
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import HttpRequest, HttpResponse
+from django.urls import reverse
+
+from cambio.utils import metrics
+from cambio.utils.profiling import PROFILE_PARAM, RequestProfile, has_valid_signature
+from cambio.utils.timing import PhaseTimer, start_timer, stop_timer
+
+
+logger = logging.getLogger("cambio.timing")
+
+
+class HybridMiddleware:
+    """
+    Base class for middleware that runs in the same mode (sync or async) as
+    the rest of the chain. Subclasses implement both __call__ and __acall__;
+    __call__ hands over to __acall__ in async mode.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        """
+        Create an instance of the class
+
+        @param get_response  The next middleware or view
+        """
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+
+class ServerTimingMiddleware(HybridMiddleware):
+    """
+    Time the phases of each request (see timing), adding the durations to
+    the response as a Server-Timing header and logging them as JSON. Only
+    used with the CAMBIO_SERVER_TIMING setting on; otherwise Django drops
+    it at startup, so it costs nothing.
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        """
+        Create an instance of the class
+
+        @param get_response  The next middleware or view
+        """
+        if not getattr(settings, "CAMBIO_SERVER_TIMING", False):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """
+        Time the request
+        @param request  The HttpRequest
+        @returns  The HttpResponse, with the Server-Timing header
+        """
+        if self.async_mode:
+            return self.__acall__(request)
+        timer = start_timer()
+        try:
+            response = self.get_response(request)
+        finally:
+            stop_timer()
+        return self.report(request, response, timer)
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Time the request, in async mode"""
+        timer = start_timer()
+        try:
+            response = await self.get_response(request)
+        finally:
+            stop_timer()
+        return self.report(request, response, timer)
+
+    def report(
+        self, request: HttpRequest, response: HttpResponse, timer: PhaseTimer
+    ) -> HttpResponse:
+        """
+        Add the Server-Timing header to the response and log the durations
+        @param request  The HttpRequest
+        @param response  The HttpResponse
+        @param timer  The request's timer
+        @returns  The HttpResponse
+        """
+        response["Server-Timing"] = timer.header()
+        logger.info(
+            json.dumps(
+                {
+                    "method": request.method,
+                    "path": request.path,
+                    "status": response.status_code,
+                    "total_ms": round(timer.total() * 1000, 2),
+                    "phases_ms": {
+                        name: round(seconds * 1000, 2)
+                        for name, seconds in timer.durations.items()
+                    },
+                }
+            )
+        )
+        return response
+
+
+class ProfilingMiddleware(HybridMiddleware):
+    """
+    Profile requests with cProfile and/or tracemalloc (see profiling),
+    writing the profiles to the CAMBIO_PROFILE_DIR directory. A request is
+    profiled if CAMBIO_PROFILE is on, if it is picked at random at the
+    CAMBIO_PROFILE_SAMPLE_RATE, or, with CAMBIO_PROFILE_SIGNED on, if it
+    has a profile parameter signed for its path and query string. Static
+    files and /metrics are never profiled. With none of these settings,
+    Django drops the middleware at startup, so it costs nothing.
+
+    The CPU profile only covers the request's own thread; see profiling for
+    what that leaves out with the async views.
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        """
+        Create an instance of the class
+
+        @param get_response  The next middleware or view
+        """
+        self.always = getattr(settings, "CAMBIO_PROFILE", False)
+        self.sample_rate = getattr(settings, "CAMBIO_PROFILE_SAMPLE_RATE", 0.0)
+        self.signed = getattr(settings, "CAMBIO_PROFILE_SIGNED", False)
+        if not (self.always or self.sample_rate > 0 or self.signed):
+            raise MiddlewareNotUsed
+        mode = getattr(settings, "CAMBIO_PROFILE_MODE", "cpu")
+        self.cpu = mode in ("cpu", "both")
+        self.memory = mode in ("memory", "both")
+        self.keep = getattr(settings, "CAMBIO_PROFILE_KEEP", 50)
+        super().__init__(get_response)
+
+    def wants_profile(self, request: HttpRequest) -> bool:
+        """
+        Determine whether to profile a request
+        @param request  The HttpRequest
+        @returns  True to profile it
+        """
+        skipped = request.path.startswith(settings.STATIC_URL)
+        if skipped or request.path == reverse("metrics"):
+            return False
+        if self.always:
+            return True
+        if self.signed and PROFILE_PARAM in request.GET:
+            return has_valid_signature(request)
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """
+        Profile the request, if it is wanted
+        @param request  The HttpRequest
+        @returns  The HttpResponse
+        """
+        if self.async_mode:
+            return self.__acall__(request)
+        profile = self.start(request)
+        if profile is None:
+            return self.get_response(request)
+
+        with profile:
+            response = self.get_response(request)
+        profile.dump(self.summary(request, response), self.keep)
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Profile the request, if it is wanted, in async mode"""
+        profile = self.start(request)
+        if profile is None:
+            return await self.get_response(request)
+
+        with profile:
+            response = await self.get_response(request)
+        summary = self.summary(request, response)
+        await asyncio.to_thread(profile.dump, summary, self.keep)
+        return response
+
+    def start(self, request: HttpRequest) -> RequestProfile | None:
+        """
+        Return a profile for the request, if it is wanted and no other
+        request is being profiled
+        @param request  The HttpRequest
+        @returns  The RequestProfile, or None
+        """
+        if not self.wants_profile(request):
+            return None
+        return RequestProfile.acquire(self.cpu, self.memory)
+
+    def summary(self, request: HttpRequest, response: HttpResponse) -> dict:
+        """
+        Return the details of a profiled request to save with its profile
+        @param request  The HttpRequest
+        @param response  The HttpResponse
+        @returns  Dictionary of the details
+        """
+        return {
+            "method": request.method,
+            "path": request.path,
+            "query": request.META.get("QUERY_STRING", ""),
+            "status": response.status_code,
+            "scenario_hashes": getattr(request, "cambio_scenario_hashes", {}),
+        }
+
+
+class MetricsMiddleware(HybridMiddleware):
+    """
+    Write the metrics of this process to its file after a request, at most
+    every metrics.FLUSH_INTERVAL seconds, so the /metrics endpoint of any
+    worker can add them up (see metrics). Only used with the CAMBIO_METRICS
+    setting on.
+    """
+
+    def __init__(self, get_response: Callable[[HttpRequest], HttpResponse]):
+        """
+        Create an instance of the class
+
+        @param get_response  The next middleware or view
+        """
+        if not getattr(settings, "CAMBIO_METRICS", False):
+            raise MiddlewareNotUsed
+        super().__init__(get_response)
+
+    def __call__(self, request: HttpRequest) -> HttpResponse:
+        """
+        Handle the request, then write the metrics if they are due
+        @param request  The HttpRequest
+        @returns  The HttpResponse
+        """
+        if self.async_mode:
+            return self.__acall__(request)
+        response = self.get_response(request)
+        if metrics.flush_due():
+            metrics.flush()
+        return response
+
+    async def __acall__(self, request: HttpRequest) -> HttpResponse:
+        """Handle the request, then write the metrics if due, in async mode"""
+        response = await self.get_response(request)
+        if metrics.flush_due():
+            await asyncio.to_thread(metrics.flush)
+        return response
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-17 07:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = []
+
+    operations = [
+        migrations.CreateModel(
+            name="StoredResult",
+            fields=[
+                (
+                    "key",
+                    models.CharField(max_length=64, primary_key=True, serialize=False),
+                ),
+                ("data", models.BinaryField()),
+                ("compressed", models.BooleanField(default=False)),
+                ("nbytes", models.PositiveIntegerField()),
+                ("hits", models.PositiveIntegerField(default=0)),
+                ("last_used", models.DateTimeField(db_index=True)),
+            ],
+        ),
+    ]
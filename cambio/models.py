@@ -1,3 +1,19 @@
 from django.db import models
 
-# Create your models here.
+
+class StoredResult(models.Model):
+    """
+    Model results saved in the database, so they outlast the process
+    (see cambio.utils.persistent_store)
+    """
+
+    # Canonical hash of the CambioInputs the results are for
+    key = models.CharField(max_length=64, primary_key=True)
+    # The result arrays, packed and optionally compressed
+    data = models.BinaryField()
+    compressed = models.BooleanField(default=False)
+    # Size of data, in bytes, for the size cap
+    nbytes = models.PositiveIntegerField()
+    # How often and how recently the results were used
+    hits = models.PositiveIntegerField(default=0)
+    last_used = models.DateTimeField(db_index=True)
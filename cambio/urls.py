@@ -1,11 +1,19 @@
 """
 cambio app URL Configuration
 """
+from django.conf import settings
 from django.urls import path
 
 # imported views
 from . import views
 
+# Serve the async views if so set (best under ASGI)
+if getattr(settings, "CAMBIO_ASYNC_VIEWS", False):
+    index, data = views.index_async, views.data_async
+else:
+    index, data = views.index, views.data
+
 urlpatterns = [
-    path("", views.index, name="index"),
+    path("", index, name="index"),
+    path("data/", data, name="data"),
 ]
@@ -0,0 +1,96 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Helpers for the async views, which hand the model runs and the plotting
+to a bounded pool of threads so the event loop is never blocked.
+
+The pool is shared by every request in the process, so however many
+pages are loading at once, at most CAMBIO_EXECUTOR_WORKERS threads are
+busy with model runs and the rest of the work waits its turn. If a
+request is cancelled (for example, the client goes away) or times out,
+any of its work that has not started yet is dropped from the queue.
+"""
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import functools
+import os
+from typing import Any, Callable
+
+from django.conf import settings
+from django.db import close_old_connections
+
+from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.result_cache import inputs_hash, is_cacheable
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.view_utils import run_model_for_dict
+
+
+_executor: ThreadPoolExecutor | None = None
+
+
+def get_executor() -> ThreadPoolExecutor:
+    """
+    Return the thread pool for this process, with CAMBIO_EXECUTOR_WORKERS
+    threads (by default, one per core, up to 8)
+    @returns  The ThreadPoolExecutor
+    """
+    global _executor
+    if _executor is None:
+        max_workers = getattr(settings, "CAMBIO_EXECUTOR_WORKERS", None)
+        if not max_workers:
+            max_workers = min(8, os.cpu_count() or 1)
+        _executor = ThreadPoolExecutor(max_workers, thread_name_prefix="cambio")
+    return _executor
+
+
+def _call(func: Callable, *args: Any) -> Any:
+    """
+    Call a function in a pool thread, then let go of the thread's
+    database connection if it is done with
+    """
+    try:
+        return func(*args)
+    finally:
+        close_old_connections()
+
+
+async def offload(func: Callable, *args: Any) -> Any:
+    """
+    Run a blocking function in the thread pool, in a copy of the current
+    context (so the request's timer, for one, goes with it)
+    @param func  The function
+    @param args  Its arguments
+    @returns  What the function returns
+    """
+    loop = asyncio.get_running_loop()
+    context = contextvars.copy_context()
+    return await loop.run_in_executor(
+        get_executor(), functools.partial(context.run, _call, func, *args)
+    )
+
+
+async def run_model_for_dict_async(
+    scenario_inputs: dict[str, CambioInputs]
+) -> dict[str, dict[str, CambioVar]]:
+    """
+    Run the model for the inputs, running independent scenarios at the same
+    time in the thread pool (see run_model_for_dict)
+    @param scenario_inputs  The inputs, by scenario id
+    @returns  Climate model run outputs, by scenario id
+    """
+    # Scenarios with the same inputs are run together, and so only once
+    groups: dict[str, dict[str, CambioInputs]] = {}
+    for scenario_id, inputs in scenario_inputs.items():
+        key = inputs_hash(inputs) if is_cacheable(inputs) else scenario_id
+        groups.setdefault(key, {})[scenario_id] = inputs
+
+    results = await asyncio.gather(
+        *(offload(run_model_for_dict, group) for group in groups.values())
+    )
+
+    scenarios: dict[str, dict[str, CambioVar]] = {}
+    for result in results:
+        scenarios.update(result)
+    return {scenario_id: scenarios[scenario_id] for scenario_id in scenario_inputs}
@@ -74,20 +74,43 @@ Refactored for wep app By Penny Rowe and Daniel Neshyba-Rowe
 
 
 import numpy as np
+import numpy.typing as npt
 from cambio.utils.schemas import CambioInputs
 
 
-from cambio.utils.cambio_utils import make_emissions_scenario_lte, is_same
+from collections.abc import Iterable
+from time import perf_counter
+
+from cambio.utils.cambio_utils import (
+    make_emissions_scenario_lte,
+    make_emissions_scenarios_lte,
+)
 from cambio.utils.climate_params import ClimateParams
+from cambio.utils.scalar_diagnostics import ScalarClimateParams
 from cambio.utils.preindustrial_inputs import preindustrial_inputs
 from cambio.utils.cambio_utils import diagnose_actual_temperature
 from cambio.utils.cambio_utils import CambioVar
-
-
-def cambio(inputs: CambioInputs) -> tuple[dict[str, CambioVar], dict[str, float]]:
+from cambio.utils import kernels
+from cambio.utils.checkpoints import checkpoint_cache, trajectory_key
+from cambio.utils.metrics import MODEL_RUN_SECONDS, MODEL_SCENARIOS, MODEL_STEPS
+from cambio.utils.climate_state import (
+    ClimateState,
+    DIAGNOSTIC_VARS,
+    C_ATM,
+    C_OCEAN,
+    ALBEDO,
+    T_ANOMALY,
+)
+
+
+def cambio(
+    inputs: CambioInputs, diagnostics: Iterable[str] | None = None
+) -> tuple[dict[str, CambioVar], dict[str, float]]:
     """
     Run the cambio model
     @param inputs  Required inputs (see notes)
+    @param diagnostics  Names of the diagnostic outputs to compute (pH,
+                        T_C, the fluxes and year), or None for all of them
     @returns  The model results
     Notes:
     Inputs must include:
@@ -116,6 +139,7 @@ def cambio(inputs: CambioInputs) -> tuple[dict[str, CambioVar], dict[str, float]
     - F_al  flux atmosphere-land, GtC/year
     - year
     """
+    start_time = perf_counter()
 
     # Call the LTE emissions scenario maker with these parameters
     # time is in years
@@ -136,33 +160,19 @@ def cambio(inputs: CambioInputs) -> tuple[dict[str, CambioVar], dict[str, float]
     # We've set the starting year to what was specified above when you
     # created your scenario.
     climate_params = preindustrial_inputs()
-    climateParams = ClimateParams(inputs.stochastic_c_atm_std_dev)
+    climateParams = ClimateParams(inputs.stochastic_c_atm_std_dev, make_rng(inputs))
 
     # Propagating through time
 
-    # Make the starting state the preindustrial
-    # Create an empty climate state
-    climatestate: dict[str, float] = {}
-    # Fill in some default (preindustrial) values
-    climatestate["C_atm"] = climate_params["preindust_c_atm"]
-    climatestate["C_ocean"] = climate_params["preindust_c_ocean"]
-    climatestate["albedo"] = climate_params["preindust_albedo"]
-    climatestate["T_anomaly"] = 0
-    # These are just placeholders (values don't mean anything)
-    climatestate["pH"] = 0
-    climatestate["T_C"] = 0
-    climatestate["F_ha"] = 0
-    climatestate["F_ao"] = 0
-    climatestate["F_oa"] = 0
-    climatestate["F_al"] = 0
-    climatestate["F_la"] = 0
-    climatestate["year"] = time[0] - inputs.dtime
-
-    # Initialize the dictionary that will hold the time series
+    # Create the climate state that will hold the time series, with
+    # a slot for the starting state ahead of the first time step
     ntimes = len(time)
-    climate: dict[str, CambioVar] = {}
-    for key in climatestate:
-        climate[key] = np.zeros(ntimes)
+    state = ClimateState(ntimes)
+
+    # Make the starting state the preindustrial
+    state.set_initial("C_atm", climate_params["preindust_c_atm"])
+    state.set_initial("C_ocean", climate_params["preindust_c_ocean"])
+    state.set_initial("albedo", climate_params["preindust_albedo"])
 
     # Only turn on noise if the noise level is > 0
     if inputs.stochastic_c_atm_std_dev > 0:
@@ -170,42 +180,366 @@ def cambio(inputs: CambioInputs) -> tuple[dict[str, CambioVar], dict[str, float]
     else:
         stochastic_c_atm = False
 
-    # Loop over all the times in the scheduled flow
-    for i in range(len(time)):
+    # Step through time, from a checkpoint if there is one
+    buffer = state.buffer
+    propagate_climate(buffer, climateParams, inputs, flux_human_atm, stochastic_c_atm)
 
-        # Propagate
-        climatestate = propagate_climate_state(
-            climatestate,
+    # Diagnose everything else from the prognostic variables in one pass
+    climate = state.climate()
+    climate.update(
+        diagnose_climate(
+            buffer,
+            climateParams,
+            time,
+            flux_human_atm,
+            inputs.temp_anomaly_feedback,
+            inputs.flux_al_transition_temp,
+            diagnostics,
+        )
+    )
+
+    # Add variables that are constants
+    climate["albedo_trans_temp"] = np.array([inputs.albedo_transition_temp])
+    climate["flux_al_trans_temp"] = np.array([inputs.flux_al_transition_temp])
+
+    MODEL_SCENARIOS.inc()
+    MODEL_RUN_SECONDS.observe(perf_counter() - start_time, function="cambio")
+    return climate, climate_params
+
+
+# Fewest scenarios sharing a time axis for which stepping them together
+# beats running them one at a time, without the compiled kernel. Each
+# NumPy step costs about the same for 1 scenario as for 20, while a
+# scalar cambio run takes about 2 ms, so they cross at about 20-25.
+ENSEMBLE_MIN_SCENARIOS = 24
+
+
+def cambio_ensemble(
+    inputs_list: list[CambioInputs], diagnostics: Iterable[str] | None = None
+) -> list[tuple[dict[str, CambioVar], dict[str, float]]]:
+    """
+    Run the cambio model for many scenarios at once
+    @param inputs_list  Required inputs for each scenario (see cambio)
+    @param diagnostics  Names of the diagnostic outputs to compute, or None
+                        for all of them
+    @returns  The model results for each scenario, in the same order as
+              the inputs, as returned by cambio
+    Notes:
+    Scenarios that share a time axis (start_year, stop_year, dtime) are
+    stacked along a scenario axis and propagated together, so each time
+    step is a handful of NumPy operations no matter how many scenarios
+    there are. The feedback flags and the albedo constraint are applied
+    as masks over the scenario axis. Seeded stochastic scenarios are run
+    on their own, so they draw the same noise as they would from cambio.
+    So are groups too small for stepping them together to pay off (see
+    ENSEMBLE_MIN_SCENARIOS), as with the usual one scenario per page.
+    """
+    start_time = perf_counter()
+    results: list[tuple[dict[str, CambioVar], dict[str, float]]] = [None] * len(
+        inputs_list
+    )
+
+    # Group the scenarios by time axis
+    groups: dict[tuple[float, float, float], list[int]] = {}
+    for iscen, inputs in enumerate(inputs_list):
+        if make_rng(inputs) is not None:
+            results[iscen] = cambio(inputs, diagnostics)
+            continue
+        key = (inputs.start_year, inputs.stop_year, inputs.dtime)
+        groups.setdefault(key, []).append(iscen)
+
+    # With the compiled kernel, the group only shares the diagnostics,
+    # which pays off from two scenarios
+    min_scenarios = 2 if kernels.USE_COMPILED_KERNEL else ENSEMBLE_MIN_SCENARIOS
+    for iscens in groups.values():
+        if len(iscens) < min_scenarios:
+            for iscen in iscens:
+                results[iscen] = cambio(inputs_list[iscen], diagnostics)
+            continue
+        group_results = _cambio_ensemble_group(
+            [inputs_list[i] for i in iscens], diagnostics
+        )
+        for iscen, result in zip(iscens, group_results):
+            results[iscen] = result
+
+    MODEL_RUN_SECONDS.observe(perf_counter() - start_time, function="cambio_ensemble")
+    return results
+
+
+def _cambio_ensemble_group(
+    inputs_list: list[CambioInputs], diagnostics: Iterable[str] | None = None
+) -> list[tuple[dict[str, CambioVar], dict[str, float]]]:
+    """
+    Run the cambio model for scenarios that share a time axis
+    @param inputs_list  Required inputs for each scenario
+    @param diagnostics  Names of the diagnostic outputs to compute
+    @returns  The model results for each scenario
+    """
+    nscen = len(inputs_list)
+    dtime = inputs_list[0].dtime
+
+    # Per-scenario inputs, as arrays along the scenario axis
+    def as_array(name: str, dtype: type = np.float64) -> npt.NDArray:
+        return np.array([getattr(inputs, name) for inputs in inputs_list], dtype)
+
+    # Emissions for each scenario, built together as (nscen, ntimes) (the
+    # scenarios reaching the model are mostly new ones, missing from the
+    # cache of make_emissions_scenario_lte)
+    time, flux_human_atm = make_emissions_scenarios_lte(
+        inputs_list[0].start_year,
+        inputs_list[0].stop_year,
+        dtime,
+        as_array("inv_time_constant"),
+        as_array("transition_year"),
+        as_array("transition_duration"),
+        as_array("long_term_emissions"),
+    )
+
+    std_dev = as_array("stochastic_c_atm_std_dev")
+    albedo_with_no_constraint = as_array("albedo_with_no_constraint", bool)
+    albedo_feedback = as_array("albedo_feedback", bool)
+    albedo_transition_temp = as_array("albedo_transition_temp")
+    flux_al_transition_temp = as_array("flux_al_transition_temp")
+    temp_anomaly_feedback = as_array("temp_anomaly_feedback", bool)
+
+    climate_params = preindustrial_inputs()
+    climateParams = ClimateParams(std_dev)
+
+    # Create the climate state for every scenario, as (nvars, nscen, ntimes + 1)
+    ntimes = len(time)
+    state = ClimateState(ntimes, nscen)
+
+    # Make the starting state the preindustrial, for every scenario
+    state.set_initial("C_atm", climate_params["preindust_c_atm"])
+    state.set_initial("C_ocean", climate_params["preindust_c_ocean"])
+    state.set_initial("albedo", climate_params["preindust_albedo"])
+
+    # Only turn on noise where the noise level is > 0
+    stochastic_c_atm = std_dev > 0
+
+    # With the compiled kernel, each scenario is fastest on its own;
+    # otherwise loop over all the times in the scheduled flow
+    buffer = state.buffer
+    if kernels.USE_COMPILED_KERNEL:
+        for iscen, inputs in enumerate(inputs_list):
+            propagate_climate(
+                buffer[:, iscen],
+                ClimateParams(std_dev[iscen]),
+                inputs,
+                flux_human_atm[iscen],
+                stochastic_c_atm[iscen],
+            )
+    else:
+        for i in range(ntimes):
+            propagate_climate_ensemble(
+                buffer,
+                i,
+                climateParams,
+                dtime,
+                flux_human_atm[:, i],
+                albedo_with_no_constraint,
+                albedo_feedback,
+                albedo_transition_temp,
+                stochastic_c_atm,
+                flux_al_transition_temp,
+                temp_anomaly_feedback,
+            )
+        MODEL_STEPS.inc(ntimes * nscen, method="numpy")
+
+    # Diagnose everything else for every scenario in one pass
+    # (the per-scenario inputs become columns, to broadcast over time)
+    diagnosed = diagnose_climate(
+        buffer,
+        climateParams,
+        time,
+        flux_human_atm,
+        temp_anomaly_feedback[:, np.newaxis],
+        flux_al_transition_temp[:, np.newaxis],
+        diagnostics,
+    )
+
+    # Split the results back out into one climate per scenario
+    results = []
+    for iscen, inputs in enumerate(inputs_list):
+        scenario = state.climate(iscen)
+        for key, value in diagnosed.items():
+            scenario[key] = value[iscen]
+        scenario["albedo_trans_temp"] = np.array([inputs.albedo_transition_temp])
+        scenario["flux_al_trans_temp"] = np.array([inputs.flux_al_transition_temp])
+        results.append((scenario, dict(climate_params)))
+
+    MODEL_SCENARIOS.inc(nscen)
+    return results
+
+
+def make_rng(inputs: CambioInputs) -> np.random.Generator | None:
+    """
+    Return the random number generator for a stochastic run
+    @param inputs  The CambioInputs
+    @returns  A generator seeded from the inputs, or None if the run is not
+              seeded (or has no noise) and so uses NumPy's global one
+    """
+    seed = getattr(inputs, "random_seed", None)
+    if seed is None or inputs.stochastic_c_atm_std_dev <= 0:
+        return None
+    return np.random.default_rng(seed)
+
+
+def diagnose_climate(
+    buffer: CambioVar,
+    climateParams: ClimateParams,
+    time: CambioVar,
+    flux_human_atm: CambioVar,
+    temp_anomaly_feedback: bool | npt.NDArray[np.bool_],
+    flux_al_transition_temp: float | CambioVar,
+    diagnostics: Iterable[str] | None = None,
+) -> dict[str, CambioVar]:
+    """
+    Diagnose the outputs that do not feed back into the time loop
+    (pH, T_C, the fluxes and year) from the integrated prognostic variables,
+    all time steps at once
+
+    @param buffer  ClimateState buffer, (nvars, ntimes + 1) or
+                   (nvars, nscen, ntimes + 1), with the starting state
+                   in column 0
+    @param climateParams  Climate params class
+    @param time  Years, (ntimes,)
+    @param flux_human_atm  Anthropogenic carbon flux, shaped like the time series
+    @param temp_anomaly_feedback  Flag (an (nscen, 1) array for an ensemble)
+    @param flux_al_transition_temp  Forest tipping point (likewise)
+    @param diagnostics  Names of the outputs to compute, or None for all
+    @returns  Dictionary of diagnosed time series
+    """
+    if diagnostics is None:
+        names = DIAGNOSTIC_VARS
+    else:
+        names = tuple(diagnostics)
+        unknown = set(names) - set(DIAGNOSTIC_VARS)
+        if unknown:
+            raise ValueError(f"Unknown diagnostics: {sorted(unknown)}")
+
+    # The carbon amounts after each step, and going into each step
+    c_atm = buffer[C_ATM, ..., 1:]
+    prev_c_atm = buffer[C_ATM, ..., :-1]
+    prev_c_ocean = buffer[C_OCEAN, ..., :-1]
+
+    # The fluxes at each step see the temperature anomaly from the previous
+    # step's carbon, before the albedo feedback is added
+    if "F_oa" in names or "F_al" in names:
+        t_anom = climateParams.diagnose_temp_anomaly(prev_c_atm)
+
+    diagnosed: dict[str, CambioVar] = {}
+    for name in DIAGNOSTIC_VARS:
+        if name not in names:
+            continue
+        if name == "pH":
+            diagnosed[name] = climateParams.diagnose_ocean_surface_ph(c_atm)
+        elif name == "T_C":
+            diagnosed[name] = diagnose_actual_temperature(buffer[T_ANOMALY, ..., 1:])
+        elif name == "F_ha":
+            diagnosed[name] = np.array(flux_human_atm, dtype=np.float64)
+        elif name == "F_ao":
+            diagnosed[name] = climateParams.diagnose_flux_atm_ocean(prev_c_atm)
+        elif name == "F_oa":
+            diagnosed[name] = climateParams.diagnose_flux_ocean_atm(
+                prev_c_ocean, t_anom
+            )
+        elif name == "F_la":
+            diagnosed[name] = np.full(
+                c_atm.shape, climateParams.diagnose_flux_land_atm(), np.float64
+            )
+        elif name == "F_al":
+            diagnosed[name] = climateParams.diagnose_flux_atm_land(
+                np.where(temp_anomaly_feedback, t_anom, 0.0),
+                prev_c_atm,
+                flux_al_transition_temp,
+            )
+        elif name == "year":
+            diagnosed[name] = np.broadcast_to(time, c_atm.shape).astype(np.float64)
+
+    return diagnosed
+
+
+def propagate_climate(
+    buffer: CambioVar,
+    climateParams: ClimateParams,
+    inputs: CambioInputs,
+    flux_human_atm: CambioVar,
+    stochastic_c_atm: bool,
+) -> None:
+    """
+    Propagate the prognostic climate state of one scenario over all the
+    time steps, picking up from a checkpoint of an equivalent earlier run
+    when there is one (see checkpoints)
+
+    @param buffer  ClimateState buffer, (nvars, ntimes + 1), with the
+                   starting state in column 0
+    @param climateParams  Climate params class
+    @param inputs  The CambioInputs
+    @param flux_human_atm  Anthropogenic carbon flux at each time step
+    @param stochastic_c_atm  Flag; noisy runs are never checkpointed, nor
+                             are runs with the compiled kernel
+    """
+    ntimes = len(flux_human_atm)
+
+    # Skip the time steps that an earlier run has already done (the
+    # compiled kernel is faster than looking them up)
+    start = 0
+    checkpointed = not (stochastic_c_atm or kernels.USE_COMPILED_KERNEL)
+    if checkpointed:
+        key = trajectory_key(inputs)
+        start = checkpoint_cache.resume(key, flux_human_atm, buffer)
+        if start == ntimes:
+            return
+
+    # Use the compiled kernel if we have it; otherwise loop over the
+    # remaining times in the scheduled flow, writing each new state
+    # straight into the buffer
+    if kernels.USE_COMPILED_KERNEL:
+        kernels.propagate_climate_compiled(
+            buffer,
             climateParams,
             inputs.dtime,
-            flux_human_atm[i],
+            flux_human_atm,
             inputs.albedo_with_no_constraint,
             inputs.albedo_feedback,
             inputs.albedo_transition_temp,
             stochastic_c_atm,
             inputs.flux_al_transition_temp,
             inputs.temp_anomaly_feedback,
+            start,
         )
+    else:
+        # Every value in this loop is a float, so use the math-based
+        # diagnostics rather than NumPy's
+        scalarParams = ScalarClimateParams(
+            inputs.stochastic_c_atm_std_dev, climateParams.rng
+        )
+        for i in range(start, ntimes):
+            propagate_climate_state(
+                buffer,
+                i,
+                scalarParams,
+                inputs.dtime,
+                flux_human_atm[i],
+                inputs.albedo_with_no_constraint,
+                inputs.albedo_feedback,
+                inputs.albedo_transition_temp,
+                stochastic_c_atm,
+                inputs.flux_al_transition_temp,
+                inputs.temp_anomaly_feedback,
+            )
 
-        # Append to climate variables
-        for key, value in climatestate.items():
-            climate[key][i] = value
-
-    # Add variables that are constants
-    climate["albedo_trans_temp"] = np.array([inputs.albedo_transition_temp])
-    climate["flux_al_trans_temp"] = np.array([inputs.flux_al_transition_temp])
-
-    # QC: make sure the input and output times and human co2 emissions are same
-    if not is_same(time, climate["year"]):
-        raise ValueError("The input and output times differ!")
-    if not is_same(flux_human_atm, climate["F_ha"]):
-        raise ValueError("The input and output anthropogenic emissions differ!")
+    method = "compiled" if kernels.USE_COMPILED_KERNEL else "python"
+    MODEL_STEPS.inc(ntimes - start, method=method)
 
-    return climate, climate_params
+    if checkpointed:
+        checkpoint_cache.store(key, flux_human_atm, buffer)
 
 
 def propagate_climate_state(
-    prev_climatestate: dict[str, float],
+    buffer: CambioVar,
+    i: int,
     climateParams: ClimateParams,
     dtime: float = 1,
     f_ha: float = 0,
@@ -215,27 +549,29 @@ def propagate_climate_state(
     stochastic_c_atm: bool = False,
     flux_al_transition_temp: float = 4,
     temp_anomaly_feedback: bool = False,
-) -> dict[str, float]:
+) -> None:
 
     """
-    Propagate the state of the climate, with a specified anthropogenic
+    Propagate the prognostic climate state, with a specified anthropogenic
     carbon flux
 
-    @param prev_climatestate
-    @param ClimateParams  Climate params class
+    @param buffer  ClimateState buffer, (nvars, ntimes + 1)
+    @param i  Time step; the previous state is read from column i and
+              the new state is written to column i + 1
+    @param ClimateParams  Climate params class (ScalarClimateParams is
+                          fastest here, since every value is a float)
     @param climparams, dtime, F_ha
-    @returns dictionary of climate state
 
     Default anthropogenic carbon flux is zero
     Default time step is 1 year
-    Returns a new climate state
     """
 
     # More inputs (for feedbacks and etc)
 
     # Extract concentrations from the previous climate state
-    c_atm = prev_climatestate["C_atm"]
-    c_ocean = prev_climatestate["C_ocean"]
+    prev_climatestate = buffer[:, i]
+    c_atm = float(prev_climatestate[C_ATM])
+    c_ocean = float(prev_climatestate[C_OCEAN])
 
     # Get the temperature anomaly resulting from carbon concentrations
     t_anom = climateParams.diagnose_temp_anomaly(c_atm)
@@ -267,7 +603,7 @@ def propagate_climate_state(
             albedo = climateParams.diagnose_albedo_w_constraint(
                 albedo_transition_temp,
                 t_anom,
-                prev_climatestate["albedo"],
+                prev_climatestate[ALBEDO],
                 dtime,
             )
         else:
@@ -279,31 +615,102 @@ def propagate_climate_state(
         t_anom += climateParams.diagnose_delta_t_from_albedo(albedo)
 
     else:
-        albedo = prev_climatestate["albedo"]
+        albedo = prev_climatestate[ALBEDO]
         # The t_anom was set previously and does not change
 
     # Stochasticity in the model (if we want it)
     if stochastic_c_atm:
         c_atm = climateParams.diagnose_stochastic_c_atm(c_atm)
 
-    # Ordinary diagnostics
-    ph_ = climateParams.diagnose_ocean_surface_ph(c_atm)
-    temp_c = diagnose_actual_temperature(t_anom)
-
-    # Create a new climate state with these updates
-    climatestate: dict[str, float] = {}
-    climatestate["C_atm"] = c_atm
-    climatestate["C_ocean"] = c_ocean
-    climatestate["albedo"] = albedo
-    climatestate["T_anomaly"] = t_anom
-    climatestate["pH"] = ph_
-    climatestate["T_C"] = temp_c
-    climatestate["F_ha"] = f_ha
-    climatestate["F_ao"] = f_ao
-    climatestate["F_oa"] = f_oa
-    climatestate["F_la"] = f_la
-    climatestate["F_al"] = f_al
-    climatestate["year"] = prev_climatestate["year"] + dtime
-
-    # Return the new climate state
-    return climatestate
+    # Write the new climate state into the next column
+    # (the ordinary diagnostics are done afterwards, by diagnose_climate)
+    climatestate = buffer[:, i + 1]
+    climatestate[C_ATM] = c_atm
+    climatestate[C_OCEAN] = c_ocean
+    climatestate[ALBEDO] = albedo
+    climatestate[T_ANOMALY] = t_anom
+
+
+def propagate_climate_ensemble(
+    buffer: CambioVar,
+    i: int,
+    climateParams: ClimateParams,
+    dtime: float,
+    f_ha: CambioVar,
+    albedo_with_no_constraint: npt.NDArray[np.bool_],
+    albedo_feedback: npt.NDArray[np.bool_],
+    albedo_transition_temp: CambioVar,
+    stochastic_c_atm: npt.NDArray[np.bool_],
+    flux_al_transition_temp: CambioVar,
+    temp_anomaly_feedback: npt.NDArray[np.bool_],
+) -> None:
+    """
+    Propagate the prognostic climate state for many scenarios at once.
+    This is propagate_climate_state with every value (and every flag)
+    an array along the scenario axis
+
+    @param buffer  ClimateState buffer, (nvars, nscen, ntimes + 1)
+    @param i  Time step; the previous state is read from column i and
+              the new state is written to column i + 1
+    @param climateParams  Climate params class
+    @param dtime  Time step (years)
+    @param f_ha  Anthropogenic carbon flux for each scenario
+    @param albedo_with_no_constraint, albedo_feedback  Flags for each scenario
+    @param albedo_transition_temp  Albedo tipping point for each scenario
+    @param stochastic_c_atm  Flag for each scenario
+    @param flux_al_transition_temp  Forest tipping point for each scenario
+    @param temp_anomaly_feedback  Flag for each scenario
+    """
+
+    # Extract concentrations from the previous climate state
+    prev_climatestate = buffer[:, :, i]
+    c_atm = prev_climatestate[C_ATM]
+    c_ocean = prev_climatestate[C_OCEAN]
+    prev_albedo = prev_climatestate[ALBEDO]
+
+    # Get the temperature anomaly resulting from carbon concentrations
+    t_anom = climateParams.diagnose_temp_anomaly(c_atm)
+
+    # Get fluxes, activating the impact temperature has on land only
+    # where the feedback is on
+    f_oa = climateParams.diagnose_flux_ocean_atm(c_ocean, t_anom)
+    f_al = climateParams.diagnose_flux_atm_land(
+        np.where(temp_anomaly_feedback, t_anom, 0.0), c_atm, flux_al_transition_temp
+    )
+
+    # Get other fluxes resulting from carbon concentrations
+    f_ao = climateParams.diagnose_flux_atm_ocean(c_atm)
+    f_la = climateParams.diagnose_flux_land_atm()
+
+    # Update concentrations of carbon based on these fluxes
+    c_atm = c_atm + (f_la + f_oa - f_ao - f_al + f_ha) * dtime
+    c_ocean = c_ocean + (f_ao - f_oa) * dtime
+
+    # Where the albedo feedback is on, get albedo from temperature anomaly
+    # (limiting the change where the constraint is on); elsewhere keep it
+    albedo = climateParams.diagnose_albedo(albedo_transition_temp, t_anom)
+    constrain = albedo_with_no_constraint & (prev_albedo != 0) & (dtime != 0)
+    max_albedo_change = ClimateParams.max_albedo_change_rate * dtime
+    limited_albedo = prev_albedo + np.clip(
+        albedo - prev_albedo, -max_albedo_change, max_albedo_change
+    )
+    albedo = np.where(constrain, limited_albedo, albedo)
+    albedo = np.where(albedo_feedback, albedo, prev_albedo)
+
+    # Get a new temperature anomaly as impacted by albedo, where wanted
+    t_anom = t_anom + np.where(
+        albedo_feedback, climateParams.diagnose_delta_t_from_albedo(albedo), 0.0
+    )
+
+    # Stochasticity in the model, where wanted
+    if np.any(stochastic_c_atm):
+        c_atm = np.where(
+            stochastic_c_atm, climateParams.diagnose_stochastic_c_atm(c_atm), c_atm
+        )
+
+    # Write the new climate state into the next column
+    climatestate = buffer[:, :, i + 1]
+    climatestate[C_ATM] = c_atm
+    climatestate[C_OCEAN] = c_ocean
+    climatestate[ALBEDO] = albedo
+    climatestate[T_ANOMALY] = t_anom
@@ -8,7 +8,7 @@ Created on Wed Dec 21 15:49:24 2022
 By Steven Neshyba and Penny Rowe
 Refactored by Penny Rowe and Daniel Neshyba-Rowe
 """
-from copy import deepcopy as makeacopy
+from functools import lru_cache
 from typing import Any
 import numpy as np
 import numpy.typing as npt
@@ -116,25 +116,28 @@ def diagnose_degrees_f(temp_c: float) -> float:
 def post_peak_flattener(
     time: CambioVar,
     eps: CambioVar,
-    transitiontimeinterval: float,
-    epslongterm: float,
+    transitiontimeinterval: float | CambioVar,
+    epslongterm: float | CambioVar,
 ) -> CambioVar:
     """
     Flatten the post peak
 
     @param time, eps, transitiontimeinterval, epslongterm
     @returns neweps
+    Notes:
+    eps may also be (nscen, ntimes), with transitiontimeinterval and
+    epslongterm as (nscen, 1) columns, to flatten many scenarios at once
     """
-    ipeak = np.where(eps == np.max(eps))[0][0]
-    b = eps[ipeak]
+    # Index and value of the (first) peak of each scenario
+    ipeak = np.argmax(eps, axis=-1)[..., np.newaxis]
+    b = np.take_along_axis(eps, ipeak, axis=-1)
     a = epslongterm
-    neweps = makeacopy(eps)
-    for i in range(ipeak, len(eps)):
-        # ipostpeak = i - ipeak
-        neweps[i] = a + np.exp(
-            -((time[i] - time[ipeak]) ** 2) / transitiontimeinterval**2
-        ) * (b - a)
-    return neweps
+
+    # From the peak on, decay towards the long term emissions
+    flattened = a + np.exp(
+        -((time - time[ipeak]) ** 2) / transitiontimeinterval**2
+    ) * (b - a)
+    return np.where(np.arange(eps.shape[-1]) >= ipeak, flattened, eps)
 
 
 def make_emissions_scenario(
@@ -203,7 +206,72 @@ def make_emissions_scenario_lte(
     @param epslongterm  Long term CO2 emissions
     @returns time
     @returns neweps  Anthropogenic CO2 emissions, with time
+    Notes:
+    The scenario depends only on the inputs, so recent ones are cached;
+    the arrays returned are shared and read-only
+    """
+    return _make_emissions_scenario_lte(
+        float(t_start),
+        float(t_stop),
+        float(dtime),
+        float(k),
+        float(t_peak),
+        float(delta_t),
+        float(epslongterm),
+    )
+
+
+@lru_cache(maxsize=256)
+def _make_emissions_scenario_lte(
+    t_start: float,
+    t_stop: float,
+    dtime: float,
+    k: float,
+    t_peak: float,
+    delta_t: float,
+    epslongterm: float,
+) -> tuple[CambioVar, CambioVar]:
+    """
+    Make emissions scenario with long term emissions (cached)
     """
+    time = np.arange(t_start, t_stop, dtime)
+    eps = make_emissions_scenario2(time, k, t_peak, delta_t)
+    neweps = post_peak_flattener(time, eps, delta_t, epslongterm)
+    time.flags.writeable = False
+    neweps.flags.writeable = False
+    return time, neweps
+
+
+def make_emissions_scenarios_lte(
+    t_start: float,
+    t_stop: float,
+    dtime: float,
+    k: float | CambioVar,
+    t_peak: float | CambioVar,
+    delta_t: float | CambioVar,
+    epslongterm: float | CambioVar,
+) -> tuple[CambioVar, CambioVar]:
+    """
+    Make many emissions scenarios with long term emissions at once
+
+    @param t_start, t_stop, dtime  Time axis, shared by all the scenarios
+    @param k  Inverse time constant for each scenario
+    @param t_peak  Year of peak carbon for each scenario
+    @param delta_t  Transition time interval for each scenario
+    @param epslongterm  Long term CO2 emissions for each scenario
+    @returns time  (ntimes,)
+    @returns neweps  Anthropogenic CO2 emissions, (nscen, ntimes)
+    Notes:
+    Scalars are used for every scenario
+    """
+    params = np.broadcast_arrays(
+        *[
+            np.atleast_1d(np.asarray(x, dtype=np.float64))
+            for x in (k, t_peak, delta_t, epslongterm)
+        ]
+    )
+    k, t_peak, delta_t, epslongterm = [x[:, np.newaxis] for x in params]
+
     time = np.arange(t_start, t_stop, dtime)
     eps = make_emissions_scenario2(time, k, t_peak, delta_t)
     neweps = post_peak_flattener(time, eps, delta_t, epslongterm)
@@ -0,0 +1,223 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Cache of partial model runs, so that a new run can resume from the
+point where it stops agreeing with a run that has already been done.
+
+Every scenario starts from the same preindustrial state, and two
+scenarios follow exactly the same trajectory for as long as their
+emissions agree and their other trajectory inputs (time step, feedback
+flags and tipping points) are the same. For example, changing only the
+long term emissions leaves everything up to the emissions peak alone.
+The cache keeps the prognostic state of recent runs and, for a new run,
+copies in the longest prefix that is valid for it, rounded down to a
+checkpoint every `interval` steps. A prefix is valid only if the
+emissions agree to within `tolerance` at every step (exactly, by
+default), so resumed runs give the same results as fresh ones.
+
+With exact matching, each run is indexed by its trajectory key and a
+digest of its emissions up to each checkpoint, so finding the longest
+prefix takes one dictionary lookup per checkpoint, however many runs are
+kept. With a tolerance, the runs with the same key are compared step by
+step.
+
+The compiled kernel runs the whole time axis faster than a lookup, so
+cambio does not use the cache when it has the kernel.
+"""
+
+from collections import OrderedDict
+import hashlib
+import threading
+from typing import Hashable
+
+import numpy as np
+
+from cambio.utils.cambio_utils import CambioVar
+
+
+class CheckpointCache:
+    """
+    LRU cache of prognostic climate states from previous model runs
+    """
+
+    def __init__(
+        self, max_entries: int = 128, interval: int = 10, tolerance: float = 0.0
+    ) -> None:
+        """
+        Create an instance of the class
+
+        @param max_entries  Number of runs to keep
+        @param interval  Number of time steps between checkpoints
+        @param tolerance  Largest difference in emissions (GtC/year) at
+                          which two runs count as equivalent
+        """
+        self.max_entries = max_entries
+        self.interval = interval
+        self.tolerance = tolerance
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.steps_saved = 0
+        self._entries: OrderedDict[
+            tuple[Hashable, bytes], tuple[CambioVar, CambioVar, list[bytes]]
+        ] = OrderedDict()
+        # Most recently used run, by trajectory key and emissions digest at
+        # each checkpoint (a run that is evicted is the least recently used,
+        # so no other run has any of the prefixes it owns)
+        self._owners: dict[tuple[Hashable, bytes], tuple[Hashable, bytes]] = {}
+        self._lock = threading.Lock()
+
+    def digests(self, emissions: CambioVar) -> list[bytes]:
+        """
+        Return the digests of the emissions up to each checkpoint
+
+        @param emissions  Anthropogenic carbon flux at each time step of a run
+        @returns  Digest of the first interval, 2 * interval, ... steps
+        """
+        emissions = np.ascontiguousarray(emissions, dtype=float)
+        data = emissions.tobytes()
+        step = self.interval * emissions.itemsize
+        hasher = hashlib.blake2b(digest_size=16)
+        digests = []
+        for end in range(step, len(data) + 1, step):
+            hasher.update(data[end - step : end])
+            digests.append(hasher.copy().digest())
+        return digests
+
+    def resume(self, key: Hashable, emissions: CambioVar, buffer: CambioVar) -> int:
+        """
+        Copy the longest valid checkpoint for a run into its buffer
+
+        @param key  The inputs, other than emissions, that affect the trajectory
+        @param emissions  Anthropogenic carbon flux at each time step of the run
+        @param buffer  ClimateState buffer for the run, (nvars, ntimes + 1)
+        @returns  Number of time steps copied in, from which to carry on
+        """
+        if not self.enabled:
+            return 0
+
+        with self._lock:
+            if self.tolerance > 0:
+                best_steps, best_id = self._match_within_tolerance(key, emissions)
+            else:
+                best_steps, best_id = self._match_exact(key, emissions)
+
+            if best_id is None:
+                self.misses += 1
+                return 0
+
+            self._use(best_id)
+            buffer[:, : best_steps + 1] = self._entries[best_id][1][:, : best_steps + 1]
+            self.hits += 1
+            self.steps_saved += best_steps
+        return best_steps
+
+    def _match_exact(
+        self, key: Hashable, emissions: CambioVar
+    ) -> tuple[int, tuple[Hashable, bytes] | None]:
+        """
+        Find the run with the longest prefix of the same emissions
+        @returns  The number of steps it shares, and its id (or None)
+        """
+        entry_id = (key, np.ascontiguousarray(emissions, dtype=float).tobytes())
+        if entry_id in self._entries:
+            return len(emissions), entry_id
+        digests = self.digests(emissions)
+        for ncheckpoints in range(len(digests), 0, -1):
+            owner = self._owners.get((key, digests[ncheckpoints - 1]))
+            if owner is not None:
+                return ncheckpoints * self.interval, owner
+        return 0, None
+
+    def _match_within_tolerance(
+        self, key: Hashable, emissions: CambioVar
+    ) -> tuple[int, tuple[Hashable, bytes] | None]:
+        """
+        Find the run with the longest prefix of emissions within tolerance
+        @returns  The number of steps it shares, and its id (or None)
+        """
+        ntimes = len(emissions)
+        best_steps = 0
+        best_id = None
+        for entry_id, (entry_emissions, _, _) in self._entries.items():
+            if entry_id[0] != key:
+                continue
+
+            # Number of leading steps for which the emissions agree
+            nsame = min(len(entry_emissions), ntimes)
+            differs = (
+                np.abs(entry_emissions[:nsame] - emissions[:nsame]) > self.tolerance
+            )
+            if np.any(differs):
+                nsame = int(np.argmax(differs))
+
+            # Round down to a checkpoint, unless the whole run agrees
+            if nsame < ntimes:
+                nsame = (nsame // self.interval) * self.interval
+            if nsame > best_steps:
+                best_steps = nsame
+                best_id = entry_id
+        return best_steps, best_id
+
+    def _use(self, entry_id: tuple[Hashable, bytes]) -> None:
+        """Mark a run as the most recently used owner of its prefixes"""
+        self._entries.move_to_end(entry_id)
+        for digest in self._entries[entry_id][2]:
+            self._owners[(entry_id[0], digest)] = entry_id
+
+    def store(self, key: Hashable, emissions: CambioVar, buffer: CambioVar) -> None:
+        """
+        Keep the prognostic state of a finished run
+
+        @param key  The inputs, other than emissions, that affect the trajectory
+        @param emissions  Anthropogenic carbon flux at each time step of the run
+        @param buffer  ClimateState buffer for the run, (nvars, ntimes + 1)
+        """
+        if not self.enabled:
+            return
+
+        entry_id = (key, np.ascontiguousarray(emissions, dtype=float).tobytes())
+        digests = self.digests(emissions)
+        with self._lock:
+            if entry_id not in self._entries:
+                self._entries[entry_id] = (
+                    np.array(emissions),
+                    np.array(buffer),
+                    digests,
+                )
+            self._use(entry_id)
+            while len(self._entries) > self.max_entries:
+                old_id, (_, _, old_digests) = self._entries.popitem(last=False)
+                for digest in old_digests:
+                    if self._owners.get((old_id[0], digest)) == old_id:
+                        del self._owners[(old_id[0], digest)]
+
+    def clear(self) -> None:
+        """Forget all the checkpoints and counts"""
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self.hits = 0
+            self.misses = 0
+            self.steps_saved = 0
+
+
+def trajectory_key(inputs) -> tuple:
+    """
+    Return the inputs, other than the emissions, that affect the trajectory
+    @param inputs  The CambioInputs
+    @returns  A hashable key
+    """
+    return (
+        float(inputs.start_year),
+        float(inputs.dtime),
+        bool(inputs.albedo_with_no_constraint),
+        bool(inputs.albedo_feedback),
+        float(inputs.albedo_transition_temp),
+        float(inputs.flux_al_transition_temp),
+        bool(inputs.temp_anomaly_feedback),
+    )
+
+
+# Checkpoints shared by every model run in this process
+checkpoint_cache = CheckpointCache()
@@ -58,15 +58,22 @@ class ClimateParams:
     # T anomaly at which photosynthesis will become impaired (a guess)
     # flux_al_transition_temp = 2.5
 
-    def __init__(self, stochastic_c_atm_std_dev: float = 0.1) -> None:
+    def __init__(
+        self,
+        stochastic_c_atm_std_dev: float = 0.1,
+        rng: np.random.Generator | None = None,
+    ) -> None:
         """
         Create an instance of the class
 
         @param  stochastic_c_atm_std_dev  Std dev of atm. carbon
+        @param  rng  Random number generator for the noise, or None to use
+                     NumPy's global one
 
         """
         # Parameter for stochastic processes (0 for no randomness in c_atm)
         self.stochastic_c_atm_std_dev = stochastic_c_atm_std_dev
+        self.rng = rng
 
     def diagnose_ocean_surface_ph(self, c_atm: float) -> float:
         """
@@ -212,7 +219,8 @@ class ClimateParams:
         @param c_atm  Atmospheric carbon
         @returns  Atmospheric carbon amount randomized based on std dev
         """
-        c_atm_new = np.random.normal(c_atm, self.stochastic_c_atm_std_dev)
+        random = np.random if self.rng is None else self.rng
+        c_atm_new = random.normal(c_atm, self.stochastic_c_atm_std_dev)
         return c_atm_new
 
 
@@ -0,0 +1,84 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Storage for the climate state as it is propagated through time.
+The prognostic variables live in one contiguous float64 buffer, with a
+row per variable and a column per time step, and the climate dictionary
+handed back to callers is made of zero-copy views into that buffer. The
+diagnostic variables are computed from the buffer afterwards, by
+diagnose_climate in cambio.
+"""
+
+import numpy as np
+
+from cambio.utils.cambio_utils import CambioVar
+
+
+# The variables that carry over from one time step to the next, and so
+# have to be integrated, in buffer row order
+PROGNOSTIC_VARS: tuple[str, ...] = ("C_atm", "C_ocean", "albedo", "T_anomaly")
+
+# The variables that can be diagnosed from the prognostic variables once
+# the integration is done
+DIAGNOSTIC_VARS: tuple[str, ...] = (
+    "pH",
+    "T_C",
+    "F_ha",
+    "F_ao",
+    "F_oa",
+    "F_la",
+    "F_al",
+    "year",
+)
+
+# All the variables in the climate
+CLIMATE_VARS: tuple[str, ...] = PROGNOSTIC_VARS + DIAGNOSTIC_VARS
+
+# Buffer row for each prognostic variable
+C_ATM, C_OCEAN, ALBEDO, T_ANOMALY = range(len(PROGNOSTIC_VARS))
+
+
+class ClimateState:
+    """
+    Preallocated climate state for a whole model run
+
+    The buffer holds the prognostic variables, with shape (nvars, ntimes + 1),
+    or (nvars, nscen, ntimes + 1) for an ensemble. Column 0 holds the
+    starting state and column i + 1 holds the state after time step i, so
+    propagating step i reads column i and writes column i + 1.
+    """
+
+    def __init__(self, ntimes: int, nscen: int | None = None) -> None:
+        """
+        Create an instance of the class
+
+        @param ntimes  Number of time steps
+        @param nscen  Number of scenarios, or None for a single scenario
+        """
+        self.ntimes = ntimes
+        self.nscen = nscen
+        if nscen is None:
+            shape: tuple[int, ...] = (len(PROGNOSTIC_VARS), ntimes + 1)
+        else:
+            shape = (len(PROGNOSTIC_VARS), nscen, ntimes + 1)
+        self.buffer = np.zeros(shape)
+
+    def set_initial(self, name: str, value: float | CambioVar) -> None:
+        """
+        Set the starting value of a variable
+
+        @param name  The variable name
+        @param value  The starting value (or values, for an ensemble)
+        """
+        self.buffer[PROGNOSTIC_VARS.index(name), ..., 0] = value
+
+    def climate(self, iscen: int | None = None) -> dict[str, CambioVar]:
+        """
+        Return the time series of each prognostic variable, as views into
+        the buffer
+
+        @param iscen  Scenario index, for an ensemble
+        @returns  Dictionary of time series, one per variable
+        """
+        buffer = self.buffer if iscen is None else self.buffer[:, iscen]
+        return {name: buffer[irow, 1:] for irow, name in enumerate(PROGNOSTIC_VARS)}
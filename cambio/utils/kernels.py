@@ -0,0 +1,212 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Compiled integration kernel for the cambio time loop.
+
+The kernel runs the same steps as propagate_climate_state (fluxes,
+albedo constraint and temperature) over the whole time axis in one call.
+If Numba is installed (the "compiled" extra, which the Docker image
+installs) it is JIT-compiled in nopython mode and cambio uses it
+automatically; otherwise USE_COMPILED_KERNEL is False and cambio falls
+back to the pure-Python loop. The noise for stochastic runs is drawn up
+front by ClimateParams, so both paths see the same random numbers and
+give the same results.
+"""
+
+import math
+
+import numpy as np
+
+from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.climate_params import ClimateParams
+from cambio.utils.scalar_diagnostics import sigmafloor
+from cambio.utils.climate_state import C_ATM, C_OCEAN, ALBEDO, T_ANOMALY
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+def _integrate(
+    buffer: CambioVar,
+    f_ha: CambioVar,
+    noise: CambioVar,
+    dtime: float,
+    albedo_with_no_constraint: bool,
+    albedo_feedback: bool,
+    albedo_transition_temp: float,
+    stochastic_c_atm: bool,
+    flux_al_transition_temp: float,
+    temp_anomaly_feedback: bool,
+    params: CambioVar,
+    start: int,
+) -> None:
+    """
+    Propagate the climate over every time step from start on; see
+    propagate_climate_state
+    """
+    (
+        preindust_c_atm,
+        preindust_albedo,
+        climate_sensitivity,
+        k_la,
+        k_al0,
+        k_al1,
+        k_oa,
+        k_ao,
+        ocean_degas_ff,
+        albedo_sensitivity,
+        albedo_transition_interval,
+        max_albedo_change_rate,
+        fractional_albedo_floor,
+        flux_al_transition_temp_interval,
+        fractional_flux_al_floor,
+    ) = params
+
+    for i in range(start, buffer.shape[1] - 1):
+        c_atm = buffer[C_ATM, i]
+        c_ocean = buffer[C_OCEAN, i]
+        prev_albedo = buffer[ALBEDO, i]
+
+        # Temperature anomaly and fluxes from the previous state
+        t_anom = climate_sensitivity * (c_atm - preindust_c_atm)
+        f_oa = k_oa * (1 + ocean_degas_ff * t_anom) * c_ocean
+        t_land = t_anom if temp_anomaly_feedback else 0.0
+        sigma_floor_val = sigmafloor(
+            t_land,
+            flux_al_transition_temp,
+            flux_al_transition_temp_interval,
+            fractional_flux_al_floor,
+        )
+        f_al = k_al0 + k_al1 * sigma_floor_val * c_atm
+        f_ao = k_ao * c_atm
+        f_la = k_la
+
+        # Update concentrations of carbon based on these fluxes
+        c_atm += (f_la + f_oa - f_ao - f_al + f_ha[i]) * dtime
+        c_ocean += (f_ao - f_oa) * dtime
+
+        # Albedo feedback, optionally with a limit on how fast it changes
+        if albedo_feedback:
+            albedo = (
+                sigmafloor(
+                    t_anom,
+                    albedo_transition_temp,
+                    albedo_transition_interval,
+                    fractional_albedo_floor,
+                )
+                * preindust_albedo
+            )
+            if albedo_with_no_constraint and prev_albedo != 0 and dtime != 0:
+                albedo_change = albedo - prev_albedo
+                max_albedo_change = max_albedo_change_rate * dtime
+                if abs(albedo_change) > max_albedo_change:
+                    albedo = prev_albedo + (
+                        math.copysign(max_albedo_change, albedo_change)
+                    )
+            t_anom += (albedo - preindust_albedo) * albedo_sensitivity
+        else:
+            albedo = prev_albedo
+
+        # Stochasticity in the model (if we want it)
+        if stochastic_c_atm:
+            c_atm += noise[i]
+
+        # Write the new climate state into the next column
+        buffer[C_ATM, i + 1] = c_atm
+        buffer[C_OCEAN, i + 1] = c_ocean
+        buffer[ALBEDO, i + 1] = albedo
+        buffer[T_ANOMALY, i + 1] = t_anom
+
+
+# The kernel releases the GIL, so scenarios run in threads (as by the
+# async views) really do run at the same time
+if numba is not None:
+    sigmafloor = numba.njit(cache=True, nogil=True)(sigmafloor)
+    _integrate = numba.njit(cache=True, nogil=True)(_integrate)
+
+# Whether cambio should use the compiled kernel
+USE_COMPILED_KERNEL = numba is not None
+
+
+def kernel_params() -> CambioVar:
+    """
+    Return the ClimateParams constants the kernel needs, in kernel order
+    @returns  Array of constants
+    """
+    return np.array(
+        [
+            ClimateParams.preindust_c_atm,
+            ClimateParams.preindust_albedo,
+            ClimateParams.climate_sensitivity,
+            ClimateParams.k_la,
+            ClimateParams.k_al0,
+            ClimateParams.k_al1,
+            ClimateParams.k_oa,
+            ClimateParams.k_ao,
+            ClimateParams.ocean_degas_flux_feedback,
+            ClimateParams.albedo_sensitivity,
+            ClimateParams.albedo_transition_interval,
+            ClimateParams.max_albedo_change_rate,
+            ClimateParams.fractional_albedo_floor,
+            ClimateParams.flux_al_transition_temp_interval,
+            ClimateParams.fractional_flux_al_floor,
+        ],
+        dtype=np.float64,
+    )
+
+
+def propagate_climate_compiled(
+    buffer: CambioVar,
+    climateParams: ClimateParams,
+    dtime: float,
+    f_ha: CambioVar,
+    albedo_with_no_constraint: bool,
+    albedo_feedback: bool,
+    albedo_transition_temp: float,
+    stochastic_c_atm: bool,
+    flux_al_transition_temp: float,
+    temp_anomaly_feedback: bool,
+    start: int = 0,
+) -> None:
+    """
+    Propagate the state of the climate over all the time steps with the
+    compiled kernel. Gives the same results as calling
+    propagate_climate_state for each time step.
+
+    @param buffer  ClimateState buffer, (nvars, ntimes + 1), with the
+                   starting state in column 0
+    @param climateParams  Climate params class
+    @param dtime  Time step (years)
+    @param f_ha  Anthropogenic carbon flux at each time step
+    @param albedo_with_no_constraint, albedo_feedback  Flags
+    @param albedo_transition_temp  Albedo tipping point
+    @param stochastic_c_atm  Flag
+    @param flux_al_transition_temp  Forest tipping point
+    @param temp_anomaly_feedback  Flag
+    @param start  First time step to propagate (column start must already
+                  hold the state to start from)
+    """
+    ntimes = buffer.shape[1] - 1
+
+    # Draw the noise in the same order as the step-by-step loop would
+    if stochastic_c_atm:
+        noise = climateParams.diagnose_stochastic_c_atm(np.zeros(ntimes))
+    else:
+        noise = np.zeros(ntimes)
+
+    _integrate(
+        buffer,
+        np.ascontiguousarray(f_ha, dtype=np.float64),
+        noise,
+        float(dtime),
+        bool(albedo_with_no_constraint),
+        bool(albedo_feedback),
+        float(albedo_transition_temp),
+        bool(stochastic_c_atm),
+        float(flux_al_transition_temp),
+        bool(temp_anomaly_feedback),
+        kernel_params(),
+        int(start),
+    )
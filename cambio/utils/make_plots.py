@@ -4,14 +4,20 @@ By Penny Rowe and Daniel Neshyba-Rowe
 
 """
 
+import base64
+from collections import OrderedDict
+from collections.abc import Hashable
+import threading
+from time import perf_counter
 from typing import Any
-from plotly.offline import plot
-from plotly.graph_objs import Scatter
+from django.conf import settings
 from django.http import QueryDict
 import numpy.typing as npt
 import numpy as np
 
 from cambio.utils.cambio_utils import CambioVar, celsius_to_f, celsius_to_kelvin
+from cambio.utils.metrics import PANEL_SECONDS
+from cambio.utils.timing import phase
 
 
 class MakePlots:
@@ -134,6 +140,16 @@ class MakePlots:
             if len(selected_unit) > 0 and selected_unit[-1] in units:
                 values["selected_unit"] = selected_unit[-1]
 
+    def selections(self) -> tuple:
+        """
+        Return the variables and unit selected for each panel
+        @returns  Tuple of (panel, selected variables, selected unit)
+        """
+        return tuple(
+            (panel, tuple(values["selected_vars"]), values["selected_unit"])
+            for panel, values in self.plot_stuff.items()
+        ) + (self.year_range,)
+
     def make(self, scenarios: list[dict[str, CambioVar]]) -> dict:
         """
         Return the plots that will be displayed.
@@ -144,80 +160,163 @@ class MakePlots:
         if len(scenarios) == 0:
             return self.plot_stuff
 
-        # Loop over plots (aka panels)
-        # For each variable to plot
-        for values in self.plot_stuff.values():
-            legend_labels: list[str] = []
-            line_colors: list[str] = []
-            line_styles: list[str] = []
-            years: list[CambioVar] = []
-            climvarvals: list[float | CambioVar] = []
-
-            # Loop over variables to plot in each panel
-            # These correspond to the instance variables defined in the constructor
-            for name in values["selected_vars"]:
-                # Get units, conversion functions, labels, and line styles from the
-                # instance variables defined in the constructor
-                unit = values["selected_unit"]
-                conversion_fun = self.conversion_funs[name][unit]
-
-                # TODO
-                print()
-                print(values["vars"][name][0])
-                print()
-
-                label = values["vars"][name][0]
-                line_style = values["vars"][name][1]
-                if len(unit) > 0:
-                    unit = f"({unit})"
-                ylabel = f"{values['label']}  {unit}"
-
-                # Loop over the scenarios input to this method, which represent the climate
-                # model results, and append the variables that will be plotted
-                for iscen, scenario in enumerate(scenarios):
-                    scenario_id = scenario["scenario_id"]
-                    year = scenario["year"]
-
-                    # Get variables derived from other variables
-                    if name not in scenario:
-                        # Set input variables that will be plotted
-                        if name in self.derived_inputs:
-                            myfun = self.derived_inputs[name]
-                            scenario[name] = myfun(scenario)
-                        else:
-                            raise ValueError("Variable cannot be plotted")
-
-                    yvals = conversion_fun(scenario[name])
-                    inds = get_years_to_plot(year, self.year_range)
-
-                    if len(yvals) == len(year):
-                        years.append(year[inds])
-                        climvarvals.append(yvals[inds])
-                    elif len(yvals) == 1:
-                        # Constant values
-                        years.append(np.array([year[inds[0]], year[inds[-1]]]))
-                        climvarvals.append(np.array([yvals[0], yvals[0]]))
-                    else:
-                        raise ValueError("Bad length for variable to plot")
+        # Loop over plots (aka panels), reusing the rendered plot when the
+        # same panel has already been drawn for the same results
+        cache = get_panel_cache()
+        for panel, values in self.plot_stuff.items():
+            start_time = perf_counter()
+            key = self.panel_key(panel, scenarios)
+            div = cache.get(key) if key is not None else None
+            if div is None:
+                with phase("traces"):
+                    traces = self.panel_traces(values, scenarios)
+                with phase("plotly"):
+                    div = self.plot_panel(*traces)
+                if key is not None:
+                    cache.put(key, div)
+            values["plot"] = div
+            PANEL_SECONDS.observe(perf_counter() - start_time, panel=panel)
 
-                    # Unique legend label and line color for each scenario
-                    legend_labels.append(f"{label}: {scenario_id}")
-                    line_colors.append(getcolor(iscen))
+        return self.plot_stuff
 
-                    # Unique line style for each variable plotted (e.g. name)
-                    line_styles.append(line_style)
+    def data(self, scenarios: list[dict[str, CambioVar]]) -> dict:
+        """
+        Return the traces for every panel as JSON-ready data, for plotting
+        in the browser
+        @param scenarios  The climate model run results
+        @returns  Dictionary, by panel, of the Plotly traces and layout, with
+                  the x and y values as base64-encoded float32 arrays
+        """
+        panels = {}
+        if len(scenarios) == 0:
+            return panels
 
-            # Set all the plots for this panel
-            values["plot"] = self.plot_panel(
+        for panel, values in self.plot_stuff.items():
+            (
                 years,
                 climvarvals,
-                legend_labels,
+                names,
                 ylabel,
                 line_colors,
                 line_styles,
-            )
+            ) = self.panel_traces(values, scenarios)
+            traces = [
+                {
+                    "type": "scatter",
+                    "x": encode_float32(xvals),
+                    "y": encode_float32(yvals),
+                    "mode": "lines",
+                    "name": trace_name(name),
+                    "opacity": 0.8,
+                    "marker": {"color": line_color},
+                    "line": {"dash": line_style},
+                    "showlegend": True,
+                }
+                for xvals, yvals, name, line_color, line_style in zip(
+                    years, climvarvals, names, line_colors, line_styles
+                )
+            ]
+            panels[panel] = {"traces": traces, "layout": panel_layout(ylabel)}
+        return panels
+
+    def panel_key(
+        self, panel: str, scenarios: list[dict[str, CambioVar]]
+    ) -> tuple | None:
+        """
+        Return the key for the rendered plot of a panel
+        @param panel  The panel name
+        @param scenarios  The climate model run results
+        @returns  A hashable key, or None if some results have no hash
+                  (such as unseeded stochastic runs) and so can't be reused
+        """
+        result_hashes = [scenario.get("result_hash") for scenario in scenarios]
+        if None in result_hashes:
+            return None
+        values = self.plot_stuff[panel]
+        return (
+            panel,
+            tuple(values["selected_vars"]),
+            values["selected_unit"],
+            self.year_range,
+            tuple(
+                (result_hash, scenario["scenario_id"], getcolor(iscen))
+                for iscen, (result_hash, scenario) in enumerate(
+                    zip(result_hashes, scenarios)
+                )
+            ),
+        )
 
-        return self.plot_stuff
+    def panel_traces(
+        self, values: dict, scenarios: list[dict[str, CambioVar]]
+    ) -> tuple[list, list, list[str], str, list[str], list[str]]:
+        """
+        Return the traces for one panel
+        @param values  The panel's entry in plot_stuff
+        @param scenarios  The climate model run results
+        @returns  The years, values, legend labels, y-axis label, line colors
+                  and line styles, as taken by plot_panel
+        """
+        legend_labels: list[str] = []
+        line_colors: list[str] = []
+        line_styles: list[str] = []
+        years: list[CambioVar] = []
+        climvarvals: list[float | CambioVar] = []
+
+        # Loop over variables to plot in each panel
+        # These correspond to the instance variables defined in the constructor
+        for name in values["selected_vars"]:
+            # Get units, conversion functions, labels, and line styles from the
+            # instance variables defined in the constructor
+            unit = values["selected_unit"]
+            conversion_fun = self.conversion_funs[name][unit]
+
+            # TODO
+            print()
+            print(values["vars"][name][0])
+            print()
+
+            label = values["vars"][name][0]
+            line_style = values["vars"][name][1]
+            if len(unit) > 0:
+                unit = f"({unit})"
+            ylabel = f"{values['label']}  {unit}"
+
+            # Loop over the scenarios input to this method, which represent the climate
+            # model results, and append the variables that will be plotted
+            for iscen, scenario in enumerate(scenarios):
+                scenario_id = scenario["scenario_id"]
+                year = scenario["year"]
+
+                # Get variables derived from other variables
+                if name not in scenario:
+                    # Set input variables that will be plotted
+                    if name in self.derived_inputs:
+                        myfun = self.derived_inputs[name]
+                        scenario[name] = myfun(scenario)
+                    else:
+                        raise ValueError("Variable cannot be plotted")
+
+                yvals = conversion_fun(scenario[name])
+                inds = get_years_to_plot(year, self.year_range)
+
+                if len(yvals) == len(year):
+                    years.append(year[inds])
+                    climvarvals.append(yvals[inds])
+                elif len(yvals) == 1:
+                    # Constant values
+                    years.append(np.array([year[inds[0]], year[inds[-1]]]))
+                    climvarvals.append(np.array([yvals[0], yvals[0]]))
+                else:
+                    raise ValueError("Bad length for variable to plot")
+
+                # Unique legend label and line color for each scenario
+                legend_labels.append(f"{label}: {scenario_id}")
+                line_colors.append(getcolor(iscen))
+
+                # Unique line style for each variable plotted (e.g. name)
+                line_styles.append(line_style)
+
+        return years, climvarvals, legend_labels, ylabel, line_colors, line_styles
 
     def plot_panel(
         self,
@@ -236,15 +335,13 @@ class MakePlots:
         @param ylabel
         @returns a plotly plot object
         """
+        # Plotly takes a good part of a second to import (plotly.offline
+        # brings in IPython), so it is only imported once a plot is needed;
+        # the data view and a cold start before the first plot skip it
+        from plotly.graph_objs import Scatter
+        from plotly.offline import plot
 
-        names = []
-        # Replace arrows with better symbols
-        for name in names_in:
-            if "&rarr;" in name:
-                name = name.replace("&rarr;", "\u2192")
-            if "&harr;" in name:
-                name = name.replace("&harr;", "\u2194")
-            names.append(name)
+        names = [trace_name(name) for name in names_in]
 
         return plot(
             {
@@ -263,24 +360,124 @@ class MakePlots:
                         zip(years, climvarvals, names, line_colors, line_styles)
                     )
                 ],
-                "layout": {
-                    "xaxis": {"title": "year"},
-                    "yaxis": {"title": ylabel},
-                    "legend": {
-                        "orientation": "h",
-                        "entrywidth": 70,
-                        "yanchor": "bottom",
-                        "y": 1.02,
-                        "xanchor": "right",
-                        "x": 1,
-                    },
-                },
+                "layout": panel_layout(ylabel),
             },
             output_type="div",
             include_plotlyjs=False,
         )
 
 
+def trace_name(name: str) -> str:
+    """
+    Return a legend label with the arrows replaced by better symbols
+    @param name  The legend label
+    @returns  The label to display
+    """
+    if "&rarr;" in name:
+        name = name.replace("&rarr;", "\u2192")
+    if "&harr;" in name:
+        name = name.replace("&harr;", "\u2194")
+    return name
+
+
+def panel_layout(ylabel: str) -> dict:
+    """
+    Return the Plotly layout for a panel
+    @param ylabel  The y-axis label
+    @returns  The layout
+    """
+    return {
+        "xaxis": {"title": "year"},
+        "yaxis": {"title": ylabel},
+        "legend": {
+            "orientation": "h",
+            "entrywidth": 70,
+            "yanchor": "bottom",
+            "y": 1.02,
+            "xanchor": "right",
+            "x": 1,
+        },
+    }
+
+
+def encode_float32(values: CambioVar) -> dict[str, str]:
+    """
+    Encode an array compactly for JSON, as base64 of its float32 bytes
+    (decoded in the browser as a Float32Array)
+    @param values  The array
+    @returns  Dictionary with the dtype and the base64 data
+    """
+    data = np.ascontiguousarray(values, dtype="<f4").tobytes()
+    return {"dtype": "float32", "data": base64.b64encode(data).decode("ascii")}
+
+
+class PanelCache:
+    """
+    LRU cache of rendered plot panels (the HTML divs from plotly)
+    """
+
+    def __init__(self, max_entries: int = 256) -> None:
+        """
+        Create an instance of the class
+
+        @param max_entries  Number of rendered panels to keep
+        """
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, str] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable) -> str | None:
+        """
+        Return a rendered panel
+        @param key  The panel key (see MakePlots.panel_key)
+        @returns  The HTML div, or None if not cached
+        """
+        with self._lock:
+            div = self._entries.get(key)
+            if div is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return div
+
+    def put(self, key: Hashable, div: str) -> None:
+        """
+        Cache a rendered panel
+        @param key  The panel key (see MakePlots.panel_key)
+        @param div  The HTML div
+        """
+        with self._lock:
+            self._entries[key] = div
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Forget all the rendered panels and counts"""
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+
+_panel_cache: PanelCache | None = None
+
+
+def get_panel_cache() -> PanelCache:
+    """
+    Return the rendered panel cache for this process, sized by the
+    CAMBIO_PANEL_CACHE_SIZE setting
+    @returns  The PanelCache
+    """
+    global _panel_cache
+    if _panel_cache is None:
+        _panel_cache = PanelCache(getattr(settings, "CAMBIO_PANEL_CACHE_SIZE", 256))
+    return _panel_cache
+
+
 def get_display_names() -> dict[str:str]:
     """
     Retrun the display names for the plot
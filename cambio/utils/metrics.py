@@ -0,0 +1,523 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Counters and histograms of the model and cache activity, for the
+/metrics endpoint, in the Prometheus text format.
+
+Each process keeps its own values in memory and, with the CAMBIO_METRICS
+setting on, writes them to its own file in CAMBIO_METRICS_DIR at most
+every FLUSH_INTERVAL seconds (see middleware.MetricsMiddleware), and
+whenever it serves /metrics. The endpoint adds up the files of all the
+processes, so every gunicorn worker is counted, without any service to
+send the values to. As in the multiprocess mode of prometheus_client,
+the values of a worker that exits are added into an archive file, which
+the endpoint also counts, so the totals never go down when workers are
+recycled: a worker archives its own file as it exits, and the endpoint
+archives the files of workers that died without doing so.
+
+A process forked from one that has already counted (the gunicorn master,
+with --preload and CAMBIO_WARM_START) starts from zero, so the warm-up is
+not counted once by every worker.
+
+The hits, misses and evictions of the caches are read from the caches
+themselves when the values are written.
+"""
+
+import atexit
+from contextlib import contextmanager
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+import uuid
+
+from django.conf import settings
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+# Upper bounds of the histogram buckets for durations, in seconds
+DURATION_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+# Shortest time between writes of the values of a process, in seconds
+FLUSH_INTERVAL = 5.0
+
+_lock = threading.Lock()
+_registry: dict[str, "Metric"] = {}
+
+
+class Metric:
+    """
+    A named set of values, one for each combination of label values
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames=()) -> None:
+        """
+        Create an instance of the class and register it
+
+        @param name  The metric name
+        @param documentation  What it measures
+        @param labelnames  Names of its labels
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values: dict[tuple, object] = {}
+        _registry[name] = self
+
+    def label_key(self, labels: dict[str, str]) -> tuple:
+        """Return the label values, in the order of the label names"""
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def clear(self) -> None:
+        """Forget all the values"""
+        with _lock:
+            self.values.clear()
+
+
+class Counter(Metric):
+    """
+    A total that only goes up
+    """
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """
+        Add to the total
+        @param amount  The amount to add
+        @param labels  The label values
+        """
+        key = self.label_key(labels)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Histogram(Metric):
+    """
+    Counts of observations in buckets, with their sum
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames=(),
+        buckets: tuple[float, ...] = DURATION_BUCKETS,
+    ) -> None:
+        """
+        Create an instance of the class and register it
+
+        @param name  The metric name
+        @param documentation  What it measures
+        @param labelnames  Names of its labels
+        @param buckets  Upper bounds of the buckets
+        """
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels: str) -> None:
+        """
+        Count an observation
+        @param value  The observed value
+        @param labels  The label values
+        """
+        key = self.label_key(labels)
+        with _lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Counts for each bucket and +Inf, then the sum
+                counts = [0] * (len(self.buckets) + 1) + [0.0]
+                self.values[key] = counts
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+
+MODEL_RUN_SECONDS = Histogram(
+    "cambio_model_run_seconds",
+    "Time to run the model, by function",
+    ["function"],
+)
+MODEL_SCENARIOS = Counter(
+    "cambio_model_scenarios_total", "Scenarios run through the model"
+)
+MODEL_STEPS = Counter(
+    "cambio_model_steps_total",
+    "Time steps integrated, by the code that ran (compiled, python or numpy)",
+    ["method"],
+)
+REQUEST_SCENARIOS = Histogram(
+    "cambio_request_scenarios",
+    "Scenarios plotted per page",
+    buckets=(1, 2, 3, 5, 8, 13, 20, 50),
+)
+PANEL_SECONDS = Histogram(
+    "cambio_panel_seconds", "Time to make each plot panel", ["panel"]
+)
+HTML_BYTES = Counter("cambio_html_bytes_total", "Bytes of HTML produced")
+
+CACHE_EVENTS = "cambio_cache_events_total"
+
+
+_CACHE_EVENT_NAMES = ("hits", "misses", "evictions")
+
+
+def _caches() -> dict:
+    """
+    Return the caches of this process, by name (None if turned off)
+    @returns  Dictionary of the caches
+    """
+    # Imported here, since the caches import the model, which imports this
+    from cambio.utils.checkpoints import checkpoint_cache
+    from cambio.utils.make_plots import get_panel_cache
+    from cambio.utils.persistent_store import get_persistent_store
+    from cambio.utils.result_cache import get_result_cache
+    from cambio.utils.shared_store import get_shared_store
+
+    return {
+        "result": get_result_cache(),
+        "shared": get_shared_store(),
+        "database": get_persistent_store(),
+        "panel": get_panel_cache(),
+        "checkpoint": checkpoint_cache,
+    }
+
+
+def cache_samples() -> list[tuple[dict[str, str], int]]:
+    """
+    Return the hits, misses and evictions of the caches in this process
+    @returns  List of (labels, count)
+    """
+    samples = []
+    for cache_name, cache in _caches().items():
+        if cache is None:
+            continue
+        for event in _CACHE_EVENT_NAMES:
+            if hasattr(cache, event):
+                labels = {"cache": cache_name, "event": event}
+                samples.append((labels, getattr(cache, event)))
+    return samples
+
+
+def snapshot() -> dict:
+    """
+    Return the values of this process
+    @returns  Dictionary, by metric name, of the kind, documentation,
+              buckets and samples (label dictionary and value)
+    """
+    metrics = {}
+    with _lock:
+        for name, metric in _registry.items():
+            metrics[name] = {
+                "kind": metric.kind,
+                "documentation": metric.documentation,
+                "buckets": list(getattr(metric, "buckets", [])),
+                "samples": [
+                    [
+                        dict(zip(metric.labelnames, key)),
+                        list(value) if isinstance(value, list) else value,
+                    ]
+                    for key, value in metric.values.items()
+                ],
+            }
+    metrics[CACHE_EVENTS] = {
+        "kind": "counter",
+        "documentation": "Cache hits, misses and evictions, by cache",
+        "buckets": [],
+        "samples": [[labels, count] for labels, count in cache_samples()],
+    }
+    return metrics
+
+
+def get_metrics_dir() -> Path:
+    """
+    Return the directory of the values of each process, from the
+    CAMBIO_METRICS_DIR setting
+    @returns  The directory
+    """
+    directory = getattr(settings, "CAMBIO_METRICS_DIR", None)
+    if directory is None:
+        directory = Path(tempfile.gettempdir()) / "cambio-metrics"
+    return Path(directory)
+
+
+# This process's file, named by its pid (and unique even if a pid is
+# reused), and when it was last written
+_process_file: Path | None = None
+_process_pid: int | None = None
+_flushed = 0.0
+
+
+def flush_due() -> bool:
+    """
+    Determine whether FLUSH_INTERVAL has passed since the values of this
+    process were last written
+    @returns  True if they should be written
+    """
+    return time.monotonic() - _flushed >= FLUSH_INTERVAL
+
+
+# Values of the processes that have exited, and the lock held to change it
+ARCHIVE_FILE = "archive.json"
+ARCHIVE_LOCK = "archive.lock"
+
+
+def _write(path: Path, metrics: dict) -> None:
+    """
+    Write values to a file, replacing it in one step
+    @param path  The file
+    @param metrics  The values, like those from snapshot
+    """
+    data = json.dumps(metrics, separators=(",", ":"))
+    try:
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as file:
+            file.write(data)
+        os.replace(tmp_name, path)
+    except OSError:
+        pass
+
+
+def _read(path: Path) -> dict | None:
+    """
+    Read the values in a file
+    @param path  The file
+    @returns  The values, like those from snapshot, or None if unreadable
+    """
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError):
+        return None
+
+
+def flush(directory: Path | None = None) -> None:
+    """
+    Write the values of this process to its file
+    @param directory  The directory (default: from get_metrics_dir)
+    """
+    global _process_file, _process_pid, _flushed
+    directory = get_metrics_dir() if directory is None else directory
+    if _process_pid != os.getpid() or _process_file.parent != directory:
+        _process_pid = os.getpid()
+        _process_file = directory / f"{_process_pid}-{uuid.uuid4().hex[:8]}.json"
+    _flushed = time.monotonic()
+    directory.mkdir(parents=True, exist_ok=True)
+    _write(_process_file, snapshot())
+
+
+@contextmanager
+def _archive_lock(directory: Path):
+    """
+    Hold the lock on the archive of a directory (where fcntl is available)
+    @param directory  The directory
+    """
+    if fcntl is None:
+        yield
+        return
+    with open(directory / ARCHIVE_LOCK, "a") as file:
+        fcntl.flock(file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+
+
+def _archive(path: Path) -> None:
+    """
+    Add the values in a process's file to the archive, and remove the file
+    (the caller holds the archive lock)
+    @param path  The file
+    """
+    metrics = _read(path)
+    if metrics is not None:
+        totals: dict[str, dict] = {}
+        _add(totals, _read(path.parent / ARCHIVE_FILE) or {})
+        _add(totals, metrics)
+        _write(path.parent / ARCHIVE_FILE, _to_snapshot(totals))
+    try:
+        path.unlink()
+    except OSError:
+        pass
+
+
+def archive_file() -> None:
+    """Write the values of this process and archive them, as it exits"""
+    if _process_file is None or _process_pid != os.getpid():
+        return
+    if not _process_file.parent.is_dir():
+        return
+    flush(_process_file.parent)
+    with _archive_lock(_process_file.parent):
+        _archive(_process_file)
+
+
+def reset() -> None:
+    """
+    Set the values of this process back to zero, including the counts of
+    its caches, and forget its file
+    """
+    global _lock, _process_file, _process_pid, _flushed
+    # Another thread may have held the lock as this process forked
+    _lock = threading.Lock()
+    for metric in _registry.values():
+        metric.values.clear()
+    for cache in _caches().values():
+        for event in _CACHE_EVENT_NAMES:
+            if hasattr(cache, event):
+                setattr(cache, event, 0)
+    _process_file = None
+    _process_pid = None
+    _flushed = 0.0
+
+
+def _after_fork() -> None:
+    """Start a forked process (such as a gunicorn worker) from zero"""
+    if settings.configured:
+        reset()
+
+
+atexit.register(archive_file)
+os.register_at_fork(after_in_child=_after_fork)
+
+
+def _is_running(pid: int) -> bool:
+    """
+    Determine whether a process is running
+    @param pid  The process id
+    @returns  True if it is running
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _add(totals: dict[str, dict], metrics: dict) -> None:
+    """
+    Add values into totals
+    @param totals  Dictionary like that from aggregate
+    @param metrics  Values like those from snapshot
+    """
+    for name, metric in metrics.items():
+        total = totals.setdefault(name, dict(metric, samples={}))
+        for labels, value in metric["samples"]:
+            key = tuple(sorted(labels.items()))
+            if metric["kind"] == "histogram":
+                previous = total["samples"].get(key, [0] * len(value))
+                value = [a + b for a, b in zip(previous, value)]
+            else:
+                value = total["samples"].get(key, 0) + value
+            total["samples"][key] = value
+
+
+def _to_snapshot(totals: dict[str, dict]) -> dict:
+    """
+    Return totals in the form of a snapshot, to write to a file
+    @param totals  Dictionary like that from aggregate
+    @returns  Dictionary like that from snapshot
+    """
+    return {
+        name: dict(
+            total,
+            samples=[[dict(key), value] for key, value in total["samples"].items()],
+        )
+        for name, total in totals.items()
+    }
+
+
+def aggregate(directory: Path | None = None) -> dict:
+    """
+    Add up the values written by the running processes and the archive of
+    those that have exited, first archiving the files of processes that
+    died without doing so
+    @param directory  The directory (default: from get_metrics_dir)
+    @returns  Dictionary like that from snapshot, with the samples summed
+    """
+    directory = get_metrics_dir() if directory is None else directory
+    directory.mkdir(parents=True, exist_ok=True)
+    totals: dict[str, dict] = {}
+    with _archive_lock(directory):
+        for path in sorted(directory.glob("*.json")):
+            pid = path.stem.split("-", 1)[0]
+            if pid.isdigit() and not _is_running(int(pid)):
+                _archive(path)
+        for path in sorted(directory.glob("*.json")):
+            metrics = _read(path)
+            if metrics is not None:
+                _add(totals, metrics)
+    return totals
+
+
+def _format_labels(labels) -> str:
+    """Format label pairs as {name="value",...}"""
+    if not labels:
+        return ""
+    pairs = []
+    for name, value in labels:
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        value = value.replace("\n", "\\n")
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_bound(bound: float) -> str:
+    """Format a bucket bound as Prometheus does"""
+    return repr(float(bound))
+
+
+def render(totals: dict) -> str:
+    """
+    Format values in the Prometheus text format
+    @param totals  The values, from aggregate
+    @returns  The text
+    """
+    lines = []
+    for name in sorted(totals):
+        metric = totals[name]
+        lines.append(f"# HELP {name} {metric['documentation']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric["samples"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_format_labels(key)} {value}")
+                continue
+            cumulative = 0
+            bounds = [_format_bound(b) for b in metric["buckets"]] + ["+Inf"]
+            for bound, count in zip(bounds, value[:-1]):
+                cumulative += count
+                labels = _format_labels(key + (("le", bound),))
+                lines.append(f"{name}_bucket{labels} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(key)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(key)} {cumulative}")
+    return "\n".join(lines) + "\n"
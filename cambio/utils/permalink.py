@@ -0,0 +1,175 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Compact permalinks for sets of scenarios.
+
+A set of scenarios is packed into a short binary token, in URL-safe
+base64, so a link can carry every scenario it shows. The token starts
+with a version byte; each scenario is then its name, a bit mask of the
+float inputs that differ from the defaults, a byte of flags, the values
+that differ, and the random seed if there is one. The default scenario
+therefore takes only a few bytes. The same scenarios always give the
+same token, so links can be used as cache keys.
+
+Decoding unpacks the values with struct and, since a token can be made
+by hand, checks them as CambioInputs would (finite values, a valid time
+axis and seed) before building the inputs without pydantic. A token with
+invalid inputs is rejected like any other bad token, as is one with more
+than MAX_SCENARIOS scenarios, since every scenario in a link is plotted.
+"""
+
+import base64
+import binascii
+from functools import lru_cache
+import math
+import struct
+
+from cambio.utils.schemas import CambioInputs, validate_time_axis
+
+
+# Query parameter that carries the token
+PERMALINK_PARAM = "s"
+
+VERSION = 1
+
+# Most scenarios in a token
+MAX_SCENARIOS = 20
+
+# Float inputs, in the order of the bits of the mask (never reorder these;
+# add new ones at the end)
+FLOAT_FIELDS = (
+    "transition_year",
+    "transition_duration",
+    "long_term_emissions",
+    "albedo_transition_temp",
+    "stochastic_c_atm_std_dev",
+    "flux_al_transition_temp",
+    "start_year",
+    "stop_year",
+    "dtime",
+    "inv_time_constant",
+)
+
+# Bool inputs, in the order of the bits of the flags
+BOOL_FIELDS = (
+    "albedo_with_no_constraint",
+    "albedo_feedback",
+    "temp_anomaly_feedback",
+)
+HAS_SEED = 1 << len(BOOL_FIELDS)
+
+_VERSION = struct.Struct("<B")
+_NAME_LENGTH = struct.Struct("<B")
+_HEADER = struct.Struct("<HB")
+_SEED = struct.Struct("<q")
+
+_DEFAULTS = CambioInputs().dict()
+
+
+@lru_cache(maxsize=None)
+def _values_struct(count: int) -> struct.Struct:
+    """Return the struct for count float64 values"""
+    return struct.Struct(f"<{count}d")
+
+
+@lru_cache(maxsize=None)
+def _mask_fields(mask: int) -> tuple[str, ...]:
+    """Return the names of the float inputs set in a mask"""
+    return tuple(name for i, name in enumerate(FLOAT_FIELDS) if mask & (1 << i))
+
+
+def encode_scenarios(scenario_inputs: dict[str, CambioInputs]) -> str:
+    """
+    Pack scenarios into a permalink token
+    @param scenario_inputs  The inputs, by scenario id (names longer than
+                            255 bytes are cut short, at a whole character)
+    @returns  The token
+    @raises ValueError  If there are more than MAX_SCENARIOS scenarios
+    """
+    if len(scenario_inputs) > MAX_SCENARIOS:
+        raise ValueError(f"A permalink holds at most {MAX_SCENARIOS} scenarios")
+    parts = [_VERSION.pack(VERSION)]
+    for scenario_id, inputs in scenario_inputs.items():
+        name = scenario_id.encode()[:255].decode(errors="ignore").encode()
+        parts.append(_NAME_LENGTH.pack(len(name)))
+        parts.append(name)
+
+        mask = 0
+        values = []
+        for i, field in enumerate(FLOAT_FIELDS):
+            value = getattr(inputs, field)
+            if value != _DEFAULTS[field]:
+                mask |= 1 << i
+                values.append(value)
+
+        flags = 0
+        for i, field in enumerate(BOOL_FIELDS):
+            if getattr(inputs, field):
+                flags |= 1 << i
+        if inputs.random_seed is not None:
+            flags |= HAS_SEED
+
+        parts.append(_HEADER.pack(mask, flags))
+        parts.append(_values_struct(len(values)).pack(*values))
+        if inputs.random_seed is not None:
+            parts.append(_SEED.pack(inputs.random_seed))
+
+    return base64.urlsafe_b64encode(b"".join(parts)).rstrip(b"=").decode("ascii")
+
+
+def decode_scenarios(token: str) -> dict[str, CambioInputs]:
+    """
+    Unpack the scenarios in a permalink token
+    @param token  The token, from encode_scenarios
+    @returns  The inputs, by scenario id
+    @raises ValueError  If the token is not valid
+    """
+    try:
+        data = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4))
+    except (binascii.Error, ValueError) as err:
+        raise ValueError("Not a permalink token") from err
+
+    try:
+        (version,) = _VERSION.unpack_from(data, 0)
+        if version != VERSION:
+            raise ValueError(f"Unknown permalink version {version}")
+
+        scenarios = {}
+        offset = _VERSION.size
+        while offset < len(data):
+            if len(scenarios) == MAX_SCENARIOS:
+                raise ValueError(f"More than {MAX_SCENARIOS} scenarios")
+            (length,) = _NAME_LENGTH.unpack_from(data, offset)
+            offset += _NAME_LENGTH.size
+            scenario_id = data[offset : offset + length].decode()
+            offset += length
+
+            mask, flags = _HEADER.unpack_from(data, offset)
+            offset += _HEADER.size
+            fields = _mask_fields(mask)
+            values_struct = _values_struct(len(fields))
+            changed = values_struct.unpack_from(data, offset)
+            offset += values_struct.size
+            if not all(map(math.isfinite, changed)):
+                raise ValueError("Inputs must be finite")
+            values = dict(_DEFAULTS)
+            values.update(zip(fields, changed))
+            validate_time_axis(
+                values["start_year"], values["stop_year"], values["dtime"]
+            )
+
+            for i, field in enumerate(BOOL_FIELDS):
+                values[field] = bool(flags & (1 << i))
+            if flags & HAS_SEED:
+                (values["random_seed"],) = _SEED.unpack_from(data, offset)
+                offset += _SEED.size
+                if values["random_seed"] < 0:
+                    raise ValueError("The random seed must not be negative")
+
+            scenarios[scenario_id] = CambioInputs.construct(**values)
+    except struct.error as err:
+        raise ValueError("Truncated permalink token") from err
+    except ValueError as err:
+        # Names that are not UTF-8, and inputs that are not valid
+        raise ValueError("Invalid permalink token") from err
+    return scenarios
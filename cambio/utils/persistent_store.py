@@ -0,0 +1,229 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Result store in the database, so model results outlast the process.
+
+Results are saved as StoredResult rows keyed by the input hash, with the
+arrays packed as in shared_store, optionally cut to float32 and
+compressed. A fresh process (after a restart, or a machine that was
+stopped for being idle) can then load the most popular results instead
+of recomputing them. The total size is capped by removing the least
+recently used rows. With SQLite and the CAMBIO_SQLITE_WAL setting, the
+connection is put in WAL mode (see apps), so readers are not blocked
+while a result is written.
+
+Reading a result does not write to the database: the uses of each result
+are counted in memory and written in one transaction at most every
+HITS_FLUSH_INTERVAL seconds, or before a result is stored.
+"""
+
+import threading
+import time
+import zlib
+
+from django.conf import settings
+from django.db import DatabaseError, transaction
+from django.db.models import F, Sum
+from django.utils import timezone
+import numpy as np
+
+from cambio.models import StoredResult
+from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.shared_store import pack_climate, unpack_climate
+
+
+# Size cap of the stored results, if the settings give none
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# Longest time between writes of the counted uses, in seconds
+HITS_FLUSH_INTERVAL = 60.0
+
+
+def encode_climate(
+    climate: dict[str, CambioVar], float32: bool = False, compress: bool = True
+) -> tuple[bytes, bool]:
+    """
+    Encode the arrays of a climate as a compact blob
+    @param climate  Model results, as returned by cambio
+    @param float32  If True, store the floating point arrays as float32
+    @param compress  If True, compress the blob
+    @returns  The blob, and whether it is compressed
+    """
+    if float32:
+        climate = {
+            key: value.astype(np.float32) if value.dtype == np.float64 else value
+            for key, value in climate.items()
+            if isinstance(value, np.ndarray)
+        }
+    data = pack_climate(climate)
+    if compress:
+        data = zlib.compress(data, 1)
+    return data, compress
+
+
+def decode_climate(data: bytes, compressed: bool) -> dict[str, CambioVar]:
+    """
+    Decode a blob made by encode_climate
+    @param data  The blob
+    @param compressed  Whether the blob is compressed
+    @returns  Dictionary of read-only float64 arrays
+    """
+    if compressed:
+        data = zlib.decompress(data)
+    climate = unpack_climate(bytes(data))
+    for key, value in climate.items():
+        if value.dtype == np.float32:
+            value = value.astype(np.float64)
+            value.flags.writeable = False
+            climate[key] = value
+    return climate
+
+
+class PersistentResultStore:
+    """
+    Model results kept in the database, keyed by input hash
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = DEFAULT_MAX_BYTES,
+        float32: bool = False,
+        compress: bool = True,
+    ) -> None:
+        """
+        Create an instance of the class
+
+        @param max_bytes  Largest total size of the stored blobs
+        @param float32  If True, store the results as float32
+        @param compress  If True, compress the stored results
+        """
+        self.max_bytes = max_bytes
+        self.float32 = float32
+        self.compress = compress
+        self.hits = 0
+        self.misses = 0
+
+        # Uses of each result not yet written to the database
+        self._pending: dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._flushed = time.monotonic()
+
+    def get(self, key: str) -> dict[str, CambioVar] | None:
+        """
+        Return the stored results for an input hash
+        @param key  The input hash
+        @returns  Dictionary of read-only arrays, or None if not stored
+        """
+        try:
+            row = StoredResult.objects.filter(key=key).first()
+        except DatabaseError:
+            row = None
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + 1
+            due = time.monotonic() - self._flushed >= HITS_FLUSH_INTERVAL
+        if due:
+            self.flush_hits()
+        return decode_climate(row.data, row.compressed)
+
+    def flush_hits(self) -> None:
+        """Write the uses counted since the last time to the database"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = time.monotonic()
+        if not pending:
+            return
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                for key, count in pending.items():
+                    StoredResult.objects.filter(key=key).update(
+                        hits=F("hits") + count, last_used=now
+                    )
+        except DatabaseError:
+            pass
+
+    def put(self, key: str, climate: dict[str, CambioVar]) -> None:
+        """
+        Store the results for an input hash
+        @param key  The input hash
+        @param climate  Model results, as returned by cambio
+        """
+        data, compressed = encode_climate(climate, self.float32, self.compress)
+        if len(data) > self.max_bytes:
+            return
+        self.flush_hits()
+        try:
+            StoredResult.objects.update_or_create(
+                key=key,
+                defaults={
+                    "data": data,
+                    "compressed": compressed,
+                    "nbytes": len(data),
+                    "last_used": timezone.now(),
+                },
+            )
+            self.prune()
+        except DatabaseError:
+            pass
+
+    def prune(self) -> None:
+        """Remove the least recently used results until within the size cap"""
+        total = StoredResult.objects.aggregate(total=Sum("nbytes"))["total"] or 0
+        if total <= self.max_bytes:
+            return
+        stale = []
+        for key, nbytes in StoredResult.objects.order_by("last_used").values_list(
+            "key", "nbytes"
+        ):
+            if total <= self.max_bytes:
+                break
+            stale.append(key)
+            total -= nbytes
+        StoredResult.objects.filter(key__in=stale).delete()
+
+    def popular(self, count: int) -> list[tuple[str, dict[str, CambioVar]]]:
+        """
+        Return the most used stored results
+        @param count  Number of results to return
+        @returns  List of (input hash, results), most used first
+        """
+        self.flush_hits()
+        try:
+            rows = list(StoredResult.objects.order_by("-hits", "-last_used")[:count])
+        except DatabaseError:
+            return []
+        return [(row.key, decode_climate(row.data, row.compressed)) for row in rows]
+
+    def clear(self) -> None:
+        """Remove all the results"""
+        with self._lock:
+            self._pending.clear()
+        StoredResult.objects.all().delete()
+
+
+_persistent_store: PersistentResultStore | None = None
+
+
+def get_persistent_store() -> PersistentResultStore | None:
+    """
+    Return the database result store, capped at CAMBIO_RESULT_STORE_BYTES
+    and encoded according to CAMBIO_RESULT_STORE_FLOAT32 and
+    CAMBIO_RESULT_STORE_COMPRESS
+    @returns  The PersistentResultStore, or None if it is turned off (a
+              size cap of 0)
+    """
+    global _persistent_store
+    max_bytes = getattr(settings, "CAMBIO_RESULT_STORE_BYTES", DEFAULT_MAX_BYTES)
+    if not max_bytes:
+        return None
+    if _persistent_store is None:
+        _persistent_store = PersistentResultStore(
+            max_bytes,
+            getattr(settings, "CAMBIO_RESULT_STORE_FLOAT32", False),
+            getattr(settings, "CAMBIO_RESULT_STORE_COMPRESS", True),
+        )
+    return _persistent_store
@@ -0,0 +1,159 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Optional pool of processes for running many scenarios at once.
+
+With the CAMBIO_PROCESS_POOL setting on, requests with at least
+CAMBIO_PROCESS_POOL_MIN_SCENARIOS scenarios to run are split into one
+chunk per core and each chunk is run as an ensemble in its own process.
+Smaller requests stay in the request's own process, where they are
+cheaper than the hand-off. The pool is started the first time it is
+needed in each process (so each gunicorn worker gets its own, after it
+is forked), with one process per core available to it.
+
+The results come back through a shared memory segment rather than being
+pickled: the pool process packs the result arrays into the segment (see
+shared_store) and the requesting process copies them out and frees it.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+import os
+
+from django.conf import settings
+import numpy as np
+
+from cambio.utils.cambio import cambio_ensemble
+from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.shared_store import pack_climate, unpack_climate
+
+
+_pool: ProcessPoolExecutor | None = None
+_pool_pid: int | None = None
+
+
+def available_cores() -> int:
+    """
+    Return the number of cores this process may run on
+    @returns  Number of cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    """
+    Return the process pool for this process, starting it if need be
+    @returns  The ProcessPoolExecutor
+    """
+    global _pool, _pool_pid
+    if _pool is None or _pool_pid != os.getpid():
+        # Start fresh processes, rather than forking this one, which may
+        # have threads and open database connections
+        _pool = ProcessPoolExecutor(
+            available_cores(), mp_context=multiprocessing.get_context("spawn")
+        )
+        _pool_pid = os.getpid()
+    return _pool
+
+
+def use_process_pool(nscen: int) -> bool:
+    """
+    Determine whether to run scenarios in the process pool
+    @param nscen  Number of scenarios to run
+    @returns  True if the pool is turned on and there are enough scenarios
+    """
+    if not getattr(settings, "CAMBIO_PROCESS_POOL", False):
+        return False
+    return nscen >= getattr(settings, "CAMBIO_PROCESS_POOL_MIN_SCENARIOS", 8)
+
+
+def _run_chunk(
+    inputs_dicts: list[dict],
+) -> tuple[str, list[tuple[int, int]], list[dict[str, float]]]:
+    """
+    Run a chunk of scenarios in a pool process, packing the results into a
+    new shared memory segment
+    @param inputs_dicts  The inputs for each scenario, as dictionaries
+    @returns  Name of the segment, the (offset, length) of each packed
+              climate in it, and the climate params for each scenario
+    """
+    results = cambio_ensemble([CambioInputs(**inputs) for inputs in inputs_dicts])
+    packed = [pack_climate(climate) for climate, _ in results]
+
+    segment = shared_memory.SharedMemory(create=True, size=sum(map(len, packed)))
+    spans = []
+    offset = 0
+    try:
+        for data in packed:
+            segment.buf[offset : offset + len(data)] = data
+            spans.append((offset, len(data)))
+            offset += len(data)
+    except BaseException:
+        segment.close()
+        segment.unlink()
+        raise
+    # The requesting process frees the segment, so this one must not
+    resource_tracker.unregister(segment._name, "shared_memory")
+    segment.close()
+    return segment.name, spans, [climate_params for _, climate_params in results]
+
+
+def run_in_process_pool(
+    inputs_list: list[CambioInputs],
+) -> list[tuple[dict[str, CambioVar], dict[str, float]]]:
+    """
+    Run the model for many scenarios in the process pool
+    @param inputs_list  Required inputs for each scenario
+    @returns  The model results for each scenario, as from cambio_ensemble
+    """
+    pool = get_process_pool()
+    chunks = np.array_split(np.arange(len(inputs_list)), available_cores())
+    futures = [
+        pool.submit(_run_chunk, [inputs_list[i].dict() for i in chunk])
+        for chunk in chunks
+        if len(chunk) > 0
+    ]
+
+    # Wait for every chunk, so that the segments of all those that finished
+    # are freed even if another failed, then raise the first error
+    wait(futures)
+    results = []
+    error = None
+    for future in futures:
+        try:
+            name, spans, climate_params = future.result()
+        except Exception as err:
+            error = error or err
+            continue
+        segment = shared_memory.SharedMemory(name=name)
+        try:
+            if error is None:
+                for (offset, length), params in zip(spans, climate_params):
+                    data = bytes(segment.buf[offset : offset + length])
+                    results.append((unpack_climate(data), params))
+        except Exception as err:
+            error = err
+        finally:
+            segment.close()
+            segment.unlink()
+    if error is not None:
+        raise error
+    return results
+
+
+def run_scenarios(
+    inputs_list: list[CambioInputs],
+) -> list[tuple[dict[str, CambioVar], dict[str, float]]]:
+    """
+    Run the model for the scenarios, in the process pool if it is turned on
+    and there are enough of them, or else in this process
+    @param inputs_list  Required inputs for each scenario
+    @returns  The model results for each scenario, as from cambio_ensemble
+    """
+    if use_process_pool(len(inputs_list)):
+        return run_in_process_pool(inputs_list)
+    return cambio_ensemble(inputs_list)
@@ -0,0 +1,197 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Profile single requests, with cProfile and tracemalloc.
+
+A RequestProfile runs around one request (see
+middleware.ProfilingMiddleware) and writes what it found to a dump
+directory: the cProfile stats (.prof, for pstats or snakeviz), the
+tracemalloc snapshot (.snapshot, for tracemalloc.Snapshot.load), and a
+summary (.json) with the request, the hashes of the scenarios it showed
+and the lines that allocated the most memory. Only the newest dumps are
+kept. Only one request is profiled at a time, since both profilers are
+global to the process.
+
+cProfile only follows the thread that handles the request. With
+CAMBIO_ASYNC_VIEWS, the model runs and plots are done in the threads of
+async_utils.get_executor, so the CPU profile shows the view waiting for
+them rather than the work itself; profile with the async views off to see
+it. tracemalloc follows every thread, so the memory profile has it all.
+"""
+
+import cProfile
+import datetime
+import json
+import os
+from pathlib import Path
+import tempfile
+import threading
+import time
+import tracemalloc
+
+from django.conf import settings
+from django.core import signing
+from django.http import HttpRequest, QueryDict
+
+
+# Query parameter that turns on profiling, with a signature from
+# profile_signature as its value
+PROFILE_PARAM = "profile"
+
+_SALT = "cambio.profile"
+_lock = threading.Lock()
+
+
+def _signed_value(path: str, query: QueryDict) -> str:
+    """
+    Return the part of a request that a profile signature is for: its path
+    and its query string, without the profile parameter
+    @param path  The path of the page
+    @param query  The query parameters
+    @returns  The value to sign
+    """
+    query = query.copy()
+    query.pop(PROFILE_PARAM, None)
+    return f"{path}?{query.urlencode()}"
+
+
+def profile_signature(path: str, query: str = "") -> str:
+    """
+    Return the value of the profile parameter that turns on profiling for
+    a page (for example, profile_signature("/cambio/", "carbon=ppm")), for
+    CAMBIO_PROFILE_MAX_AGE seconds
+    @param path  The path of the page
+    @param query  The query string of the page
+    @returns  The signature, with the time it was made
+    """
+    value = _signed_value(path, QueryDict(query))
+    return signing.TimestampSigner(salt=_SALT).sign(value)[len(value) + 1 :]
+
+
+def has_valid_signature(request: HttpRequest) -> bool:
+    """
+    Determine whether the profile parameter of a request is signed for its
+    path and query string, and is not too old
+    @param request  The HttpRequest
+    @returns  True if the signature is valid
+    """
+    value = _signed_value(request.path, request.GET)
+    max_age = getattr(settings, "CAMBIO_PROFILE_MAX_AGE", 3600)
+    try:
+        signing.TimestampSigner(salt=_SALT).unsign(
+            f"{value}:{request.GET[PROFILE_PARAM]}", max_age=max_age
+        )
+    except signing.BadSignature:
+        return False
+    return True
+
+
+def get_profile_dir() -> Path:
+    """
+    Return the dump directory, from the CAMBIO_PROFILE_DIR setting
+    @returns  The directory
+    """
+    directory = getattr(settings, "CAMBIO_PROFILE_DIR", None)
+    if directory is None:
+        directory = Path(tempfile.gettempdir()) / "cambio-profiles"
+    return Path(directory)
+
+
+class RequestProfile:
+    """
+    cProfile and tracemalloc profiles of one request
+    """
+
+    def __init__(self, cpu: bool = True, memory: bool = False) -> None:
+        """
+        Create an instance of the class
+
+        @param cpu  If True, profile with cProfile
+        @param memory  If True, trace allocations with tracemalloc
+        """
+        self.profiler = cProfile.Profile() if cpu else None
+        self.memory = memory
+        self.started_tracing = False
+        self.snapshot: tracemalloc.Snapshot | None = None
+        self.start_time = 0.0
+        self.duration = 0.0
+
+    @classmethod
+    def acquire(cls, cpu: bool = True, memory: bool = False):
+        """
+        Return a new profile, unless another request is being profiled
+        @param cpu  If True, profile with cProfile
+        @param memory  If True, trace allocations with tracemalloc
+        @returns  The RequestProfile, or None
+        """
+        if not _lock.acquire(blocking=False):
+            return None
+        return cls(cpu, memory)
+
+    def __enter__(self) -> "RequestProfile":
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start(25)
+            self.started_tracing = True
+        self.start_time = time.perf_counter()
+        if self.profiler is not None:
+            self.profiler.enable()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if self.profiler is not None:
+                self.profiler.disable()
+            self.duration = time.perf_counter() - self.start_time
+            if self.memory:
+                self.snapshot = tracemalloc.take_snapshot()
+                if self.started_tracing:
+                    tracemalloc.stop()
+        finally:
+            _lock.release()
+
+    def dump(self, info: dict, keep: int = 50) -> Path:
+        """
+        Write the profiles to the dump directory, removing the oldest dumps
+        beyond the newest keep
+        @param info  Details of the request to save in the summary
+        @param keep  Number of dumps to keep
+        @returns  The path of the summary file
+        """
+        directory = get_profile_dir()
+        directory.mkdir(parents=True, exist_ok=True)
+        stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S-%f")
+        stem = directory / f"{stamp}-{os.getpid()}"
+
+        summary = dict(info, duration_ms=round(self.duration * 1000, 2))
+        if self.profiler is not None:
+            self.profiler.dump_stats(f"{stem}.prof")
+        if self.snapshot is not None:
+            self.snapshot.dump(f"{stem}.snapshot")
+            summary["top_allocations"] = [
+                {
+                    "line": str(stat.traceback[0]),
+                    "bytes": stat.size,
+                    "count": stat.count,
+                }
+                for stat in self.snapshot.statistics("lineno")[:25]
+            ]
+        path = Path(f"{stem}.json")
+        path.write_text(json.dumps(summary, indent=2), encoding="utf-8")
+
+        rotate(directory, keep)
+        return path
+
+
+def rotate(directory: Path, keep: int) -> None:
+    """
+    Remove all but the newest dumps
+    @param directory  The dump directory
+    @param keep  Number of dumps to keep
+    """
+    summaries = sorted(directory.glob("*.json"))
+    for summary in summaries[: max(len(summaries) - keep, 0)]:
+        for suffix in (".json", ".prof", ".snapshot"):
+            try:
+                summary.with_suffix(suffix).unlink()
+            except OSError:
+                pass
@@ -0,0 +1,304 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Content-addressed cache of model results.
+
+A model run depends only on its CambioInputs, so results are keyed by a
+hash of the normalized input values rather than by scenario name, and
+identically configured scenarios share one entry (every visitor's Default
+scenario, for example). Stochastic runs are only cached when they are
+seeded, since otherwise each run is meant to be different. The hash
+also covers the version of the model (see cache_version), since the
+shared and database stores outlast a deploy.
+
+The cache holds compact, read-only copies of the result arrays within a
+byte budget, evicting the least recently used results first. Each hit
+hands back a new dictionary, so callers can add keys to it freely.
+Behind it sit the shared store (see shared_store), so one worker process
+can reuse the results of another, and the database (see persistent_store),
+so results outlast the process; lookup_result and save_result go through
+all three.
+"""
+
+from collections import OrderedDict
+from functools import lru_cache
+import hashlib
+import importlib.util
+import json
+import threading
+
+from django.conf import settings
+import numpy as np
+
+from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.persistent_store import get_persistent_store
+from cambio.utils.shared_store import get_shared_store
+
+
+# Memory budget of the cache in each process, if the settings give none
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+
+
+# Modules whose code or constants decide the model results
+MODEL_MODULES = (
+    "cambio.utils.cambio",
+    "cambio.utils.cambio_utils",
+    "cambio.utils.climate_params",
+    "cambio.utils.climate_state",
+    "cambio.utils.kernels",
+    "cambio.utils.preindustrial_inputs",
+    "cambio.utils.scalar_diagnostics",
+    "cambio.utils.schemas",
+)
+
+
+@lru_cache(maxsize=None)
+def model_fingerprint() -> str:
+    """
+    Return a hash of the source of the model modules, which changes
+    whenever the model or its parameters (such as ClimateParams) do
+    @returns  Hex digest
+    """
+    digest = hashlib.sha256()
+    for name in MODEL_MODULES:
+        with open(importlib.util.find_spec(name).origin, "rb") as file:
+            digest.update(file.read())
+    return digest.hexdigest()[:16]
+
+
+def cache_version() -> str:
+    """
+    Return the version of the cached results: the model fingerprint and
+    the CAMBIO_CACHE_VERSION setting (to throw away results by hand)
+    @returns  The version
+    """
+    return f"{model_fingerprint()}:{getattr(settings, 'CAMBIO_CACHE_VERSION', '')}"
+
+
+def inputs_hash(inputs: CambioInputs) -> str:
+    """
+    Return the canonical hash of the inputs to a model run, for this
+    version of the model
+    @param inputs  The CambioInputs
+    @returns  Hex digest that is the same for all equivalent inputs
+    """
+    # Float fields are hashed as floats, so 2 and 2.0 are the same, but the
+    # seed stays an integer, so large seeds do not collide
+    normalized = {
+        key: float(value) if inputs.__fields__[key].type_ is float else value
+        for key, value in inputs.dict().items()
+    }
+    text = json.dumps(normalized, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(f"{cache_version()}|{text}".encode()).hexdigest()
+
+
+def is_cacheable(inputs: CambioInputs) -> bool:
+    """
+    Determine whether the results for these inputs can be reused
+    @param inputs  The CambioInputs
+    @returns  True if the run is deterministic or seeded, else False
+    """
+    return inputs.stochastic_c_atm_std_dev <= 0 or inputs.random_seed is not None
+
+
+def freeze_climate(climate: dict[str, CambioVar]) -> dict[str, CambioVar]:
+    """
+    Return a compact, read-only copy of the arrays in a climate
+    @param climate  Model results, as returned by cambio
+    @returns  Dictionary of read-only arrays (other values are dropped)
+    """
+    frozen = {}
+    for key, value in climate.items():
+        if not isinstance(value, np.ndarray):
+            continue
+
+        # Arrays that are already read-only (such as ones mapped from the
+        # shared store) can be kept as they are
+        if value.flags.writeable:
+            value = np.array(value)
+            value.flags.writeable = False
+        frozen[key] = value
+    return frozen
+
+
+def climate_nbytes(climate: dict[str, CambioVar]) -> int:
+    """
+    Return the number of bytes in the arrays of a climate
+    @param climate  Model results
+    @returns  Number of bytes
+    """
+    return sum(value.nbytes for value in climate.values())
+
+
+class ResultCache:
+    """
+    LRU cache of model results, keyed by input hash, within a byte budget
+    """
+
+    def __init__(self, max_bytes: int = DEFAULT_MAX_BYTES) -> None:
+        """
+        Create an instance of the class
+
+        @param max_bytes  Largest total size of the cached arrays
+        """
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[str, dict[str, CambioVar]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> dict[str, CambioVar] | None:
+        """
+        Return the cached results for an input hash
+        @param key  The input hash
+        @returns  A new dictionary of read-only arrays, or None if not cached
+        """
+        with self._lock:
+            climate = self._entries.get(key)
+            if climate is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return dict(climate)
+
+    def put(self, key: str, climate: dict[str, CambioVar]) -> dict[str, CambioVar]:
+        """
+        Cache the results for an input hash
+        @param key  The input hash
+        @param climate  Model results, as returned by cambio
+        @returns  A new dictionary of the read-only arrays that were cached
+        """
+        frozen = freeze_climate(climate)
+        nbytes = climate_nbytes(frozen)
+        if nbytes > self.max_bytes:
+            return dict(frozen)
+
+        with self._lock:
+            if key in self._entries:
+                self.nbytes -= climate_nbytes(self._entries.pop(key))
+            self._entries[key] = frozen
+            self.nbytes += nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= climate_nbytes(evicted)
+                self.evictions += 1
+        return dict(frozen)
+
+    def clear(self) -> None:
+        """Forget all the results and counts"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self) -> dict[str, int]:
+        """
+        Return the cache counters
+        @returns  Dictionary of counts and sizes
+        """
+        return {
+            "entries": len(self._entries),
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+_result_cache: ResultCache | None = None
+
+
+def get_result_cache() -> ResultCache:
+    """
+    Return the result cache for this process, sized by the
+    CAMBIO_RESULT_CACHE_BYTES setting
+    @returns  The ResultCache
+    """
+    global _result_cache
+    if _result_cache is None:
+        max_bytes = getattr(settings, "CAMBIO_RESULT_CACHE_BYTES", DEFAULT_MAX_BYTES)
+        _result_cache = ResultCache(max_bytes)
+    return _result_cache
+
+
+def backing_stores() -> list:
+    """
+    Return the stores behind this process's cache, fastest first
+    @returns  List of the shared and database stores that are turned on
+    """
+    stores = [get_shared_store(), get_persistent_store()]
+    return [store for store in stores if store is not None]
+
+
+_preloaded = False
+
+
+def preload_results() -> None:
+    """
+    Load the most popular stored results into this process's cache, once,
+    so a freshly started process does not have to recompute them (the
+    number is the CAMBIO_RESULT_STORE_PRELOAD setting)
+    """
+    global _preloaded
+    if _preloaded:
+        return
+    _preloaded = True
+
+    store = get_persistent_store()
+    count = getattr(settings, "CAMBIO_RESULT_STORE_PRELOAD", 8)
+    if store is None or not count:
+        return
+    cache = get_result_cache()
+    for key, climate in reversed(store.popular(count)):
+        cache.put(key, climate)
+
+
+def lookup_result(key: str) -> dict[str, CambioVar] | None:
+    """
+    Return the results for an input hash from this process's cache, or
+    failing that from the shared store or the database (copying them into
+    the faster stores on the way back)
+    @param key  The input hash
+    @returns  A new dictionary of read-only arrays, or None if not cached
+    """
+    preload_results()
+    cache = get_result_cache()
+    climate = cache.get(key)
+    if climate is not None:
+        return climate
+
+    stores = backing_stores()
+    for istore, store in enumerate(stores):
+        climate = store.get(key)
+        if climate is not None:
+            for faster_store in stores[:istore]:
+                faster_store.put(key, climate)
+            return cache.put(key, climate)
+    return None
+
+
+def save_result(key: str, climate: dict[str, CambioVar]) -> dict[str, CambioVar]:
+    """
+    Save the results for an input hash in this process's cache, the shared
+    store and the database
+    @param key  The input hash
+    @param climate  Model results, as returned by cambio
+    @returns  A new dictionary of the read-only arrays that were cached
+    """
+    climate = get_result_cache().put(key, climate)
+    for store in backing_stores():
+        store.put(key, climate)
+    return climate
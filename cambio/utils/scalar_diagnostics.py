@@ -0,0 +1,146 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Scalar versions of the sigmoid helpers and the ClimateParams diagnostics.
+
+The versions in cambio_utils and climate_params use NumPy so they work on
+arrays, but calling a NumPy ufunc on a single float costs far more than
+the arithmetic itself. These versions use the math module instead, for
+the single-scenario loop in propagate_climate_state, where every value
+is a float.
+
+math.exp raises OverflowError where NumPy returns inf, so the sigmoids
+return their limits when the exponent is too large, as the NumPy versions
+do (these are also compiled by kernels, where the same holds).
+"""
+
+import math
+import sys
+
+from cambio.utils.climate_params import ClimateParams
+
+
+# Largest exponent for which math.exp does not overflow
+MAX_EXPONENT = math.log(sys.float_info.max)
+
+
+def sigmafloor(
+    t_in: float, t_transition: float, t_interval: float, floor: float
+) -> float:
+    """
+    Generate a sigmoid (smooth step-down) function with a floor
+
+    @param t_in  Starting temperature
+    @param t_transition  Transition temperature
+    @param t_interval  Interval for transition temperature
+    @param floor
+    """
+    exponent = -(t_in - t_transition) * 3 / t_interval
+    if exponent > MAX_EXPONENT:
+        return 1.0
+    temp = 1 - 1 / (1 + math.exp(exponent))
+    return temp * (1 - floor) + floor
+
+
+def sigmaup(t_in: float, transitiontime: float, transitiontimeinterval: float) -> float:
+    """
+    Generate a sigmoid (smooth step-up) function
+
+    @param t_in
+    @param transitiontime
+    @param transitiontimeinterval
+    """
+    exponent = -(t_in - transitiontime) * 3 / transitiontimeinterval
+    if exponent > MAX_EXPONENT:
+        return 0.0
+    return 1 / (1 + math.exp(exponent))
+
+
+def sigmadown(
+    t_in: float, transitiontime: float, transitiontimeinterval: float
+) -> float:
+    """
+    Generate a sigmoid (smooth step-down) function
+
+    @param t_in
+    @param transitiontime
+    @param transitiontimeinterval
+    """
+    return 1 - sigmaup(t_in, transitiontime, transitiontimeinterval)
+
+
+class ScalarClimateParams(ClimateParams):
+    """Climate Parameters Class, with diagnostics for single floats"""
+
+    def diagnose_ocean_surface_ph(self, c_atm: float) -> float:
+        """
+        Compute ocean pH as a function of atmospheric CO2
+
+        @param c_atm
+        @returns pH
+        """
+        return (
+            -math.log10(c_atm / ClimateParams.preindust_c_atm)
+            + ClimateParams.preindust_ph
+        )
+
+    def diagnose_flux_atm_land(
+        self, temp_anomaly: float, c_atm: float, flux_al_transition_temp: float
+    ) -> float:
+        """
+        Compute the terrestrial carbon sink
+
+        @param temp_anomaly
+        @param c_atm
+        @returns flux from atmosphere to land
+        """
+        sigma_floor_val = sigmafloor(
+            temp_anomaly,
+            flux_al_transition_temp,
+            ClimateParams.flux_al_transition_temp_interval,
+            ClimateParams.fractional_flux_al_floor,
+        )
+        return ClimateParams.k_al0 + ClimateParams.k_al1 * sigma_floor_val * c_atm
+
+    def diagnose_albedo_w_constraint(
+        self,
+        trans_temp: float,
+        temp_anom: float,
+        prev_albedo: float = 0,
+        dtime: float = 0,
+    ) -> float:
+        """
+        Return the albedo as a function of temperature, constrained so the
+        change can't exceed a certain amount per year, if so flagged
+
+        @param temp_anomaly
+        @param previousalbedo=0
+        @param dtime=0
+        @returns albedo
+        """
+        albedo = self.diagnose_albedo(trans_temp, temp_anom)
+
+        # Applying a constraint, if called for
+        if prev_albedo != 0 and dtime != 0:
+            albedo_change = albedo - prev_albedo
+            max_albedo_change = ClimateParams.max_albedo_change_rate * dtime
+            if abs(albedo_change) > max_albedo_change:
+                albedo = prev_albedo + math.copysign(max_albedo_change, albedo_change)
+        return albedo
+
+    def diagnose_albedo(self, trans_temp: float, temp_anom: float) -> float:
+        """
+        Return the albedo as a function of temperature anomaly
+
+        @param temp_anomaly
+        @returns albedo
+        """
+        return (
+            sigmafloor(
+                temp_anom,
+                trans_temp,
+                ClimateParams.albedo_transition_interval,
+                ClimateParams.fractional_albedo_floor,
+            )
+            * ClimateParams.preindust_albedo
+        )
@@ -4,8 +4,31 @@ By Daniel Neshyba-Rowe and Penny Rowe
 """
 
 import json
+import math
 from django.http import QueryDict
-from pydantic import BaseModel
+from pydantic import BaseModel, conint, root_validator, validator
+
+
+# Most time steps in a model run
+MAX_TIME_STEPS = 100_000
+
+# Bound on the random seeds (they are stored as 64-bit integers)
+MAX_RANDOM_SEED = 2**63
+
+
+def validate_time_axis(start_year: float, stop_year: float, dtime: float) -> None:
+    """
+    Require a positive time step, and from 1 to MAX_TIME_STEPS steps
+    @param start_year  The first year
+    @param stop_year  The last year
+    @param dtime  The time step, in years
+    @raises ValueError  If the time axis is not valid
+    """
+    if dtime <= 0:
+        raise ValueError("dtime must be positive")
+    steps = (stop_year - start_year) / dtime
+    if not 0 < steps <= MAX_TIME_STEPS:
+        raise ValueError(f"the run must have 1 to {MAX_TIME_STEPS} time steps")
 
 
 class BaseInputs(BaseModel):
@@ -18,6 +41,13 @@ class BaseInputs(BaseModel):
     stochastic_c_atm_std_dev: float = 0.0
     flux_al_transition_temp: float = 3.9
 
+    @validator("*")
+    def check_finite(cls, value):
+        """Reject NaN and infinite values"""
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ValueError("must be finite")
+        return value
+
     @classmethod
     def from_dict(cls, input_dict: dict[str, str] | QueryDict):
         """
@@ -69,6 +99,15 @@ class CambioInputs(BaseInputs):
     albedo_with_no_constraint: bool = False
     albedo_feedback: bool = True
     temp_anomaly_feedback: bool = True
+    # Seed for the noise in stochastic runs, so they can be repeated
+    # (None draws fresh noise every run)
+    random_seed: conint(ge=0, lt=MAX_RANDOM_SEED) | None = None
+
+    @root_validator(skip_on_failure=True)
+    def check_time_axis(cls, values):
+        """Require a time axis of at least one and at most MAX_TIME_STEPS steps"""
+        validate_time_axis(values["start_year"], values["stop_year"], values["dtime"])
+        return values
 
 
 class ScenarioInputs(BaseInputs):
@@ -0,0 +1,234 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Result store shared by all the worker processes on a machine.
+
+Each result is one file in a shared directory, named by the input hash,
+holding the arrays of the climate packed back to back after a short
+header. Readers memory-map the file and get read-only arrays that point
+straight into the mapping, so a result computed by one gunicorn worker
+can be served by any other without copying or recomputing it. Files are
+written to a temporary name and renamed into place, so readers never see
+a partial result, and the least recently used files are removed when the
+directory grows past its size cap. Each process keeps a running total of
+the directory size (from one scan, plus what it writes), so it only scans
+the directory again when the total goes over the cap.
+"""
+
+import json
+import mmap
+import os
+from pathlib import Path
+import struct
+import tempfile
+
+from django.conf import settings
+import numpy as np
+
+from cambio.utils.cambio_utils import CambioVar
+
+
+# File format: magic, header length, JSON header, padding, array data
+MAGIC = b"CMB1"
+_PREFIX = struct.Struct("<4sI")
+_ALIGN = 8
+
+# Size cap of the shared directory, if the settings give none
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+def pack_climate(climate: dict[str, CambioVar]) -> bytes:
+    """
+    Pack the arrays of a climate into bytes
+    @param climate  Model results, as returned by cambio
+    @returns  The packed results (other values than arrays are dropped)
+    """
+    arrays = {
+        key: np.ascontiguousarray(value)
+        for key, value in climate.items()
+        if isinstance(value, np.ndarray)
+    }
+
+    # Lay the arrays out one after another, each aligned for its dtype
+    layout = []
+    offset = 0
+    for key, array in arrays.items():
+        layout.append([key, array.dtype.str, list(array.shape), offset])
+        offset += -(-array.nbytes // _ALIGN) * _ALIGN
+
+    header = json.dumps(layout, separators=(",", ":")).encode()
+    start = -(-(_PREFIX.size + len(header)) // _ALIGN) * _ALIGN
+    packed = bytearray(start + offset)
+    _PREFIX.pack_into(packed, 0, MAGIC, len(header))
+    packed[_PREFIX.size : _PREFIX.size + len(header)] = header
+    for (_, _, _, array_offset), array in zip(layout, arrays.values()):
+        begin = start + array_offset
+        packed[begin : begin + array.nbytes] = array.tobytes()
+    return bytes(packed)
+
+
+def unpack_climate(packed) -> dict[str, CambioVar]:
+    """
+    Unpack a climate packed by pack_climate, without copying the arrays
+    @param packed  The packed results (bytes, mmap, or any buffer)
+    @returns  Dictionary of arrays that share memory with packed
+    """
+    magic, header_length = _PREFIX.unpack_from(packed, 0)
+    if magic != MAGIC:
+        raise ValueError("Not a packed climate")
+    header_end = _PREFIX.size + header_length
+    layout = json.loads(bytes(packed[_PREFIX.size : header_end]))
+    start = -(-header_end // _ALIGN) * _ALIGN
+
+    climate = {}
+    for key, dtype, shape, offset in layout:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape, dtype=np.int64))
+        array = np.frombuffer(packed, dtype, count, start + offset)
+        climate[key] = array.reshape(shape)
+    return climate
+
+
+class SharedResultStore:
+    """
+    Directory of memory-mapped model results, keyed by input hash
+    """
+
+    def __init__(self, directory: str | Path, max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        Create an instance of the class
+
+        @param directory  Directory shared by the worker processes
+        @param max_bytes  Largest total size of the result files
+        """
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        # Size of the directory, as far as this process knows (None until
+        # it is first scanned)
+        self.nbytes: int | None = None
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key: str) -> Path:
+        """
+        Return the file for an input hash
+        @param key  The input hash
+        @returns  Path of the file
+        """
+        return self.directory / f"{key}.cmb"
+
+    def get(self, key: str) -> dict[str, CambioVar] | None:
+        """
+        Return the stored results for an input hash
+        @param key  The input hash
+        @returns  Dictionary of read-only arrays mapped from the file, or
+                  None if there is no such result
+        """
+        path = self.path(key)
+        try:
+            with open(path, "rb") as file:
+                mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            climate = unpack_climate(mapping)
+            os.utime(path)
+        except (OSError, ValueError, struct.error):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return climate
+
+    def put(self, key: str, climate: dict[str, CambioVar]) -> None:
+        """
+        Store the results for an input hash
+        @param key  The input hash
+        @param climate  Model results, as returned by cambio
+        """
+        path = self.path(key)
+        if path.exists():
+            return
+
+        # Write to a temporary file, then rename it into place in one step
+        packed = pack_climate(climate)
+        try:
+            fd, tmp_name = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as file:
+                file.write(packed)
+            os.replace(tmp_name, path)
+        except OSError:
+            return
+
+        if self.nbytes is None:
+            self.nbytes = self.total_bytes()
+        else:
+            self.nbytes += len(packed)
+        if self.nbytes > self.max_bytes:
+            self.prune()
+
+    def total_bytes(self) -> int:
+        """
+        Return the size of all the result files
+        @returns  The size in bytes
+        """
+        total = 0
+        for path in self.directory.glob("*.cmb"):
+            try:
+                total += path.stat().st_size
+            except OSError:
+                pass
+        return total
+
+    def prune(self) -> None:
+        """Remove the least recently used results until within the size cap"""
+        entries = []
+        for path in self.directory.glob("*.cmb"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total -= size
+        self.nbytes = total
+
+    def clear(self) -> None:
+        """Remove all the results"""
+        for path in self.directory.glob("*.cmb"):
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        self.nbytes = 0
+
+
+_shared_store: SharedResultStore | None = None
+
+
+def get_shared_store() -> SharedResultStore | None:
+    """
+    Return the shared result store, in the CAMBIO_SHARED_CACHE_DIR setting
+    and capped at CAMBIO_SHARED_CACHE_BYTES
+    @returns  The SharedResultStore, or None if it is turned off (a size
+              cap of 0)
+    """
+    global _shared_store
+    max_bytes = getattr(settings, "CAMBIO_SHARED_CACHE_BYTES", DEFAULT_MAX_BYTES)
+    if not max_bytes:
+        return None
+    directory = getattr(settings, "CAMBIO_SHARED_CACHE_DIR", None)
+    if directory is None:
+        directory = Path(tempfile.gettempdir()) / "cambio-results"
+    directory = Path(directory)
+
+    # Start a new store if the settings have changed since the last one
+    store = _shared_store
+    if store is None or (store.directory, store.max_bytes) != (directory, max_bytes):
+        store = _shared_store = SharedResultStore(directory, max_bytes)
+    return store
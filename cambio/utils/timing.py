@@ -0,0 +1,106 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Time the phases of a request.
+
+While a request is being timed (see middleware.ServerTimingMiddleware),
+each "with phase(name):" block adds its duration to the request's timer;
+a phase that runs more than once (as for each panel) adds up. Outside a
+timed request, phase costs one context variable lookup. The timer is
+kept in a context variable, so it follows the request into the thread
+pool of the async views.
+"""
+
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+import threading
+import time
+from typing import Iterator
+
+
+class PhaseTimer:
+    """
+    Durations of the phases of one request
+    """
+
+    def __init__(self) -> None:
+        """Create an instance of the class, starting the clock"""
+        self.start = time.perf_counter()
+        self.durations: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float) -> None:
+        """
+        Add time to a phase
+        @param name  The phase
+        @param seconds  Time spent in it
+        """
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def total(self) -> float:
+        """
+        Return the time since the timer was started
+        @returns  The time, in seconds
+        """
+        return time.perf_counter() - self.start
+
+    def header(self) -> str:
+        """
+        Return the durations as a Server-Timing header value
+        @returns  The header value, with the durations in milliseconds
+        """
+        metrics = [
+            f"{name};dur={seconds * 1000:.2f}"
+            for name, seconds in self.durations.items()
+        ]
+        metrics.append(f"total;dur={self.total() * 1000:.2f}")
+        return ", ".join(metrics)
+
+
+_timer: ContextVar[PhaseTimer | None] = ContextVar("cambio_timer", default=None)
+_untimed = nullcontext()
+
+
+def start_timer() -> PhaseTimer:
+    """
+    Start timing the phases of the current request
+    @returns  The timer
+    """
+    timer = PhaseTimer()
+    _timer.set(timer)
+    return timer
+
+
+def stop_timer() -> None:
+    """Stop timing the current request"""
+    _timer.set(None)
+
+
+def current_timer() -> PhaseTimer | None:
+    """
+    Return the timer of the current request
+    @returns  The timer, or None if the request is not being timed
+    """
+    return _timer.get()
+
+
+@contextmanager
+def _timed(timer: PhaseTimer, name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+def phase(name: str):
+    """
+    Time a phase of the current request, if it is being timed
+    @param name  The phase, as it will appear in the Server-Timing header
+    @returns  A context manager
+    """
+    timer = _timer.get()
+    if timer is None:
+        return _untimed
+    return _timed(timer, name)
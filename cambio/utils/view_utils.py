@@ -4,11 +4,131 @@ By Penny Rowe and Daniel Neshyba-Rowe
 
 """
 
+from collections.abc import Iterable, Iterator, Mapping
+from functools import lru_cache
+import hashlib
+import json
+
 from django.http import HttpRequest
 
-from cambio.utils.cambio import cambio
+from cambio.utils.permalink import PERMALINK_PARAM, decode_scenarios
+from cambio.utils.process_pool import run_scenarios
 from cambio.utils.schemas import CambioInputs
 from cambio.utils.cambio_utils import CambioVar
+from cambio.utils.result_cache import (
+    inputs_hash,
+    is_cacheable,
+    lookup_result,
+    save_result,
+)
+
+
+# Session key under which each visitor's saved scenarios are kept
+SCENARIOS_SESSION_KEY = "cambio_scenarios"
+
+
+@lru_cache(maxsize=1024)
+def _parse_inputs(text: str) -> CambioInputs | None:
+    try:
+        values = json.loads(text)
+    except ValueError:
+        return None
+    if not isinstance(values, dict):
+        return None
+    return CambioInputs.from_dict(values)
+
+
+def parse_inputs(text: str) -> CambioInputs | None:
+    """
+    Parse and validate saved scenario inputs, remembering the results so
+    the same text is never parsed twice
+    @param text  The inputs, as JSON
+    @returns  The CambioInputs, or None if the text is not a JSON object
+    """
+    inputs = _parse_inputs(text)
+    return None if inputs is None else inputs.copy()
+
+
+# Parameters of the default scenario, as if from the form
+DEFAULT_SCENARIO_PARAMS = {
+    "inv_time_constant": [""],
+    "transition_year": [""],
+    "transition_duration": [""],
+    "long_term_emissions": [""],
+    "albedo_with_no_constraint": [""],
+    "albedo_feedback": [""],
+    "albedo_transition_temp": [""],
+    "flux_al_transition_temp": [""],
+    "stochastic_c_atm_std_dev": [""],
+    "scenario_name": [""],
+    "F_ha": ["on"],
+    "flux": ["GtC/year"],
+    "C_atm": ["on"],
+    "carbon": ["GtC"],
+    "T_anomaly": ["on"],
+    "temp": ["C"],
+    "pH": ["on"],
+    "albedo": ["on"],
+}
+
+
+class ScenarioStore:
+    """
+    A visitor's saved scenarios, kept on the server in their session, so
+    the only cookie is the session key
+    """
+
+    def __init__(self, request: HttpRequest) -> None:
+        """
+        Create an instance of the class
+
+        @param request  The HttpRequest (without a session, as with no
+                        session middleware, nothing is saved)
+        """
+        self.session = getattr(request, "session", None)
+
+    @property
+    def enabled(self) -> bool:
+        """True if scenarios can be saved in the session"""
+        return self.session is not None
+
+    def load(self) -> dict[str, CambioInputs]:
+        """
+        Return the saved scenarios
+        @returns  The inputs, by scenario id
+        """
+        if self.session is None:
+            return {}
+        scenarios = {}
+        for scenario_id, text in self.session.get(SCENARIOS_SESSION_KEY, {}).items():
+            inputs = parse_inputs(text)
+            if inputs is not None:
+                scenarios[scenario_id] = inputs
+        return scenarios
+
+    def add(self, scenario_id: str, inputs: CambioInputs) -> None:
+        """
+        Save a scenario
+        @param scenario_id  The scenario id
+        @param inputs  Its inputs
+        """
+        if self.session is None:
+            return
+        saved = dict(self.session.get(SCENARIOS_SESSION_KEY, {}))
+        saved[scenario_id] = inputs.json()
+        self.session[SCENARIOS_SESSION_KEY] = saved
+
+    def remove(self, scenario_ids: Iterable[str]) -> None:
+        """
+        Remove saved scenarios
+        @param scenario_ids  The scenario ids
+        """
+        if self.session is None:
+            return
+        saved = dict(self.session.get(SCENARIOS_SESSION_KEY, {}))
+        for scenario_id in scenario_ids:
+            saved.pop(scenario_id, None)
+        self.session[SCENARIOS_SESSION_KEY] = saved
 
 
 class ManageInputs:
@@ -24,22 +144,52 @@ class ManageInputs:
         self.is_new = False
         self.new_scenario = None
         self.scenario_inputs: dict[str, CambioInputs] = {}
+        self.store = ScenarioStore(request)
+        self.migrated_cookies: list[str] = []
+        self.permalink_ids: list[str] = []
+        self.deleted_ids: list[str] = []
 
         # Always add the default
         self.include_default()
 
-        # Add old scenarios
+        # Add old scenarios, from the session and from any cookies left over
+        # from before scenarios were kept in the session
+        self.scenario_inputs.update(self.store.load())
         self.add_old(request.COOKIES)
 
+        # Add scenarios from a permalink
+        self.add_permalink(request)
+
         # Add new scenarios if indicated
         if is_in_request(request, "add_button"):
             self.set_new(request)
 
     def add_old(self, cookies):
-        """add old scenarios from cookies"""
+        """add old scenarios from cookies, moving them into the session"""
         for scenario_id, scenario in cookies.items():
-            if CambioInputs.is_json(scenario):
-                self.scenario_inputs[scenario_id] = CambioInputs.from_json(scenario)
+            inputs = parse_inputs(scenario)
+            if inputs is None:
+                continue
+            self.scenario_inputs[scenario_id] = inputs
+            if self.store.enabled:
+                self.store.add(scenario_id, inputs)
+                self.migrated_cookies.append(scenario_id)
+
+    def add_permalink(self, request):
+        """
+        add the scenarios in a permalink token, for this page only (they are
+        not saved, so a shared link leaves the visitor's own scenarios, and
+        the cacheability of the page, alone)
+        """
+        token = request.GET.get(PERMALINK_PARAM, "")
+        if token == "":
+            return
+        try:
+            scenarios = decode_scenarios(token)
+        except ValueError:
+            return
+        self.scenario_inputs.update(scenarios)
+        self.permalink_ids = list(scenarios)
 
     def set_new(self, request):
         """Get new scenario from get parameters only if it exists"""
@@ -49,6 +199,7 @@ class ManageInputs:
             self.is_new = True
             self.new_scenario = CambioInputs.from_dict(request.GET)
             self.scenario_inputs[new_scenario_id] = self.new_scenario
+            self.store.add(new_scenario_id, self.new_scenario)
         else:
             self.new_scenario_id = ""
             self.is_new = False
@@ -85,6 +236,8 @@ class ManageInputs:
                 scenarios_ids_to_delete.remove(self.default)
 
             # Remove the scenarios scheduled for deletion
+            self.store.remove(scenarios_ids_to_delete)
+            self.deleted_ids = scenarios_ids_to_delete
             self.scenario_inputs = {
                 key: value
                 for key, value in self.scenario_inputs.items()
@@ -93,6 +246,13 @@ class ManageInputs:
 
         return scenarios_ids_to_delete
 
+    def changed(self) -> bool:
+        """
+        Return True if this request changes the saved scenarios (adding,
+        deleting, or moving them from cookies)
+        """
+        return bool(self.is_new or self.deleted_ids or self.migrated_cookies)
+
     def get(self):
         """Get the scenario inputs"""
         return self.scenario_inputs
@@ -106,7 +266,10 @@ class ManageInputs:
         scenarios_ids_to_plot = [
             sid for sid in scenarios_ids_to_plot if sid in self.scenario_inputs
         ]
-        # If nothing else is indicated for plotting, plot the default
+        # If nothing else is indicated for plotting, plot the scenarios in
+        # a permalink, or else the default
+        if len(scenarios_ids_to_plot) == 0:
+            scenarios_ids_to_plot = list(self.permalink_ids)
         if len(scenarios_ids_to_plot) == 0:
             scenarios_ids_to_plot = [self.default]
         return scenarios_ids_to_plot
@@ -116,27 +279,9 @@ class ManageInputs:
         Always include default scenario in the list of scenarios
         """
         if self.default not in self.scenario_inputs:
-            dflt_params = {
-                "inv_time_constant": [""],
-                "transition_year": [""],
-                "transition_duration": [""],
-                "long_term_emissions": [""],
-                "albedo_with_no_constraint": [""],
-                "albedo_feedback": [""],
-                "albedo_transition_temp": [""],
-                "flux_al_transition_temp": [""],
-                "stochastic_c_atm_std_dev": [""],
-                "scenario_name": [""],
-                "F_ha": ["on"],
-                "flux": ["GtC/year"],
-                "C_atm": ["on"],
-                "carbon": ["GtC"],
-                "T_anomaly": ["on"],
-                "temp": ["C"],
-                "pH": ["on"],
-                "albedo": ["on"],
-            }
-            self.scenario_inputs[self.default] = CambioInputs.from_dict(dflt_params)
+            self.scenario_inputs[self.default] = CambioInputs.from_dict(
+                DEFAULT_SCENARIO_PARAMS
+            )
 
 
 # def include_default(scenario_inputs, default: str):
@@ -202,11 +347,117 @@ def run_model_for_dict(
     @param request
     @returns Climate model run outputs
     """
-    # Run the model
-    # scenarios: dict[dict[str, CambioVar]] = {}
+    # Look up each distinct set of inputs in the result cache, and collect
+    # the ones that still have to be run (identical inputs run only once)
+    found: dict[str, dict[str, CambioVar]] = {}
+    to_run: dict[str, CambioInputs] = {}
+    keys: dict[str, str] = {}
+    for scenario_id, inputs in scenario_inputs.items():
+        if not is_cacheable(inputs):
+            keys[scenario_id] = f"uncached:{scenario_id}"
+            to_run[keys[scenario_id]] = inputs
+            continue
+        key = inputs_hash(inputs)
+        keys[scenario_id] = key
+        if key in found or key in to_run:
+            continue
+        climate = lookup_result(key)
+        if climate is None:
+            to_run[key] = inputs
+        else:
+            found[key] = climate
+
+    # Run the model for all the missing scenarios together (in the process
+    # pool, if it is turned on and there are enough of them)
+    results = run_scenarios(list(to_run.values()))
+    for (key, inputs), (climate, _) in zip(to_run.items(), results):
+        if is_cacheable(inputs):
+            climate = save_result(key, climate)
+        found[key] = climate
+
+    # Give each scenario its own dictionary, so they can be changed freely
     scenarios: dict[str, dict[str, CambioVar]] = {}
-    for scenario_id, scenario_input in scenario_inputs.items():
-        climate, _ = cambio(scenario_input)
+    for scenario_id, key in keys.items():
+        climate = dict(found[key])
         climate["scenario_id"] = scenario_id
+        climate["result_hash"] = (
+            key if is_cacheable(scenario_inputs[scenario_id]) else None
+        )
         scenarios[scenario_id] = climate
     return scenarios
+
+
+class LazyScenarios(Mapping):
+    """
+    Climate model run outputs, by scenario id, that are only computed when
+    they are first looked up. The keys come from the inputs, so listing the
+    scenarios costs nothing; only the ones that are used are run.
+    """
+
+    def __init__(self, scenario_inputs: dict[str, CambioInputs]) -> None:
+        """
+        Create an instance of the class
+
+        @param scenario_inputs  The inputs, by scenario id
+        """
+        self.scenario_inputs = scenario_inputs
+        self._scenarios: dict[str, dict[str, CambioVar]] = {}
+
+    def __getitem__(self, scenario_id: str) -> dict[str, CambioVar]:
+        if scenario_id not in self._scenarios:
+            self.load([scenario_id])
+        return self._scenarios[scenario_id]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.scenario_inputs)
+
+    def __len__(self) -> int:
+        return len(self.scenario_inputs)
+
+    def load(self, scenario_ids: Iterable[str]) -> list[dict[str, CambioVar]]:
+        """
+        Run the model for several scenarios at once (any not yet run)
+        @param scenario_ids  The scenario ids
+        @returns  The model outputs for the scenarios, in the same order
+        """
+        scenario_ids = list(scenario_ids)
+        to_run = {
+            sid: self.scenario_inputs[sid]
+            for sid in scenario_ids
+            if sid not in self._scenarios
+        }
+        if to_run:
+            self._scenarios.update(run_model_for_dict(to_run))
+        return [self._scenarios[sid] for sid in scenario_ids]
+
+    def loaded(self) -> list[str]:
+        """
+        Return the ids of the scenarios that have been run
+        @returns  The scenario ids
+        """
+        return list(self._scenarios)
+
+
+def page_etag(
+    scenario_inputs: dict[str, CambioInputs],
+    ids_to_plot: list[str],
+    selections: tuple,
+    *extra: object,
+) -> str:
+    """
+    Return a strong ETag for a page showing the scenarios, from the hashes
+    of their inputs, the scenarios plotted and the panel selections
+    @param scenario_inputs  The inputs, by scenario id
+    @param ids_to_plot  The scenarios to plot
+    @param selections  The panel selections, from MakePlots.selections
+    @param extra  Anything else the page depends on
+    @returns  The ETag, quoted
+    """
+    state = [
+        [[sid, inputs_hash(inputs)] for sid, inputs in scenario_inputs.items()],
+        ids_to_plot,
+        selections,
+        [repr(value) for value in extra],
+    ]
+    text = json.dumps(state, separators=(",", ":"))
+    return '"' + hashlib.sha256(text.encode()).hexdigest()[:32] + '"'
@@ -0,0 +1,58 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Warm a process up before it serves its first request.
+
+With scale-to-zero hosting, the first visitor after a quiet spell waits
+for the server to start. Warming up does the work of that first request
+ahead of time: it imports the views (and with them NumPy, pydantic and
+Plotly), compiles the page template, runs the model for the Default
+scenario and draws its panels, keeping the results in this process's
+result and panel caches. Run in the gunicorn master (with --preload), the
+warmed caches are shared by every worker forked from it.
+
+The database is not touched, since apps are still being set up.
+"""
+
+from importlib import import_module
+import logging
+from time import perf_counter
+
+from django.http import QueryDict
+from django.template.loader import get_template
+
+from cambio.utils.cambio import cambio
+from cambio.utils.make_plots import MakePlots
+from cambio.utils.result_cache import get_result_cache, inputs_hash
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.view_utils import DEFAULT_SCENARIO_PARAMS
+
+
+logger = logging.getLogger("cambio.startup")
+
+
+def warm_up(scenario_id: str = "Default") -> float:
+    """
+    Import the views, compile the template, and compute the results and
+    the panels of the default scenario
+    @param scenario_id  Id of the default scenario
+    @returns  Time taken, in seconds
+    """
+    start = perf_counter()
+    import_module("cambio.views")
+    get_template("cambio/index.html")
+
+    inputs = CambioInputs.from_dict(DEFAULT_SCENARIO_PARAMS)
+    key = inputs_hash(inputs)
+    cache = get_result_cache()
+    climate = cache.get(key)
+    if climate is None:
+        climate = cache.put(key, cambio(inputs)[0])
+
+    # The panels as the page first shows them, keyed as the view keys them
+    scenario = dict(climate, scenario_id=scenario_id, result_hash=key)
+    MakePlots(QueryDict()).make([scenario])
+
+    seconds = perf_counter() - start
+    logger.info("Warmed up in %.2f s", seconds)
+    return seconds
@@ -5,12 +5,27 @@ By Penny Rowe and Daniel Neshyba-Rowe
 Inspired by Benchly, by Ben Gamble, Charlie Dahl, and Penny Rowe
 """
 
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.shortcuts import render
-from django.http import HttpRequest, HttpResponse
+from django.http import Http404, HttpRequest, HttpResponse, JsonResponse
+from django.utils.cache import (
+    add_never_cache_headers,
+    get_conditional_response,
+    patch_cache_control,
+    patch_vary_headers,
+)
 
-from cambio.utils.view_utils import ManageInputs, run_model_for_dict
+from cambio.utils.async_utils import offload, run_model_for_dict_async
+from cambio.utils.result_cache import cache_version, inputs_hash, is_cacheable
+from cambio.utils.view_utils import LazyScenarios, ManageInputs, page_etag
+from cambio.utils import metrics
 from cambio.utils.make_plots import MakePlots, get_display_names
-from cambio.utils.schemas import ScenarioInputs
+from cambio.utils.permalink import MAX_SCENARIOS, PERMALINK_PARAM, encode_scenarios
+from cambio.utils.schemas import CambioInputs, ScenarioInputs
+from cambio.utils.timing import phase
 
 
 def index(request: HttpRequest) -> HttpResponse:
@@ -19,30 +34,65 @@ def index(request: HttpRequest) -> HttpResponse:
     @param request  The HttpRequest
     """
 
-    # Get the scenario inputs from the default, the cookies, and new scenarios
-    manageInputs = ManageInputs(request, "Default")
+    # Get the scenario inputs from the default, the session, and new
+    # scenarios, less any set for deletion, and the scenarios to plot
+    with phase("inputs"):
+        manageInputs, ids_to_delete, ids_to_plot = get_inputs(request)
+    scenario_inputs = manageInputs.get()
 
-    # Remove scenarios set for deletion
-    ids_to_delete = manageInputs.delete(request, "delete_button", "del_scenario")
+    # If the browser already has this page, tell it so
+    makePlots = MakePlots(request.GET)
+    client_plots = getattr(settings, "CAMBIO_CLIENT_PLOTS", False)
+    etag = response_etag(
+        manageInputs, ids_to_plot, makePlots, not client_plots, "index", client_plots
+    )
+    not_modified = conditional_response(request, etag)
+    if not_modified is not None:
+        return not_modified
 
-    # Run the model on old and new inputs to get the climate model results
-    scenario_inputs = manageInputs.get()
+    # Create the plots (for passing to the html), unless the browser is
+    # going to draw them from the data view
+    if client_plots:
+        plot_divs = makePlots.plot_stuff
+    else:
+        # Model output: scenarios: Mapping[str, dict[str, CambioVar]]
+        # where scenarios[scenario_id] is a dictionary with model output;
+        # only the scenarios that are plotted are actually run
+        scenarios = LazyScenarios(scenario_inputs)
+        with phase("model"):
+            plot_scenarios = scenarios.load(ids_to_plot)
+        plot_divs = makePlots.make(plot_scenarios)
 
-    # Model output: scenarios: dict[str, dict[str, CambioVar]]
-    # where scenarios[scenario_id] is a dictionary with model output
-    scenarios = run_model_for_dict(scenario_inputs)
+    with phase("render"):
+        response = render_index(
+            request, manageInputs, ids_to_delete, ids_to_plot, plot_divs, client_plots
+        )
+    return set_cache_headers(request, response, etag)
 
-    # Always plot any checked scenarios
-    ids_to_plot = manageInputs.get_ids_to_plot(request, "plot_scenario_")
 
-    # Create the plots (for passing to the html)
-    makePlots = MakePlots(request.GET)
-    plot_divs = makePlots.make([scenarios[sid] for sid in ids_to_plot])
+def render_index(
+    request: HttpRequest,
+    manageInputs: ManageInputs,
+    ids_to_delete: list[str],
+    ids_to_plot: list[str],
+    plot_divs: dict,
+    client_plots: bool,
+) -> HttpResponse:
+    """
+    Render the main page
+    @param request  The HttpRequest
+    @param manageInputs  The scenario inputs
+    @param ids_to_delete  Scenarios that were deleted
+    @param ids_to_plot  Scenarios to plot
+    @param plot_divs  The plots, from MakePlots.make
+    @param client_plots  True if the browser is to draw the plots
+    """
+    scenario_inputs = manageInputs.get()
 
     # Get the other variables to pass to the html
     old_display_inputs = {sid: inp.dict() for sid, inp in scenario_inputs.items()}
-    plot_scenario_choices = [[sid, f"plot_scenario_{sid}"] for sid in scenarios]
-    plot_scenario_ids = [sid for sid in ids_to_plot if sid in scenarios]
+    plot_scenario_choices = [[sid, f"plot_scenario_{sid}"] for sid in scenario_inputs]
+    plot_scenario_ids = [sid for sid in ids_to_plot if sid in scenario_inputs]
 
     # Variables to pass to html
     context = {
@@ -52,16 +102,259 @@ def index(request: HttpRequest) -> HttpResponse:
         "plot_scenario_ids": plot_scenario_ids,
         "inputs": ScenarioInputs().dict(),
         "display_names": get_display_names(),
+        "client_plots": client_plots,
+        "permalink_param": PERMALINK_PARAM,
+        "permalink": permalink(scenario_inputs),
     }
     response = render(request, "cambio/index.html", context)
+    metrics.HTML_BYTES.inc(len(response.content))
+    metrics.REQUEST_SCENARIOS.observe(len(ids_to_plot))
 
-    # If there is a new scenario in the get parameters, save it to cookies
-    if manageInputs.new_exists():
+    # Scenarios are saved in the session; without one, fall back to saving
+    # a new scenario in the get parameters to cookies
+    if manageInputs.new_exists() and not manageInputs.store.enabled:
         new_id, new_scenario = manageInputs.get_new()
         response.set_cookie(new_id, new_scenario)
 
-    # Delete all unwanted scenarios:
-    for cookie_name in ids_to_delete:
+    # Delete all unwanted scenarios, and the cookies of any scenarios that
+    # have been moved into the session
+    for cookie_name in ids_to_delete + manageInputs.migrated_cookies:
         response.delete_cookie(cookie_name)
 
     return response
+
+
+def data(request: HttpRequest) -> HttpResponse:
+    """
+    Return the plot data for the scenarios to plot, as JSON, so the page
+    can draw the plots itself. Takes the same parameters as the main page.
+    @param request  The HttpRequest
+    """
+    with phase("inputs"):
+        manageInputs, _, ids_to_plot = get_inputs(request)
+    makePlots = MakePlots(request.GET)
+    etag = response_etag(manageInputs, ids_to_plot, makePlots, True, "data")
+    not_modified = conditional_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    scenarios = LazyScenarios(manageInputs.get())
+    with phase("model"):
+        plot_scenarios = scenarios.load(ids_to_plot)
+    with phase("traces"):
+        panels = makePlots.data(plot_scenarios)
+    with phase("render"):
+        response = JsonResponse({"panels": panels})
+    return set_cache_headers(request, response, etag)
+
+
+async def index_async(request: HttpRequest) -> HttpResponse:
+    """
+    Create the view for the main page, as index does, but with the model
+    runs and the plotting done in the thread pool (see async_utils)
+    @param request  The HttpRequest
+    """
+    # The scenarios are kept in the session, which is in the database
+    with phase("inputs"):
+        manageInputs, ids_to_delete, ids_to_plot = await sync_to_async(get_inputs)(
+            request
+        )
+    scenario_inputs = manageInputs.get()
+
+    makePlots = MakePlots(request.GET)
+    client_plots = getattr(settings, "CAMBIO_CLIENT_PLOTS", False)
+    etag = response_etag(
+        manageInputs, ids_to_plot, makePlots, not client_plots, "index", client_plots
+    )
+    not_modified = conditional_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    if client_plots:
+        plot_divs = makePlots.plot_stuff
+    else:
+        # Only the scenarios that are plotted are run
+        plot_inputs = {sid: scenario_inputs[sid] for sid in ids_to_plot}
+
+        async def make_plots() -> dict:
+            with phase("model"):
+                scenarios = await run_model_for_dict_async(plot_inputs)
+            return await offload(
+                makePlots.make, [scenarios[sid] for sid in ids_to_plot]
+            )
+
+        try:
+            plot_divs = await asyncio.wait_for(make_plots(), view_timeout())
+        except asyncio.TimeoutError:
+            return busy_response()
+
+    with phase("render"):
+        response = render_index(
+            request, manageInputs, ids_to_delete, ids_to_plot, plot_divs, client_plots
+        )
+    return set_cache_headers(request, response, etag)
+
+
+async def data_async(request: HttpRequest) -> HttpResponse:
+    """
+    Return the plot data for the scenarios to plot, as data does, but with
+    the model runs done in the thread pool (see async_utils)
+    @param request  The HttpRequest
+    """
+    with phase("inputs"):
+        manageInputs, _, ids_to_plot = await sync_to_async(get_inputs)(request)
+    scenario_inputs = {sid: manageInputs.get()[sid] for sid in ids_to_plot}
+
+    makePlots = MakePlots(request.GET)
+    etag = response_etag(manageInputs, ids_to_plot, makePlots, True, "data")
+    not_modified = conditional_response(request, etag)
+    if not_modified is not None:
+        return not_modified
+
+    async def make_data() -> dict:
+        with phase("model"):
+            scenarios = await run_model_for_dict_async(scenario_inputs)
+        with phase("traces"):
+            return await offload(
+                makePlots.data, [scenarios[sid] for sid in ids_to_plot]
+            )
+
+    try:
+        panels = await asyncio.wait_for(make_data(), view_timeout())
+    except asyncio.TimeoutError:
+        return busy_response()
+    with phase("render"):
+        response = JsonResponse({"panels": panels})
+    return set_cache_headers(request, response, etag)
+
+
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    """
+    Return the metrics of all the worker processes, in the Prometheus text
+    format (only with the CAMBIO_METRICS setting on)
+    @param request  The HttpRequest
+    """
+    if not getattr(settings, "CAMBIO_METRICS", False):
+        raise Http404
+    metrics.flush()
+    return HttpResponse(
+        metrics.render(metrics.aggregate()),
+        content_type="text/plain; version=0.0.4; charset=utf-8",
+    )
+
+
+def get_inputs(request: HttpRequest) -> tuple[ManageInputs, list[str], list[str]]:
+    """
+    Get the scenario inputs from the default, the session, and new
+    scenarios, less any set for deletion
+    @param request  The HttpRequest
+    @returns  The scenario inputs, the ids deleted and the ids to plot
+    """
+    manageInputs = ManageInputs(request, "Default")
+    ids_to_delete = manageInputs.delete(request, "delete_button", "del_scenario")
+    ids_to_plot = manageInputs.get_ids_to_plot(request, "plot_scenario_")
+
+    # Note the scenarios plotted, for the profiles of the request
+    scenario_inputs = manageInputs.get()
+    request.cambio_scenario_hashes = {
+        sid: inputs_hash(scenario_inputs[sid]) for sid in ids_to_plot
+    }
+    return manageInputs, ids_to_delete, ids_to_plot
+
+
+def permalink(scenario_inputs: dict[str, CambioInputs]) -> str | None:
+    """
+    Return the permalink token for the scenarios on a page
+    @param scenario_inputs  The inputs, by scenario id
+    @returns  The token, or None if there are too many scenarios for one
+    """
+    if len(scenario_inputs) > MAX_SCENARIOS:
+        return None
+    return encode_scenarios(scenario_inputs)
+
+
+def view_timeout() -> float:
+    """
+    Return how long the async views wait for results, in seconds (the
+    CAMBIO_VIEW_TIMEOUT setting)
+    """
+    return getattr(settings, "CAMBIO_VIEW_TIMEOUT", 30.0)
+
+
+def busy_response() -> HttpResponse:
+    """
+    Return the response for when the results did not come in time
+    """
+    response = HttpResponse("The server is busy. Please try again.", status=503)
+    response["Retry-After"] = "5"
+    return response
+
+
+def response_etag(
+    manageInputs: ManageInputs,
+    ids_to_plot: list[str],
+    makePlots: MakePlots,
+    shows_results: bool,
+    *extra: object,
+) -> str | None:
+    """
+    Return the ETag for a response, if it can be cached
+    @param manageInputs  The scenario inputs
+    @param ids_to_plot  Scenarios to plot
+    @param makePlots  The plots, with the panel selections
+    @param shows_results  True if the response holds the model results
+    @param extra  Anything else the response depends on
+    @returns  The ETag, or None if the request changes the saved scenarios
+              or the results are different every time (unseeded noise)
+    """
+    if manageInputs.changed():
+        return None
+    scenario_inputs = manageInputs.get()
+    if shows_results and not all(
+        is_cacheable(scenario_inputs[sid]) for sid in ids_to_plot
+    ):
+        return None
+    return page_etag(
+        scenario_inputs, ids_to_plot, makePlots.selections(), cache_version(), *extra
+    )
+
+
+def conditional_response(request: HttpRequest, etag: str | None) -> HttpResponse | None:
+    """
+    Return a 304 Not Modified response if the browser already has the
+    response with this ETag
+    @param request  The HttpRequest
+    @param etag  The ETag of the response, or None if it can't be cached
+    @returns  The 304 response, or None if the response must be made
+    """
+    if etag is None:
+        return None
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        return None
+    return set_cache_headers(request, response, etag)
+
+
+def set_cache_headers(
+    request: HttpRequest, response: HttpResponse, etag: str | None
+) -> HttpResponse:
+    """
+    Set the ETag and the caching headers of a response. Responses depend
+    on the saved scenarios, so they vary with the session cookie, and are
+    only cached by shared caches when the request had no cookies.
+    @param request  The HttpRequest
+    @param response  The HttpResponse
+    @param etag  The ETag of the response, or None if it can't be cached
+    @returns  The response
+    """
+    patch_vary_headers(response, ["Cookie"])
+    if etag is None:
+        add_never_cache_headers(response)
+        return response
+    response["ETag"] = etag
+    if request.COOKIES:
+        patch_cache_control(response, private=True)
+    else:
+        patch_cache_control(response, public=True)
+    patch_cache_control(response, max_age=getattr(settings, "CAMBIO_HTTP_MAX_AGE", 0))
+    return response
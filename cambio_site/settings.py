@@ -61,6 +61,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    "cambio.middleware.ServerTimingMiddleware",
+    "cambio.middleware.ProfilingMiddleware",
+    "cambio.middleware.MetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -102,6 +105,9 @@ DATABASES = {
     }
 }
 
+# Run the tests with the shared stores in a temporary directory
+TEST_RUNNER = "cambio_site.test_runner.TestRunner"
+
 
 # Password validation
 # https://docs.djangoproject.com/en/4.1/ref/settings/#auth-password-validators
@@ -143,6 +149,102 @@ STATIC_ROOT = BASE_DIR / "static"
 
 STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
 
+# Memory budget for cached model results, in bytes per process
+CAMBIO_RESULT_CACHE_BYTES = env.int("CAMBIO_RESULT_CACHE_BYTES", default=32 * 1024**2)
+
+# Model results shared by the worker processes on this machine: the
+# directory (default: under the system temp dir) and its size cap in bytes
+# (0 turns the shared store off)
+CAMBIO_SHARED_CACHE_DIR = env("CAMBIO_SHARED_CACHE_DIR", default=None)
+CAMBIO_SHARED_CACHE_BYTES = env.int(
+    "CAMBIO_SHARED_CACHE_BYTES", default=256 * 1024**2
+)
+
+# Model results saved in the database: the size cap in bytes (0 turns the
+# store off), whether to save them as float32 and compressed, and how many
+# of the most used ones to load when a process starts
+CAMBIO_RESULT_STORE_BYTES = env.int("CAMBIO_RESULT_STORE_BYTES", default=64 * 1024**2)
+CAMBIO_RESULT_STORE_FLOAT32 = env.bool("CAMBIO_RESULT_STORE_FLOAT32", default=False)
+CAMBIO_RESULT_STORE_COMPRESS = env.bool("CAMBIO_RESULT_STORE_COMPRESS", default=True)
+CAMBIO_RESULT_STORE_PRELOAD = env.int("CAMBIO_RESULT_STORE_PRELOAD", default=8)
+
+# Put the SQLite database in WAL mode, so workers reading stored results
+# are not blocked by one writing (this changes the database file, so it is
+# left off outside the Docker image)
+CAMBIO_SQLITE_WAL = env.bool("CAMBIO_SQLITE_WAL", default=False)
+
+# Number of rendered plot panels to keep, per process
+CAMBIO_PANEL_CACHE_SIZE = env.int("CAMBIO_PANEL_CACHE_SIZE", default=256)
+
+# Draw the plots in the browser, from the data view, instead of on the server
+CAMBIO_CLIENT_PLOTS = env.bool("CAMBIO_CLIENT_PLOTS", default=False)
+
+# Serve the async views, which run the model in a pool of
+# CAMBIO_EXECUTOR_WORKERS threads (default: one per core, up to 8) and give
+# up with a 503 after CAMBIO_VIEW_TIMEOUT seconds
+CAMBIO_ASYNC_VIEWS = env.bool("CAMBIO_ASYNC_VIEWS", default=False)
+CAMBIO_EXECUTOR_WORKERS = env.int("CAMBIO_EXECUTOR_WORKERS", default=0)
+CAMBIO_VIEW_TIMEOUT = env.float("CAMBIO_VIEW_TIMEOUT", default=30.0)
+
+# Run requests with at least CAMBIO_PROCESS_POOL_MIN_SCENARIOS scenarios to
+# run in a pool of processes, one per core
+CAMBIO_PROCESS_POOL = env.bool("CAMBIO_PROCESS_POOL", default=False)
+CAMBIO_PROCESS_POOL_MIN_SCENARIOS = env.int(
+    "CAMBIO_PROCESS_POOL_MIN_SCENARIOS", default=8
+)
+
+# Let browsers and proxies keep pages and plot data (whose results are the
+# same every time) for CAMBIO_HTTP_MAX_AGE seconds, and check back with
+# their ETag after that. Changing the model code makes them fetch
+# everything again and sets aside the stored model results; change
+# CAMBIO_CACHE_VERSION to do the same by hand
+CAMBIO_HTTP_MAX_AGE = env.int("CAMBIO_HTTP_MAX_AGE", default=0)
+CAMBIO_CACHE_VERSION = env.str("CAMBIO_CACHE_VERSION", default="")
+
+# Time the phases of each request, adding a Server-Timing header to the
+# response and logging the durations to the cambio.timing logger
+CAMBIO_SERVER_TIMING = env.bool("CAMBIO_SERVER_TIMING", default=False)
+
+# Profile requests with cProfile ("cpu"), tracemalloc ("memory") or
+# "both" (CAMBIO_PROFILE_MODE): every request with CAMBIO_PROFILE, a random
+# CAMBIO_PROFILE_SAMPLE_RATE of them, and, with CAMBIO_PROFILE_SIGNED,
+# those with ?profile=<signature> (see cambio.utils.profiling), which is
+# good for CAMBIO_PROFILE_MAX_AGE seconds. The newest
+# CAMBIO_PROFILE_KEEP profiles are kept in CAMBIO_PROFILE_DIR (default: a
+# cambio-profiles directory in the temporary directory)
+CAMBIO_PROFILE = env.bool("CAMBIO_PROFILE", default=False)
+CAMBIO_PROFILE_SAMPLE_RATE = env.float("CAMBIO_PROFILE_SAMPLE_RATE", default=0.0)
+CAMBIO_PROFILE_SIGNED = env.bool("CAMBIO_PROFILE_SIGNED", default=False)
+CAMBIO_PROFILE_MAX_AGE = env.int("CAMBIO_PROFILE_MAX_AGE", default=3600)
+CAMBIO_PROFILE_MODE = env.str("CAMBIO_PROFILE_MODE", default="cpu")
+CAMBIO_PROFILE_KEEP = env.int("CAMBIO_PROFILE_KEEP", default=50)
+CAMBIO_PROFILE_DIR = env.str("CAMBIO_PROFILE_DIR", default=None)
+
+# Serve counters and histograms of the model and cache activity at
+# /metrics, in the Prometheus text format, adding up the values that each
+# worker process writes to CAMBIO_METRICS_DIR (default: a cambio-metrics
+# directory in the temporary directory)
+CAMBIO_METRICS = env.bool("CAMBIO_METRICS", default=False)
+CAMBIO_METRICS_DIR = env.str("CAMBIO_METRICS_DIR", default=None)
+
+# Run the model for the Default scenario and draw its panels as the app
+# starts, so the first visitor after a cold start does not wait for them
+CAMBIO_WARM_START = env.bool("CAMBIO_WARM_START", default=False)
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {"console": {"class": "logging.StreamHandler"}},
+    "loggers": {
+        "cambio.timing": {"handlers": ["console"], "level": "INFO", "propagate": False},
+        "cambio.startup": {
+            "handlers": ["console"],
+            "level": "INFO",
+            "propagate": False,
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.1/ref/settings/#default-auto-field
 
@@ -0,0 +1,36 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+
+Test runner that keeps the tests out of the directories shared with a
+running server.
+"""
+
+from pathlib import Path
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+
+
+class TestRunner(DiscoverRunner):
+    """
+    The usual test runner, with each shared directory moved into a
+    temporary directory that is removed afterwards
+    """
+
+    # Settings naming shared directories, with the subdirectory to use
+    SHARED_DIRS = {"CAMBIO_SHARED_CACHE_DIR": "results"}
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.tmpdir = tempfile.TemporaryDirectory(prefix="cambio-tests-")
+        self.saved_dirs = {}
+        for name, subdir in self.SHARED_DIRS.items():
+            self.saved_dirs[name] = getattr(settings, name, None)
+            setattr(settings, name, Path(self.tmpdir.name) / subdir)
+
+    def teardown_test_environment(self, **kwargs):
+        for name, directory in self.saved_dirs.items():
+            setattr(settings, name, directory)
+        self.tmpdir.cleanup()
+        super().teardown_test_environment(**kwargs)
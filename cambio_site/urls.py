@@ -22,5 +22,6 @@ from cambio import views
 urlpatterns = [
     path("cambio/", include("cambio.urls")),
     path("admin/", admin.site.urls),
+    path("metrics", views.metrics_view, name="metrics"),
     path("", views.index),
 ]
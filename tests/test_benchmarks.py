@@ -0,0 +1,121 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+"""
+
+import io
+import json
+import os
+import tempfile
+from unittest import mock
+
+from django.contrib.sessions.models import Session
+from django.core.management import CommandError, call_command
+from django.test import TestCase
+
+from benchmarks.loadtest import (
+    SessionCookies,
+    WSGISender,
+    load_requests,
+    peak_rss,
+    run_load,
+)
+from benchmarks import suite
+from benchmarks.suite import compare, regressions
+from cambio_site.wsgi import application
+
+
+class BenchmarkTest(TestCase):
+    """
+    Check the benchmark suite and its comparison with a baseline
+    """
+
+    def test_compare(self):
+        """Benchmarks slower than the threshold are regressions"""
+        baseline = {"results": {"a": {"min": 1.0}, "b": {"min": 1.0}}}
+        results = {"results": {"a": {"min": 1.1}, "b": {"min": 2.0}, "c": {"min": 1}}}
+        rows = compare(results, baseline)
+        self.assertEqual([row[0] for row in rows], ["a", "b"])
+        self.assertEqual(regressions(rows, 0.25), ["b"])
+
+    def test_lazy_setup(self):
+        """Benchmarks left out by the pattern do not run their setup"""
+        with mock.patch.object(suite, "cambio", side_effect=AssertionError):
+            results = suite.run_suite("make_emissions*", min_time=0.001)
+        self.assertEqual(len(results["results"]), 2)
+
+    def test_command(self):
+        """The command saves JSON results and fails on a regression"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        output = os.path.join(tmpdir.name, "bench.json")
+        options = {"pattern": "make_emissions*", "min_time": 0.001}
+
+        call_command("bench", output=output, stdout=io.StringIO(), **options)
+        with open(output, encoding="utf-8") as file:
+            results = json.load(file)
+        self.assertEqual(
+            set(results["results"]),
+            {
+                "make_emissions_scenario_lte[fresh]",
+                "make_emissions_scenario_lte[cached]",
+            },
+        )
+
+        # A baseline that was much faster
+        for timing in results["results"].values():
+            timing["min"] /= 100
+        with open(output, "w", encoding="utf-8") as file:
+            json.dump(results, file)
+        with self.assertRaises(CommandError):
+            call_command("bench", compare=output, stdout=io.StringIO(), **options)
+
+
+class LoadTestTest(TestCase):
+    """
+    Check the load test against the app in this process
+    """
+
+    def test_load_requests(self):
+        """Recorded requests are bare query strings or JSON"""
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+            file.write("# comment\n\n?carbon=ppm\n")
+            file.write('{"query": "temp=F", "cookies": {"Mine": "{}"}}\n')
+        self.addCleanup(os.remove, file.name)
+        requests = load_requests(file.name)
+        self.assertEqual([r.query for r in requests], ["carbon=ppm", "temp=F"])
+        self.assertEqual(requests[1].cookie_header(), "Mine={}")
+
+    def test_run_load(self):
+        """Replayed requests are counted and timed"""
+        requests = load_requests(
+            os.path.join(os.path.dirname(__file__), "..", "benchmarks", "queries.txt")
+        )
+        report = run_load(WSGISender(application), requests, concurrency=2, count=6)
+        self.assertEqual(report["requests"], 6)
+        self.assertEqual(report["statuses"], {"200": 6})
+        self.assertLessEqual(report["latency"]["p50"], report["latency"]["max"])
+        self.assertGreater(peak_rss(), 0)
+
+    def test_sessions_reused(self):
+        """Replayed cookies reuse one session per thread, deleted at the end"""
+        path = os.path.join(os.path.dirname(__file__), "..", "benchmarks")
+        with tempfile.NamedTemporaryFile("w", suffix=".txt", delete=False) as file:
+            file.write('{"query": "", "cookies": {"Mine": "{}"}}\n')
+        self.addCleanup(os.remove, file.name)
+        sessions = SessionCookies()
+        requests = load_requests(file.name)
+        report = run_load(
+            WSGISender(application, sessions), requests, concurrency=1, count=5
+        )
+        self.assertEqual(report["statuses"], {"200": 5})
+        self.assertEqual(len(sessions.keys), 1)
+        self.assertEqual(Session.objects.count(), 1)
+
+        call_command(
+            "loadtest",
+            os.path.join(path, "queries.txt"),
+            count=4,
+            concurrency=2,
+            stdout=io.StringIO(),
+        )
+        self.assertEqual(Session.objects.count(), 1)
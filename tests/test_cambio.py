@@ -1,8 +1,29 @@
-from django.test import TestCase
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from unittest import mock
+
+from django.test import TestCase, override_settings
 from django.urls import reverse
 
 from cambio.utils.schemas import CambioInputs
-from cambio.utils.cambio import cambio
+import numpy as np
+
+from cambio.utils.cambio import cambio, cambio_ensemble
+from cambio.utils.climate_state import ClimateState, PROGNOSTIC_VARS
+from cambio.utils.climate_params import ClimateParams
+from cambio.utils import cambio as cambio_module
+from cambio.utils import kernels
+from cambio.utils import process_pool
+from cambio.utils.checkpoints import CheckpointCache, checkpoint_cache
+from cambio.utils import cambio_utils
+from cambio.utils.cambio_utils import (
+    make_emissions_scenario2,
+    make_emissions_scenario_lte,
+    make_emissions_scenarios_lte,
+    post_peak_flattener,
+)
+from cambio.utils import scalar_diagnostics
+from cambio.utils.scalar_diagnostics import ScalarClimateParams
 
 
 class Test:
@@ -65,6 +86,435 @@ class cambioTestSample(TestCase):
         # self.assertAlmostEqual(climatestate["T_C"][-1],, places=5)
 
 
+class cambioEnsembleTest(TestCase):
+    """
+    Check that running scenarios together gives the same results as
+    running them one at a time
+    """
+
+    def setUp(self):
+        self.inputs = [
+            CambioInputs(),
+            CambioInputs(albedo_feedback=False),
+            CambioInputs(temp_anomaly_feedback=False, transition_year=2080),
+            CambioInputs(albedo_with_no_constraint=True, albedo_transition_temp=1.0),
+            CambioInputs(long_term_emissions=10, flux_al_transition_temp=1.5),
+            CambioInputs(dtime=0.5),
+        ]
+
+    def test_same_as_cambio(self):
+        """Each scenario in the ensemble matches its own cambio run"""
+        with mock.patch.object(cambio_module, "ENSEMBLE_MIN_SCENARIOS", 1):
+            results = cambio_ensemble(self.inputs)
+        self.assertEqual(len(results), len(self.inputs))
+
+        for inputs, (climate, climate_params) in zip(self.inputs, results):
+            expected, expected_params = cambio(inputs)
+            self.assertEqual(climate_params, expected_params)
+            self.assertEqual(set(climate.keys()), set(expected.keys()))
+            for key, value in expected.items():
+                self.assertTrue(np.allclose(climate[key], value, rtol=1e-12), key)
+
+    def test_empty(self):
+        """An empty ensemble gives no results"""
+        self.assertEqual(cambio_ensemble([]), [])
+
+    def test_small_groups(self):
+        """Groups below the crossover are run one scenario at a time"""
+        with mock.patch.object(kernels, "USE_COMPILED_KERNEL", False):
+            with mock.patch.object(cambio_module, "_cambio_ensemble_group") as group:
+                cambio_ensemble(self.inputs)
+                group.assert_not_called()
+                cambio_ensemble([CambioInputs()] * cambio_module.ENSEMBLE_MIN_SCENARIOS)
+                group.assert_called_once()
+
+
+class ClimateStateTest(TestCase):
+    """
+    Check the preallocated climate state
+    """
+
+    def test_views_share_buffer(self):
+        """The climate time series are views into one buffer"""
+        state = ClimateState(5)
+        state.set_initial("C_atm", 615.0)
+        climate = state.climate()
+
+        self.assertEqual(list(climate.keys()), list(PROGNOSTIC_VARS))
+        self.assertEqual(state.buffer.shape, (len(PROGNOSTIC_VARS), 6))
+        for value in climate.values():
+            self.assertEqual(len(value), 5)
+            self.assertTrue(np.shares_memory(value, state.buffer))
+
+        # The starting state is not part of the time series
+        self.assertEqual(state.buffer[0, 0], 615.0)
+        self.assertTrue(np.all(climate["C_atm"] == 0))
+
+    def test_ensemble_views(self):
+        """Each scenario in an ensemble gets its own views"""
+        state = ClimateState(5, 3)
+        state.set_initial("albedo", np.array([0.1, 0.2, 0.3]))
+        state.buffer[:, 2, 1:] = 1.0
+
+        self.assertEqual(state.buffer[2, 1, 0], 0.2)
+        self.assertTrue(np.all(state.climate(2)["T_anomaly"] == 1.0))
+        self.assertTrue(np.all(state.climate(0)["T_anomaly"] == 0.0))
+
+
+class CompiledKernelTest(TestCase):
+    """
+    Check that the compiled kernel matches the step-by-step loop
+    (without Numba the kernel runs as plain Python)
+    """
+
+    def setUp(self):
+        self.inputs = [
+            CambioInputs(),
+            CambioInputs(albedo_feedback=False),
+            CambioInputs(temp_anomaly_feedback=False, transition_year=2080),
+            CambioInputs(albedo_with_no_constraint=True, albedo_transition_temp=1.0),
+            CambioInputs(dtime=0.5),
+            CambioInputs(stochastic_c_atm_std_dev=2.0),
+        ]
+
+        # Make every run start from scratch, so each path is really tested
+        patcher = mock.patch.object(checkpoint_cache, "enabled", False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_cambio(self, inputs, compiled):
+        """Run cambio with a fixed seed, with or without the kernel"""
+        np.random.seed(12)
+        with mock.patch.object(kernels, "USE_COMPILED_KERNEL", compiled):
+            return cambio(inputs)[0]
+
+    def test_same_as_loop(self):
+        """The kernel matches the loop, including the noise"""
+        for inputs in self.inputs:
+            climate = self.run_cambio(inputs, True)
+            expected = self.run_cambio(inputs, False)
+            for key, value in expected.items():
+                self.assertTrue(np.allclose(climate[key], value, rtol=1e-13), key)
+
+    def test_extreme_tipping(self):
+        """Tipping temperatures far out of reach give the NumPy limits"""
+        for inputs in (
+            CambioInputs(flux_al_transition_temp=1000.0),
+            CambioInputs(albedo_transition_temp=1000.0),
+        ):
+            # The NumPy diagnostics overflow to inf, as they always have
+            with np.errstate(over="ignore"):
+                expected = cambio_ensemble([inputs])[0][0]
+                climates = {c: self.run_cambio(inputs, c) for c in (True, False)}
+            for compiled, climate in climates.items():
+                for key, value in expected.items():
+                    self.assertTrue(
+                        np.allclose(climate[key], value, rtol=1e-12), (key, compiled)
+                    )
+
+    def test_ensemble(self):
+        """The ensemble gives the same results with and without the kernel"""
+        deterministic = self.inputs[:-1]
+        with mock.patch.object(kernels, "USE_COMPILED_KERNEL", True):
+            results = cambio_ensemble(deterministic)
+        with mock.patch.object(kernels, "USE_COMPILED_KERNEL", False):
+            expected = cambio_ensemble(deterministic)
+        for (climate, _), (expected_climate, _) in zip(results, expected):
+            for key, value in expected_climate.items():
+                self.assertTrue(np.allclose(climate[key], value, rtol=1e-13), key)
+
+
+class CheckpointTest(TestCase):
+    """
+    Check that runs resumed from a checkpoint match fresh runs
+    """
+
+    def setUp(self):
+        self.cache = CheckpointCache(interval=10)
+        for patcher in (
+            mock.patch.object(cambio_module, "checkpoint_cache", self.cache),
+            mock.patch.object(kernels, "USE_COMPILED_KERNEL", False),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def run_fresh(self, inputs):
+        """Run cambio without any checkpoints"""
+        with mock.patch.object(self.cache, "enabled", False):
+            return cambio(inputs)[0]
+
+    def test_resume(self):
+        """Changing only the long term emissions resumes from near the peak"""
+        cambio(CambioInputs())
+        inputs = CambioInputs(long_term_emissions=5)
+        climate = cambio(inputs)[0]
+        self.assertEqual(self.cache.hits, 1)
+
+        # The emissions agree up to the peak, so most of the run is reused
+        emissions = climate["F_ha"]
+        ndiffer = np.argmax(emissions != cambio(CambioInputs())[0]["F_ha"])
+        self.assertEqual(self.cache.steps_saved - len(emissions), ndiffer // 10 * 10)
+
+        expected = self.run_fresh(inputs)
+        for key, value in expected.items():
+            self.assertTrue(np.allclose(climate[key], value, rtol=1e-13), key)
+
+    def test_whole_run(self):
+        """Repeating a run reuses all of it"""
+        first = cambio(CambioInputs())[0]
+        second = cambio(CambioInputs())[0]
+        self.assertEqual(self.cache.steps_saved, len(first["year"]))
+        for key, value in first.items():
+            self.assertTrue(np.array_equal(second[key], value), key)
+
+    def test_different_trajectory(self):
+        """Runs with different feedbacks or tipping points share nothing"""
+        cambio(CambioInputs())
+        cambio(CambioInputs(albedo_transition_temp=1.0))
+        cambio(CambioInputs(dtime=0.5))
+        self.assertEqual(self.cache.hits, 0)
+
+    def test_stochastic(self):
+        """Noisy runs are never checkpointed"""
+        cambio(CambioInputs(stochastic_c_atm_std_dev=2.0))
+        cambio(CambioInputs(stochastic_c_atm_std_dev=2.0))
+        self.assertEqual(self.cache.hits + self.cache.misses, 0)
+
+    def test_lru(self):
+        """Only the most recent runs are kept"""
+        self.cache.max_entries = 2
+        for long_term_emissions in (1, 2, 3):
+            cambio(CambioInputs(long_term_emissions=long_term_emissions))
+        self.assertEqual(len(self.cache._entries), 2)
+
+        # The prefixes of the run that was dropped are forgotten, but those
+        # of the runs kept are not
+        owners = set(self.cache._owners.values())
+        self.assertEqual(owners, set(self.cache._entries))
+        hits = self.cache.hits
+        cambio(CambioInputs(long_term_emissions=2.5))
+        self.assertEqual(self.cache.hits, hits + 1)
+
+    def test_tolerance(self):
+        """With a tolerance, emissions that nearly agree are the same"""
+        self.cache.tolerance = 1e-3
+        cambio(CambioInputs())
+        inputs = CambioInputs(long_term_emissions=2.0 + 1e-5)
+        climate = cambio(inputs)[0]
+        self.assertEqual(self.cache.steps_saved, len(climate["year"]))
+
+    def test_compiled(self):
+        """With the compiled kernel, the checkpoints are not used"""
+        with mock.patch.object(kernels, "USE_COMPILED_KERNEL", True):
+            cambio(CambioInputs())
+            cambio(CambioInputs())
+        self.assertEqual(self.cache.hits + self.cache.misses, 0)
+
+
+class ScalarDiagnosticsTest(TestCase):
+    """
+    Check that the math-based diagnostics match the NumPy-based ones
+    """
+
+    def setUp(self):
+        self.array_params = ClimateParams(0.0)
+        self.scalar_params = ScalarClimateParams(0.0)
+        self.temps = [-2.0, 0.0, 1.5, 3.9, 4.0, 6.5]
+
+    def test_sigmoids(self):
+        """sigmafloor, sigmaup and sigmadown"""
+        for temp in self.temps:
+            self.assertAlmostEqual(
+                scalar_diagnostics.sigmafloor(temp, 4.0, 1.0, 0.9),
+                cambio_utils.sigmafloor(temp, 4.0, 1.0, 0.9),
+                places=14,
+            )
+            self.assertAlmostEqual(
+                scalar_diagnostics.sigmaup(2000 + temp, 2040.0, 20.0),
+                cambio_utils.sigmaup(2000 + temp, 2040.0, 20.0),
+                places=14,
+            )
+            self.assertAlmostEqual(
+                scalar_diagnostics.sigmadown(2000 + temp, 2040.0, 20.0),
+                cambio_utils.sigmadown(2000 + temp, 2040.0, 20.0),
+                places=14,
+            )
+
+    def test_sigmoid_limits(self):
+        """Huge exponents give the limits, as NumPy does, not OverflowError"""
+        with np.errstate(over="ignore"):
+            for args in ((0.0, 1000.0, 1.0), (0.0, -1000.0, 1.0)):
+                self.assertEqual(
+                    scalar_diagnostics.sigmafloor(*args, 0.9),
+                    cambio_utils.sigmafloor(*args, 0.9),
+                )
+                self.assertEqual(
+                    scalar_diagnostics.sigmaup(*args), cambio_utils.sigmaup(*args)
+                )
+
+    def test_diagnostics(self):
+        """pH, land flux and albedo, with and without the constraint"""
+        for c_atm in [500.0, 615.0, 900.0]:
+            self.assertAlmostEqual(
+                self.scalar_params.diagnose_ocean_surface_ph(c_atm),
+                self.array_params.diagnose_ocean_surface_ph(c_atm),
+                places=14,
+            )
+        for temp in self.temps:
+            self.assertAlmostEqual(
+                self.scalar_params.diagnose_flux_atm_land(temp, 700.0, 3.9),
+                self.array_params.diagnose_flux_atm_land(temp, 700.0, 3.9),
+                places=12,
+            )
+            for prev_albedo, dtime in [(0, 0), (0.3, 1.0), (0.27, 1.0), (0.3, 0.5)]:
+                self.assertAlmostEqual(
+                    self.scalar_params.diagnose_albedo_w_constraint(
+                        4.0, temp, prev_albedo, dtime
+                    ),
+                    self.array_params.diagnose_albedo_w_constraint(
+                        4.0, temp, prev_albedo, dtime
+                    ),
+                    places=14,
+                )
+
+
+class DiagnosticsTest(TestCase):
+    """
+    Check requesting only some of the diagnostic outputs
+    """
+
+    def test_subset(self):
+        """Only the requested diagnostics are computed, with the same values"""
+        inputs = CambioInputs()
+        expected, _ = cambio(inputs)
+        climate, _ = cambio(inputs, ["pH", "year"])
+
+        self.assertEqual(
+            list(climate.keys()),
+            [
+                "C_atm",
+                "C_ocean",
+                "albedo",
+                "T_anomaly",
+                "pH",
+                "year",
+                "albedo_trans_temp",
+                "flux_al_trans_temp",
+            ],
+        )
+        for key, value in climate.items():
+            self.assertTrue(np.array_equal(value, expected[key]), key)
+
+    def test_ensemble_subset(self):
+        """The ensemble takes the same diagnostics argument"""
+        results = cambio_ensemble([CambioInputs(), CambioInputs(dtime=0.5)], ["F_al"])
+        for climate, _ in results:
+            self.assertIn("F_al", climate)
+            self.assertNotIn("F_oa", climate)
+
+    def test_unknown(self):
+        """Asking for a diagnostic that does not exist is an error"""
+        with self.assertRaises(ValueError):
+            cambio(CambioInputs(), ["F_xx"])
+
+
+class EmissionsScenarioTest(TestCase):
+    """
+    Check the vectorized and cached emissions scenarios
+    """
+
+    def setUp(self):
+        self.time = np.arange(1750.0, 2200.0, 1.0)
+        self.params = [(0.025, 2040.0, 20.0, 2.0), (0.02, 2080.0, 40.0, 8.0)]
+
+    def loop_flattener(self, time, eps, transitiontimeinterval, epslongterm):
+        """The post peak flattener, one year at a time"""
+        ipeak = np.where(eps == np.max(eps))[0][0]
+        neweps = eps.copy()
+        for i in range(ipeak, len(eps)):
+            neweps[i] = epslongterm + np.exp(
+                -((time[i] - time[ipeak]) ** 2) / transitiontimeinterval**2
+            ) * (eps[ipeak] - epslongterm)
+        return neweps
+
+    def test_flattener(self):
+        """The vectorized flattener matches the loop"""
+        for k, t_peak, delta_t, epslongterm in self.params:
+            eps = make_emissions_scenario2(self.time, k, t_peak, delta_t)
+            expected = self.loop_flattener(self.time, eps, delta_t, epslongterm)
+            neweps = post_peak_flattener(self.time, eps, delta_t, epslongterm)
+            self.assertTrue(np.allclose(neweps, expected, rtol=1e-14))
+
+    def test_cached(self):
+        """The same inputs give back the same (read-only) arrays"""
+        time, eps = make_emissions_scenario_lte(1750, 2200, 1, 0.025, 2040, 20, 2)
+        time2, eps2 = make_emissions_scenario_lte(
+            1750.0, 2200.0, 1.0, 0.025, 2040.0, 20.0, 2.0
+        )
+        self.assertIs(eps, eps2)
+        self.assertIs(time, time2)
+        self.assertFalse(eps.flags.writeable)
+
+    def test_batch(self):
+        """Many scenarios at once match one at a time"""
+        params = np.array(self.params)
+        time, eps = make_emissions_scenarios_lte(1750.0, 2200.0, 1.0, *params.T)
+        self.assertEqual(eps.shape, (len(self.params), len(self.time)))
+        for row, param in zip(eps, self.params):
+            _, expected = make_emissions_scenario_lte(1750.0, 2200.0, 1.0, *param)
+            self.assertTrue(np.allclose(row, expected, rtol=1e-14))
+
+
+class ProcessPoolTest(TestCase):
+    """
+    Check that running scenarios in the process pool gives the same results
+    """
+
+    def setUp(self):
+        self.inputs = [
+            CambioInputs(long_term_emissions=long_term_emissions)
+            for long_term_emissions in range(4)
+        ]
+
+    def test_threshold(self):
+        """Only big enough requests use the pool, and only if it is on"""
+        self.assertFalse(process_pool.use_process_pool(100))
+        with override_settings(
+            CAMBIO_PROCESS_POOL=True, CAMBIO_PROCESS_POOL_MIN_SCENARIOS=8
+        ):
+            self.assertFalse(process_pool.use_process_pool(7))
+            self.assertTrue(process_pool.use_process_pool(8))
+
+    def test_same_as_ensemble(self):
+        """Results from the pool match the ensemble in this process"""
+        with mock.patch.object(process_pool, "available_cores", return_value=2):
+            results = process_pool.run_in_process_pool(self.inputs)
+        expected = cambio_ensemble(self.inputs)
+        self.assertEqual(len(results), len(expected))
+        for (climate, params), (expected_climate, expected_params) in zip(
+            results, expected
+        ):
+            self.assertEqual(params, expected_params)
+            for key, value in expected_climate.items():
+                self.assertTrue(np.array_equal(climate[key], value), key)
+
+    def test_failed_chunk(self):
+        """If a chunk fails, the segments of the others are still freed"""
+        failed = Future()
+        failed.set_exception(RuntimeError("chunk failed"))
+        done = Future()
+        done.set_result(process_pool._run_chunk([self.inputs[0].dict()]))
+        pool = mock.Mock()
+        pool.submit.side_effect = [failed, done]
+        with mock.patch.object(
+            process_pool, "get_process_pool", return_value=pool
+        ), mock.patch.object(process_pool, "available_cores", return_value=2):
+            with self.assertRaisesRegex(RuntimeError, "chunk failed"):
+                process_pool.run_in_process_pool(self.inputs[:2])
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name=done.result()[0])
+
+
 # class cambioTest(TestCase):
 #     """
 #     Testing the cambio climate model
@@ -1,7 +1,12 @@
+from unittest import mock
+
 from django.test import TestCase
 import numpy as np
 
-from cambio.utils.make_plots import get_years_to_plot
+from cambio.utils import make_plots
+from cambio.utils.make_plots import MakePlots, PanelCache, get_years_to_plot
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.view_utils import run_model_for_dict
 
 
 class GetYearsToPlotTestCase(TestCase):
@@ -53,3 +58,57 @@ class GetYearsToPlotTestCase(TestCase):
         # overlapping low end
         iyear = get_years_to_plot(self.year, (1600.0, 1703.0))
         self.assertTrue(np.allclose(iyear, np.array([0, 1, 2, 3])))
+
+
+class PanelCacheTest(TestCase):
+    """
+    Check that rendered panels are reused
+    """
+
+    def setUp(self):
+        self.cache = PanelCache()
+        patcher = mock.patch.object(
+            make_plots, "get_panel_cache", return_value=self.cache
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scenarios = run_model_for_dict(
+            {"Default": CambioInputs(), "Mine": CambioInputs(long_term_emissions=4)}
+        )
+
+    def make(self, inputs, scenario_ids):
+        """Make the plots, returning them and the number of panels rendered"""
+        scenarios = [dict(self.scenarios[sid]) for sid in scenario_ids]
+        with mock.patch.object(
+            MakePlots, "plot_panel", autospec=True, side_effect=MakePlots.plot_panel
+        ) as plot_panel:
+            plot_stuff = MakePlots(inputs).make(scenarios)
+        return plot_stuff, plot_panel.call_count
+
+    def test_reuse(self):
+        """The same request renders nothing the second time"""
+        first, nrendered = self.make({}, ["Default"])
+        self.assertEqual(nrendered, 5)
+        second, nrendered = self.make({}, ["Default"])
+        self.assertEqual(nrendered, 0)
+        for panel, values in first.items():
+            self.assertEqual(second[panel]["plot"], values["plot"])
+
+    def test_unit(self):
+        """Changing the unit of one panel renders only that panel"""
+        self.make({}, ["Default"])
+        _, nrendered = self.make({"carbon": "ppm"}, ["Default"])
+        self.assertEqual(nrendered, 1)
+
+    def test_scenarios(self):
+        """Changing the scenarios or their order renders every panel"""
+        self.make({}, ["Default", "Mine"])
+        _, nrendered = self.make({}, ["Mine", "Default"])
+        self.assertEqual(nrendered, 5)
+
+    def test_uncacheable(self):
+        """Results without a hash are always rendered"""
+        self.scenarios["Default"]["result_hash"] = None
+        self.make({}, ["Default"])
+        _, nrendered = self.make({}, ["Default"])
+        self.assertEqual(nrendered, 5)
@@ -0,0 +1,152 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+"""
+
+import json
+from pathlib import Path
+import subprocess
+import sys
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from cambio.utils import kernels, metrics
+from cambio.utils.cambio import cambio
+from cambio.utils.checkpoints import checkpoint_cache
+from cambio.utils.schemas import CambioInputs
+
+
+class MetricsTest(TestCase):
+    """
+    Check the metrics and their sums over the worker processes
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = Path(tmpdir.name)
+
+    def test_render(self):
+        """Counters and histograms are formatted as Prometheus expects"""
+        counter = metrics.Counter("test_events_total", "Events", ["kind"])
+        histogram = metrics.Histogram("test_seconds", "Times", buckets=(0.1, 1.0))
+        self.addCleanup(metrics._registry.pop, "test_events_total")
+        self.addCleanup(metrics._registry.pop, "test_seconds")
+        counter.inc(kind='a"b')
+        counter.inc(2, kind='a"b')
+        for value in (0.05, 0.5, 5):
+            histogram.observe(value)
+
+        metrics.flush(self.directory)
+        text = metrics.render(metrics.aggregate(self.directory))
+        self.assertIn("# TYPE test_events_total counter", text)
+        self.assertIn('test_events_total{kind="a\\"b"} 3', text)
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 2', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 3', text)
+        self.assertIn("test_seconds_sum 5.55", text)
+        self.assertIn("test_seconds_count 3", text)
+
+    def test_workers(self):
+        """The values written by every process are added up"""
+        metrics.flush(self.directory)
+        mine = metrics.aggregate(self.directory)
+        scenarios = mine["cambio_model_scenarios_total"]["samples"].get((), 0)
+
+        # Another worker's file
+        other = metrics.snapshot()
+        other["cambio_model_scenarios_total"]["samples"] = [[{}, 5]]
+        (self.directory / "1-other.json").write_text(json.dumps(other))
+
+        totals = metrics.aggregate(self.directory)
+        self.assertEqual(
+            totals["cambio_model_scenarios_total"]["samples"][()], scenarios + 5
+        )
+
+    def test_dead_workers(self):
+        """The values of processes that have exited are archived, not lost"""
+        process = subprocess.run(
+            [sys.executable, "-c", "import os; print(os.getpid())"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        dead = metrics.snapshot()
+        dead["cambio_model_scenarios_total"]["samples"] = [[{}, 5]]
+        path = self.directory / f"{process.stdout.strip()}-dead.json"
+        path.write_text(json.dumps(dead))
+        metrics.flush(self.directory)
+
+        def scenarios():
+            totals = metrics.aggregate(self.directory)
+            return totals["cambio_model_scenarios_total"]["samples"][()]
+
+        before = scenarios()
+        self.assertFalse(path.exists())
+        self.assertTrue((self.directory / metrics.ARCHIVE_FILE).exists())
+        self.assertEqual(scenarios(), before)
+
+        # This process exits, and its values are archived too
+        metrics.MODEL_SCENARIOS.inc(2)
+        metrics.archive_file()
+        self.assertEqual(scenarios(), before + 2)
+        self.assertEqual(
+            list(self.directory.glob("*.json")),
+            [self.directory / metrics.ARCHIVE_FILE],
+        )
+
+    def test_steps_by_path(self):
+        """Time steps are counted by the code that integrated them"""
+        for compiled, method in ((True, "compiled"), (False, "python")):
+            before = metrics.MODEL_STEPS.values.get((method,), 0)
+            with mock.patch.object(
+                kernels, "USE_COMPILED_KERNEL", compiled
+            ), mock.patch.object(checkpoint_cache, "enabled", False):
+                climate, _ = cambio(CambioInputs())
+            steps = metrics.MODEL_STEPS.values[(method,)] - before
+            self.assertEqual(steps, len(climate["year"]))
+
+    def test_reset(self):
+        """A forked process starts from zero"""
+        counter = metrics.Counter("test_reset_total", "Events")
+        self.addCleanup(metrics._registry.pop, "test_reset_total")
+        counter.inc(3)
+        metrics.reset()
+        self.assertEqual(counter.values, {})
+        for labels, count in metrics.cache_samples():
+            self.assertEqual(count, 0, labels)
+
+    def test_endpoint(self):
+        """The endpoint serves the metrics, only when turned on"""
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 404)
+
+        metrics.reset()
+        with override_settings(
+            CAMBIO_METRICS=True, CAMBIO_METRICS_DIR=str(self.directory)
+        ):
+            self.client.get(reverse("index"), {"plot_scenario_Default": "on"})
+            self.client.get(reverse("data"), {"plot_scenario_Default": "on"})
+            response = self.client.get(reverse("metrics"))
+        self.assertTrue(response["Content-Type"].startswith("text/plain"))
+        text = response.content.decode()
+        for line in (
+            'cambio_request_scenarios_bucket{le="1.0"}',
+            "cambio_html_bytes_total ",
+            'cambio_panel_seconds_count{panel="carbon"}',
+            'cambio_cache_events_total{cache="result",event="hits"}',
+            "# TYPE cambio_model_run_seconds histogram",
+            # The page and its data are one page load
+            "cambio_request_scenarios_count 1\n",
+        ):
+            self.assertIn(line, text)
+
+    def test_flush_interval(self):
+        """Requests write the values at most every FLUSH_INTERVAL seconds"""
+        with override_settings(
+            CAMBIO_METRICS=True, CAMBIO_METRICS_DIR=str(self.directory)
+        ), mock.patch.object(metrics, "flush", wraps=metrics.flush) as flush:
+            for _ in range(3):
+                self.client.get(reverse("index"))
+        self.assertLessEqual(flush.call_count, 1)
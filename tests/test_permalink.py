@@ -0,0 +1,127 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+"""
+
+from django.test import TestCase
+from django.urls import reverse
+
+from cambio.utils.permalink import MAX_SCENARIOS, decode_scenarios, encode_scenarios
+from cambio.utils.result_cache import inputs_hash
+from cambio.utils.schemas import CambioInputs
+
+
+class PermalinkTest(TestCase):
+    """
+    Check that scenarios survive a trip through a permalink token
+    """
+
+    def test_round_trip(self):
+        """Decoding a token gives back the same scenarios, in order"""
+        scenarios = {
+            "Default": CambioInputs(),
+            "Früh": CambioInputs(transition_year=2030.5, albedo_feedback=False),
+            "Noisy": CambioInputs(stochastic_c_atm_std_dev=0.1, random_seed=3),
+        }
+        decoded = decode_scenarios(encode_scenarios(scenarios))
+        self.assertEqual(list(decoded), list(scenarios))
+        for scenario_id, inputs in scenarios.items():
+            self.assertEqual(decoded[scenario_id].dict(), inputs.dict())
+            self.assertEqual(inputs_hash(decoded[scenario_id]), inputs_hash(inputs))
+
+    def test_compact(self):
+        """The default scenario takes only a few bytes"""
+        self.assertLessEqual(len(encode_scenarios({"Default": CambioInputs()})), 16)
+
+    def test_invalid(self):
+        """Tokens that are not valid raise ValueError"""
+        token = encode_scenarios({"Mine": CambioInputs(long_term_emissions=3)})
+        for bad in ("!!", token[:-4], "Ag"):
+            with self.assertRaises(ValueError, msg=bad):
+                decode_scenarios(bad)
+
+    def test_invalid_inputs(self):
+        """Tokens with inputs that would not validate raise ValueError"""
+        for changes in ({"dtime": 0.0}, {"long_term_emissions": float("nan")}):
+            inputs = CambioInputs.construct(**dict(CambioInputs().dict(), **changes))
+            with self.assertRaises(ValueError, msg=changes):
+                decode_scenarios(encode_scenarios({"Bad": inputs}))
+
+    def test_decoded_types(self):
+        """Decoded inputs have the types pydantic would give them"""
+        inputs = CambioInputs(stochastic_c_atm_std_dev=0.5, random_seed=2**63 - 1)
+        decoded = decode_scenarios(encode_scenarios({"Big": inputs}))["Big"]
+        self.assertEqual(decoded.dict(), inputs.dict())
+        self.assertEqual(decoded, CambioInputs(**decoded.dict()))
+
+    def test_too_many(self):
+        """Tokens hold at most MAX_SCENARIOS scenarios"""
+        scenarios = {str(i): CambioInputs() for i in range(MAX_SCENARIOS + 1)}
+        with self.assertRaises(ValueError):
+            encode_scenarios(scenarios)
+        token = encode_scenarios(dict(list(scenarios.items())[:MAX_SCENARIOS]))
+        extra = encode_scenarios({"extra": CambioInputs()})
+        with self.assertRaises(ValueError):
+            decode_scenarios(token + extra[2:])
+
+    def test_long_name(self):
+        """Long names are cut short at a whole character"""
+        name = "é" * 200
+        decoded = decode_scenarios(encode_scenarios({name: CambioInputs()}))
+        self.assertEqual(list(decoded), ["é" * 127])
+
+    def test_view(self):
+        """The page shows and plots the scenarios in a permalink"""
+        token = encode_scenarios({"Mine": CambioInputs(long_term_emissions=3)})
+        response = self.client.get(reverse("index"), {"s": token})
+        self.assertEqual(response.context["plot_scenario_ids"], ["Mine"])
+        inputs = response.context["old_scenario_inputs"]["Mine"]
+        self.assertEqual(inputs["long_term_emissions"], 3)
+
+        # The page links to its own scenarios
+        permalink = decode_scenarios(response.context["permalink"])
+        self.assertEqual(list(permalink), ["Default", "Mine"])
+
+    def test_view_read_only(self):
+        """A permalink is shown without saving it, so the page can be cached"""
+        self.client.get(
+            reverse("index"),
+            {"add_button": "add", "scenario_name": "Mine", "long_term_emissions": "5"},
+        )
+        token = encode_scenarios({"Mine": CambioInputs(long_term_emissions=3)})
+        response = self.client.get(reverse("index"), {"s": token})
+        self.assertEqual(
+            response.context["old_scenario_inputs"]["Mine"]["long_term_emissions"], 3
+        )
+        self.assertNotIn("sessionid", response.cookies)
+        self.assertIn("ETag", response)
+
+        # The visitor's own scenario of the same name is left alone
+        response = self.client.get(reverse("index"))
+        self.assertEqual(
+            response.context["old_scenario_inputs"]["Mine"]["long_term_emissions"], 5
+        )
+
+        # Without cookies, the page can be kept by shared caches
+        self.client.cookies.clear()
+        response = self.client.get(reverse("index"), {"s": token})
+        self.assertIn("public", response["Cache-Control"])
+
+    def test_big_seed(self):
+        """A seed too big for a token does not break the page"""
+        params = {
+            "add_button": "add",
+            "scenario_name": "Noisy",
+            "stochastic_c_atm_std_dev": "0.5",
+            "random_seed": "100000000000000000000",
+        }
+        self.assertEqual(self.client.get(reverse("index"), params).status_code, 200)
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+        decoded = decode_scenarios(response.context["permalink"])
+        self.assertIsNone(decoded["Noisy"].random_seed)
+
+    def test_bad_token(self):
+        """A bad token is ignored"""
+        response = self.client.get(reverse("index"), {"s": "!!"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.context["plot_scenario_ids"], ["Default"])
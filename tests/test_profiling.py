@@ -0,0 +1,97 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+"""
+
+import json
+from pathlib import Path
+import pstats
+import tempfile
+import time
+from unittest import mock
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from cambio.middleware import ProfilingMiddleware
+from cambio.utils.profiling import profile_signature
+from cambio.utils.result_cache import inputs_hash
+from cambio.utils.schemas import CambioInputs
+
+
+class ProfilingTest(TestCase):
+    """
+    Check that requests are profiled when asked and the dumps are rotated
+    """
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.directory = tmpdir.name
+        settings = override_settings(CAMBIO_PROFILE_DIR=self.directory)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def summaries(self):
+        """Return the summaries in the dump directory, oldest first"""
+        return sorted(Path(self.directory).glob("*.json"))
+
+    def test_off(self):
+        """Without any of the settings, the middleware is not used"""
+        with self.assertRaises(MiddlewareNotUsed):
+            ProfilingMiddleware(lambda request: None)
+
+    @override_settings(CAMBIO_PROFILE=True, CAMBIO_PROFILE_MODE="both")
+    def test_profile(self):
+        """Profiles carry the scenario hashes and the top allocations"""
+        self.client.get(reverse("index"), {"plot_scenario_Default": "on"})
+        (summary,) = self.summaries()
+        info = json.loads(summary.read_text())
+        self.assertEqual(info["status"], 200)
+        self.assertEqual(
+            info["scenario_hashes"], {"Default": inputs_hash(CambioInputs())}
+        )
+        self.assertTrue(info["top_allocations"])
+        stats = pstats.Stats(str(summary.with_suffix(".prof")))
+        self.assertGreater(stats.total_calls, 0)
+        self.assertTrue(summary.with_suffix(".snapshot").exists())
+
+    @override_settings(CAMBIO_PROFILE=True, CAMBIO_PROFILE_KEEP=2)
+    def test_rotate(self):
+        """Only the newest dumps are kept"""
+        for _ in range(3):
+            self.client.get(reverse("index"))
+        self.assertEqual(len(self.summaries()), 2)
+
+    @override_settings(CAMBIO_PROFILE_SIGNED=True)
+    def test_signed(self):
+        """Only requests with a valid signature are profiled"""
+        self.client.get(reverse("index"))
+        self.client.get(reverse("index"), {"profile": "forged"})
+        self.assertEqual(len(self.summaries()), 0)
+
+        signature = profile_signature(reverse("index"))
+        self.client.get(reverse("index"), {"profile": signature})
+        self.assertEqual(len(self.summaries()), 1)
+
+    @override_settings(CAMBIO_PROFILE_SIGNED=True, CAMBIO_PROFILE_MAX_AGE=60)
+    def test_signed_query(self):
+        """Signatures are for the query string too, and expire"""
+        signature = profile_signature(reverse("index"), "carbon=ppm")
+        self.client.get(reverse("index"), {"profile": signature})
+        self.client.get(reverse("index"), {"carbon": "GtC", "profile": signature})
+        self.assertEqual(len(self.summaries()), 0)
+
+        with mock.patch("time.time", return_value=time.time() + 120):
+            self.client.get(reverse("index"), {"carbon": "ppm", "profile": signature})
+        self.assertEqual(len(self.summaries()), 0)
+
+        self.client.get(reverse("index"), {"carbon": "ppm", "profile": signature})
+        self.assertEqual(len(self.summaries()), 1)
+
+    @override_settings(CAMBIO_PROFILE=True, CAMBIO_METRICS=True)
+    def test_skipped(self):
+        """Static files and /metrics are not profiled"""
+        self.client.get(reverse("metrics"))
+        self.client.get("/static/cambio/missing.css")
+        self.assertEqual(len(self.summaries()), 0)
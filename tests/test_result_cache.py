@@ -0,0 +1,321 @@
+"""
+By Penny Rowe and Daniel Neshyba-Rowe
+"""
+
+import os
+import tempfile
+from unittest import mock
+
+from django.test import TestCase, override_settings
+import numpy as np
+
+from cambio.models import StoredResult
+from cambio.utils import persistent_store, result_cache, shared_store
+from cambio.utils.cambio import cambio
+from cambio.utils.result_cache import (
+    ResultCache,
+    climate_nbytes,
+    freeze_climate,
+    inputs_hash,
+    is_cacheable,
+)
+from cambio.utils.persistent_store import (
+    PersistentResultStore,
+    decode_climate,
+    encode_climate,
+)
+from cambio.utils.schemas import CambioInputs
+from cambio.utils.shared_store import SharedResultStore, pack_climate, unpack_climate
+from cambio.utils.view_utils import run_model_for_dict
+
+
+class InputsHashTest(TestCase):
+    """
+    Check that equivalent inputs hash the same and others do not
+    """
+
+    def test_equivalent(self):
+        """Inputs that parse to the same values share a hash"""
+        self.assertEqual(inputs_hash(CambioInputs()), inputs_hash(CambioInputs()))
+        self.assertEqual(
+            inputs_hash(CambioInputs(transition_year=2040)),
+            inputs_hash(CambioInputs.from_dict({"transition_year": "2040.0"})),
+        )
+
+    def test_different(self):
+        """Changing any input changes the hash"""
+        self.assertNotEqual(
+            inputs_hash(CambioInputs()),
+            inputs_hash(CambioInputs(long_term_emissions=3)),
+        )
+        self.assertNotEqual(
+            inputs_hash(CambioInputs()),
+            inputs_hash(CambioInputs(albedo_feedback=False)),
+        )
+
+    def test_version(self):
+        """A new model or cache version changes the hash"""
+        before = inputs_hash(CambioInputs())
+        with override_settings(CAMBIO_CACHE_VERSION="2"):
+            self.assertNotEqual(inputs_hash(CambioInputs()), before)
+        with mock.patch.object(result_cache, "model_fingerprint", return_value="x"):
+            self.assertNotEqual(inputs_hash(CambioInputs()), before)
+
+    def test_large_seeds(self):
+        """Large seeds are hashed exactly, and seeds must fit in 64 bits"""
+        self.assertNotEqual(
+            inputs_hash(CambioInputs(random_seed=2**53)),
+            inputs_hash(CambioInputs(random_seed=2**53 + 1)),
+        )
+        for seed in (-1, 2**63):
+            with self.assertRaises(ValueError):
+                CambioInputs(random_seed=seed)
+
+    def test_cacheable(self):
+        """Stochastic runs are cacheable only when seeded"""
+        self.assertTrue(is_cacheable(CambioInputs()))
+        self.assertFalse(is_cacheable(CambioInputs(stochastic_c_atm_std_dev=1)))
+        self.assertTrue(
+            is_cacheable(CambioInputs(stochastic_c_atm_std_dev=1, random_seed=3))
+        )
+
+
+class ResultCacheTest(TestCase):
+    """
+    Check the LRU eviction and the counters of the result cache
+    """
+
+    def setUp(self):
+        self.climate = freeze_climate(cambio(CambioInputs())[0])
+        self.nbytes = climate_nbytes(self.climate)
+
+    def test_get(self):
+        """Hits give read-only copies that can be added to"""
+        cache = ResultCache()
+        self.assertIsNone(cache.get("a"))
+        cache.put("a", self.climate)
+        climate = cache.get("a")
+        climate["scenario_id"] = "mine"
+        self.assertNotIn("scenario_id", cache.get("a"))
+        self.assertFalse(climate["C_atm"].flags.writeable)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+
+    def test_eviction(self):
+        """The least recently used results go first to stay in budget"""
+        cache = ResultCache(max_bytes=2 * self.nbytes)
+        cache.put("a", self.climate)
+        cache.put("b", self.climate)
+        cache.get("a")
+        cache.put("c", self.climate)
+        self.assertIn("a", cache)
+        self.assertNotIn("b", cache)
+        self.assertEqual(cache.evictions, 1)
+        self.assertEqual(cache.nbytes, 2 * self.nbytes)
+
+    def test_too_big(self):
+        """Results bigger than the whole budget are not kept"""
+        cache = ResultCache(max_bytes=self.nbytes - 1)
+        cache.put("a", self.climate)
+        self.assertEqual(len(cache), 0)
+
+
+class RunModelCacheTest(TestCase):
+    """
+    Check that run_model_for_dict reuses cached results
+    """
+
+    def setUp(self):
+        self.cache = ResultCache()
+        for name, value in [
+            ("get_result_cache", self.cache),
+            ("get_shared_store", None),
+            ("get_persistent_store", None),
+        ]:
+            patcher = mock.patch.object(result_cache, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_shared(self):
+        """Identical scenarios with different names share one entry"""
+        scenarios = run_model_for_dict(
+            {"Default": CambioInputs(), "Mine": CambioInputs()}
+        )
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(scenarios["Mine"]["scenario_id"], "Mine")
+        self.assertEqual(scenarios["Default"]["scenario_id"], "Default")
+
+        again = run_model_for_dict({"Default": CambioInputs()})
+        self.assertEqual(self.cache.hits, 1)
+        for key, value in scenarios["Default"].items():
+            self.assertTrue(np.array_equal(again["Default"][key], value), key)
+
+    def test_stochastic(self):
+        """Unseeded stochastic runs are rerun; seeded ones are reused"""
+        noisy = CambioInputs(stochastic_c_atm_std_dev=2.0)
+        seeded = CambioInputs(stochastic_c_atm_std_dev=2.0, random_seed=7)
+        first = run_model_for_dict({"noisy": noisy, "seeded": seeded})
+        second = run_model_for_dict({"noisy": noisy, "seeded": seeded})
+        self.assertEqual(len(self.cache), 1)
+        self.assertFalse(
+            np.array_equal(first["noisy"]["C_atm"], second["noisy"]["C_atm"])
+        )
+        self.assertTrue(
+            np.array_equal(first["seeded"]["C_atm"], second["seeded"]["C_atm"])
+        )
+
+    def test_seed_reproducible(self):
+        """A seeded run gives the same results without the cache"""
+        seeded = CambioInputs(stochastic_c_atm_std_dev=2.0, random_seed=7)
+        cached = run_model_for_dict({"seeded": seeded})["seeded"]
+        fresh = cambio(seeded)[0]
+        self.assertTrue(np.allclose(cached["C_atm"], fresh["C_atm"], rtol=1e-13))
+
+
+class SharedStoreTest(TestCase):
+    """
+    Check the result store shared by the worker processes
+    """
+
+    def setUp(self):
+        self.climate = cambio(CambioInputs())[0]
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.store = SharedResultStore(tmpdir.name)
+
+    def assert_same_climate(self, climate, expected):
+        """Check that two climates have the same arrays"""
+        expected = freeze_climate(expected)
+        self.assertEqual(set(climate.keys()), set(expected.keys()))
+        for key, value in expected.items():
+            self.assertTrue(np.array_equal(climate[key], value), key)
+
+    def test_pack(self):
+        """Packing and unpacking gives back the same arrays"""
+        self.assert_same_climate(
+            unpack_climate(pack_climate(self.climate)), self.climate
+        )
+
+    def test_get(self):
+        """Stored results are mapped back read-only"""
+        self.assertIsNone(self.store.get("a"))
+        self.store.put("a", self.climate)
+        climate = self.store.get("a")
+        self.assert_same_climate(climate, self.climate)
+        self.assertFalse(climate["C_atm"].flags.writeable)
+        self.assertEqual((self.store.hits, self.store.misses), (1, 1))
+
+    def test_prune(self):
+        """The least recently used files go first to stay under the cap"""
+        self.store.put("a", self.climate)
+        self.store.max_bytes = 2 * os.path.getsize(self.store.path("a"))
+        os.utime(self.store.path("a"), (1, 1))
+        self.store.put("b", self.climate)
+        self.store.put("c", self.climate)
+        self.assertFalse(self.store.path("a").exists())
+        self.assertTrue(self.store.path("c").exists())
+
+    def test_prune_over_cap(self):
+        """The directory is only scanned again when over the cap"""
+        self.store.put("a", self.climate)
+        with mock.patch.object(self.store, "prune") as prune:
+            self.store.put("b", self.climate)
+            prune.assert_not_called()
+            self.store.max_bytes = self.store.nbytes
+            self.store.put("c", self.climate)
+            prune.assert_called_once()
+
+    def test_settings(self):
+        """A new store is started when its settings change"""
+        with override_settings(CAMBIO_SHARED_CACHE_DIR=self.store.directory):
+            store = shared_store.get_shared_store()
+            self.assertEqual(store.directory, self.store.directory)
+            self.assertIs(shared_store.get_shared_store(), store)
+            with override_settings(CAMBIO_SHARED_CACHE_BYTES=1000):
+                self.assertEqual(shared_store.get_shared_store().max_bytes, 1000)
+            with override_settings(CAMBIO_SHARED_CACHE_BYTES=0):
+                self.assertIsNone(shared_store.get_shared_store())
+
+    def test_other_worker(self):
+        """Results saved by one process are found by another"""
+        cache = ResultCache()
+        with mock.patch.object(
+            result_cache, "get_shared_store", return_value=self.store
+        ):
+            with mock.patch.object(
+                result_cache, "get_result_cache", return_value=cache
+            ):
+                result_cache.save_result("a", self.climate)
+            with mock.patch.object(
+                result_cache, "get_result_cache", return_value=ResultCache()
+            ):
+                climate = result_cache.lookup_result("a")
+        self.assert_same_climate(climate, self.climate)
+        self.assertEqual(self.store.hits, 1)
+
+
+class PersistentStoreTest(TestCase):
+    """
+    Check the result store in the database
+    """
+
+    def setUp(self):
+        self.climate = freeze_climate(cambio(CambioInputs())[0])
+        self.store = PersistentResultStore()
+
+    def test_encode(self):
+        """Results come back the same, or to float32 precision"""
+        for float32 in (False, True):
+            for compress in (False, True):
+                climate = decode_climate(
+                    *encode_climate(self.climate, float32, compress)
+                )
+                for key, value in self.climate.items():
+                    self.assertEqual(climate[key].dtype, value.dtype)
+                    rtol = 1e-7 if float32 else 0
+                    self.assertTrue(np.allclose(climate[key], value, rtol=rtol), key)
+
+    def test_get(self):
+        """Stored results can be read back and count their uses"""
+        self.assertIsNone(self.store.get("a"))
+        self.store.put("a", self.climate)
+        self.store.put("b", self.climate)
+        self.store.get("b")
+        climate = self.store.get("b")
+        for key, value in self.climate.items():
+            self.assertTrue(np.array_equal(climate[key], value), key)
+        self.assertEqual([key for key, _ in self.store.popular(1)], ["b"])
+
+    def test_get_does_not_write(self):
+        """Uses are counted in memory and written together later"""
+        self.store.put("a", self.climate)
+        with self.assertNumQueries(2):
+            self.store.get("a")
+            self.store.get("a")
+        self.assertEqual(StoredResult.objects.get(key="a").hits, 0)
+        with mock.patch.object(persistent_store, "HITS_FLUSH_INTERVAL", 0):
+            self.store.get("a")
+        self.assertEqual(StoredResult.objects.get(key="a").hits, 3)
+
+    def test_prune(self):
+        """The least recently used results go first to stay under the cap"""
+        data, _ = encode_climate(self.climate)
+        self.store.max_bytes = 2 * len(data)
+        for key in ("a", "b", "c"):
+            self.store.put(key, self.climate)
+        self.assertIsNone(self.store.get("a"))
+        self.assertIsNotNone(self.store.get("c"))
+
+    def test_preload(self):
+        """A new process starts with the most popular results in memory"""
+        self.store.put("a", self.climate)
+        cache = ResultCache()
+        with mock.patch.multiple(
+            result_cache,
+            _preloaded=False,
+            get_result_cache=mock.Mock(return_value=cache),
+            get_shared_store=mock.Mock(return_value=None),
+            get_persistent_store=mock.Mock(return_value=self.store),
+        ):
+            climate = result_cache.lookup_result("a")
+        self.assertIsNotNone(climate)
+        self.assertEqual((cache.hits, self.store.hits), (1, 0))
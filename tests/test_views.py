@@ -3,10 +3,29 @@ By Penny Rowe and Daniel Neshyba-Rowe
 2022/12/21
 """
 
-from django.test import TestCase
+import asyncio
+import base64
+import tempfile
+import time
+from unittest import mock
+
+from asgiref.sync import iscoroutinefunction
+from django.http import HttpResponse
+from django.test import RequestFactory, TestCase, override_settings
 from django.urls import reverse
+import numpy as np
 import requests
 
+from cambio.utils.cambio import cambio
+from cambio.utils.make_plots import get_panel_cache, gtc_to_ppm
+from cambio.utils.schemas import CambioInputs
+from cambio import views
+from cambio.middleware import (
+    MetricsMiddleware,
+    ProfilingMiddleware,
+    ServerTimingMiddleware,
+)
+from cambio.utils import async_utils, result_cache, timing, view_utils, warmup
 from cambio.views import index
 
 
@@ -144,6 +163,7 @@ class IndexViewTest(TestCase):
                 "stop_year": 2200.0,
                 "dtime": 1.0,
                 "inv_time_constant": 0.025,
+                "random_seed": None,
             }
         }
         # "albedo_with_no_constraint": False,
@@ -211,3 +231,355 @@ class IndexViewTest(TestCase):
         self.assertEqual(response.context["inputs"], expected_inputs)
         self.assertEqual(response.context["plot_scenario_choices"], plot_scen_choices)
         self.assertEqual(response.context["plot_scenario_ids"], ["Default"])
+
+
+class DataViewTest(TestCase):
+    """
+    Testing the view that returns the plot data as JSON
+    """
+
+    def decode(self, array):
+        """Decode an array from the data view"""
+        self.assertEqual(array["dtype"], "float32")
+        return np.frombuffer(base64.b64decode(array["data"]), "<f4")
+
+    def test_default(self):
+        """The data view gives the traces for every panel of the default"""
+        response = self.client.get(reverse("data"), {"carbon": "ppm"})
+        self.assertEqual(response.status_code, 200)
+        panels = response.json()["panels"]
+        self.assertEqual(set(panels.keys()), {"flux", "carbon", "temp", "pH", "albedo"})
+
+        # Atmospheric carbon from 1900 on, converted to ppm
+        trace = panels["carbon"]["traces"][0]
+        self.assertEqual(trace["name"], "Atmospheric: Default")
+        climate = cambio(CambioInputs())[0]
+        inds = climate["year"] >= 1900
+        self.assertTrue(np.array_equal(self.decode(trace["x"]), climate["year"][inds]))
+        expected = gtc_to_ppm(climate["C_atm"][inds])
+        self.assertTrue(np.allclose(self.decode(trace["y"]), expected, rtol=1e-6))
+        self.assertEqual(
+            panels["carbon"]["layout"]["yaxis"]["title"], "Carbon amount  (ppm)"
+        )
+
+    @override_settings(CAMBIO_CLIENT_PLOTS=True)
+    def test_client_plots(self):
+        """With client-side plots, the page has places for the plots only"""
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'id="plot-carbon"')
+        self.assertContains(response, reverse("data"))
+        self.assertEqual(response.context["plot_divs"]["carbon"]["plot"], [])
+
+
+@override_settings(CAMBIO_RESULT_STORE_BYTES=0)
+class AsyncViewTest(TestCase):
+    """
+    Testing the async versions of the views
+    """
+
+    def setUp(self):
+        self.factory = RequestFactory()
+
+    def test_index(self):
+        """The async main page has the same plots as the sync one"""
+        request = self.factory.get("/cambio/", {"plot_scenario_Default": "on"})
+        response = asyncio.run(views.index_async(request))
+        self.assertEqual(response.status_code, 200)
+        expected = views.index(request)
+        self.assertEqual(response.content.count(b"plotly-graph-div"), 5)
+        self.assertEqual(
+            response.content.count(b"plotly-graph-div"),
+            expected.content.count(b"plotly-graph-div"),
+        )
+
+    def test_data(self):
+        """The async data view gives the same data as the sync one"""
+        request = self.factory.get("/cambio/data/", {"temp": "F"})
+        response = asyncio.run(views.data_async(request))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, views.data(request).content)
+
+    def test_concurrent(self):
+        """Independent scenarios run at the same time, identical ones once"""
+        scenario_inputs = {
+            "a": CambioInputs(),
+            "b": CambioInputs(long_term_emissions=5),
+            "c": CambioInputs(),
+        }
+        with mock.patch.object(
+            async_utils, "run_model_for_dict", wraps=async_utils.run_model_for_dict
+        ) as run:
+            scenarios = asyncio.run(
+                async_utils.run_model_for_dict_async(scenario_inputs)
+            )
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual(list(scenarios.keys()), ["a", "b", "c"])
+        self.assertEqual(scenarios["c"]["scenario_id"], "c")
+
+    @override_settings(CAMBIO_VIEW_TIMEOUT=0.01)
+    def test_timeout(self):
+        """Results that take too long give a 503"""
+
+        def slow(scenario_inputs):
+            time.sleep(0.2)
+            return {}
+
+        request = self.factory.get("/cambio/data/")
+        with mock.patch.object(async_utils, "run_model_for_dict", slow):
+            response = asyncio.run(views.data_async(request))
+        self.assertEqual(response.status_code, 503)
+        self.assertIn("Retry-After", response)
+
+
+class LazyScenarioTest(TestCase):
+    """
+    Testing that only the scenarios that are plotted are run
+    """
+
+    def setUp(self):
+        for name in ("one", "two", "three"):
+            inputs = CambioInputs(long_term_emissions=len(name))
+            self.client.cookies[name] = inputs.json()
+
+    def test_only_plotted(self):
+        """With several saved scenarios, only the plotted one is run"""
+        with mock.patch(
+            "cambio.utils.view_utils.run_model_for_dict",
+            wraps=view_utils.run_model_for_dict,
+        ) as run:
+            response = self.client.get(reverse("index"), {"plot_scenario_two": "on"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(list(run.call_args.args[0].keys()), ["two"])
+
+        # All the scenarios are still listed
+        choices = [sid for sid, _ in response.context["plot_scenario_choices"]]
+        self.assertEqual(set(choices), {"Default", "one", "two", "three"})
+        self.assertEqual(list(response.context["old_scenario_inputs"].keys()), choices)
+
+    def test_mapping(self):
+        """The scenarios are run when first looked up, and only once"""
+        scenarios = view_utils.LazyScenarios(
+            {"a": CambioInputs(), "b": CambioInputs(long_term_emissions=3)}
+        )
+        self.assertEqual(list(scenarios), ["a", "b"])
+        self.assertEqual(scenarios.loaded(), [])
+        climate = scenarios["b"]
+        self.assertEqual(climate["scenario_id"], "b")
+        self.assertIs(scenarios["b"], climate)
+        self.assertEqual(scenarios.loaded(), ["b"])
+
+
+class ScenarioStoreTest(TestCase):
+    """
+    Testing that saved scenarios are kept in the session
+    """
+
+    def choices(self, response):
+        """Return the scenario ids listed on the page"""
+        return {sid for sid, _ in response.context["plot_scenario_choices"]}
+
+    def test_add(self):
+        """A new scenario goes into the session, not a cookie"""
+        response = self.client.get(
+            reverse("index"),
+            {"add_button": "add", "scenario_name": "Mine", "long_term_emissions": "5"},
+        )
+        self.assertNotIn("Mine", response.cookies)
+        self.assertIn("sessionid", response.cookies)
+
+        response = self.client.get(reverse("index"))
+        self.assertEqual(self.choices(response), {"Default", "Mine"})
+        inputs = response.context["old_scenario_inputs"]["Mine"]
+        self.assertEqual(inputs["long_term_emissions"], 5)
+
+    def test_migrate_cookies(self):
+        """Scenarios in cookies are moved into the session"""
+        self.client.cookies["Old"] = CambioInputs(long_term_emissions=3).json()
+        response = self.client.get(reverse("index"))
+        self.assertEqual(self.choices(response), {"Default", "Old"})
+        self.assertEqual(response.cookies["Old"]["max-age"], 0)
+
+        del self.client.cookies["Old"]
+        response = self.client.get(reverse("index"))
+        self.assertEqual(self.choices(response), {"Default", "Old"})
+
+    def test_delete(self):
+        """Deleted scenarios are removed from the session"""
+        self.client.get(
+            reverse("index"), {"add_button": "add", "scenario_name": "Mine"}
+        )
+        self.client.get(
+            reverse("index"), {"delete_button": "delete", "del_scenarioMine": "on"}
+        )
+        response = self.client.get(reverse("index"))
+        self.assertEqual(self.choices(response), {"Default"})
+
+    def test_parse_once(self):
+        """The same saved inputs are only parsed and validated once"""
+        view_utils._parse_inputs.cache_clear()
+        text = CambioInputs(long_term_emissions=4).json()
+        first = view_utils.parse_inputs(text)
+        second = view_utils.parse_inputs(text)
+        self.assertEqual(first, second)
+        self.assertIsNot(first, second)
+        self.assertEqual(view_utils._parse_inputs.cache_info().hits, 1)
+        self.assertIsNone(view_utils.parse_inputs("123"))
+        self.assertIsNone(view_utils.parse_inputs("not json"))
+
+
+class ConditionalGetTest(TestCase):
+    """
+    Testing that unchanged pages are answered with 304 Not Modified
+    """
+
+    def test_not_modified(self):
+        """Asking again for the same page with its ETag gives a 304"""
+        params = {"plot_scenario_Default": "on", "carbon": "ppm"}
+        response = self.client.get(reverse("index"), params)
+        etag = response["ETag"]
+        self.assertIn("Cookie", response["Vary"])
+        self.assertIn("max-age=0", response["Cache-Control"])
+
+        response = self.client.get(reverse("index"), params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+
+        # Other selections make another page
+        params["carbon"] = "GtC"
+        response = self.client.get(reverse("index"), params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response["ETag"], etag)
+
+    def test_data(self):
+        """The data view has its own ETag"""
+        response = self.client.get(reverse("data"))
+        etag = response["ETag"]
+        self.assertNotEqual(etag, self.client.get(reverse("index"))["ETag"])
+        response = self.client.get(reverse("data"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+    def test_not_cached(self):
+        """Adding scenarios and unseeded noise are never cached"""
+        params = {
+            "add_button": "add",
+            "scenario_name": "Noisy",
+            "stochastic_c_atm_std_dev": "1",
+        }
+        response = self.client.get(reverse("index"), params)
+        self.assertNotIn("ETag", response)
+        self.assertIn("no-cache", response["Cache-Control"])
+
+        response = self.client.get(reverse("index"), {"plot_scenario_Noisy": "on"})
+        self.assertNotIn("ETag", response)
+
+        # The saved scenarios are part of the page
+        response = self.client.get(reverse("index"))
+        self.assertIn("ETag", response)
+        self.assertIn("private", response["Cache-Control"])
+
+    def test_bad_seed(self):
+        """Seeds out of range are not used"""
+        for seed in ("-1", str(2**70)):
+            params = {
+                "add_button": "add",
+                "scenario_name": "Noisy",
+                "stochastic_c_atm_std_dev": "0.5",
+                "random_seed": seed,
+            }
+            self.assertEqual(self.client.get(reverse("index"), params).status_code, 200)
+            response = self.client.get(reverse("index"), {"plot_scenario_Noisy": "on"})
+            self.assertEqual(response.status_code, 200)
+
+
+@override_settings(CAMBIO_SERVER_TIMING=True)
+class ServerTimingTest(TestCase):
+    """
+    Testing the timing of the phases of each request
+    """
+
+    def setUp(self):
+        get_panel_cache().clear()
+
+    def phases(self, header):
+        """Return the phase names in a Server-Timing header"""
+        return [metric.split(";")[0] for metric in header.split(", ")]
+
+    def test_header(self):
+        """The response has the time of each phase, which is logged"""
+        with self.assertLogs("cambio.timing", "INFO") as logs:
+            response = self.client.get(reverse("index"))
+        self.assertEqual(
+            self.phases(response["Server-Timing"]),
+            ["inputs", "model", "traces", "plotly", "render", "total"],
+        )
+        self.assertIn('"path": "/cambio/"', logs.output[0])
+
+    @override_settings(CAMBIO_SERVER_TIMING=False)
+    def test_off(self):
+        """Without the setting, requests are not timed"""
+        response = self.client.get(reverse("index"))
+        self.assertNotIn("Server-Timing", response)
+        with timing.phase("model"):
+            self.assertIsNone(timing.current_timer())
+
+    def test_async_middleware(self):
+        """In an async chain, the middleware runs on the event loop"""
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+
+        async def view(request):
+            return HttpResponse("ok")
+
+        with override_settings(
+            CAMBIO_PROFILE=True,
+            CAMBIO_PROFILE_DIR=tmpdir.name,
+            CAMBIO_METRICS=True,
+            CAMBIO_METRICS_DIR=tmpdir.name,
+        ):
+            handler = view
+            for middleware in (
+                MetricsMiddleware,
+                ProfilingMiddleware,
+                ServerTimingMiddleware,
+            ):
+                handler = middleware(handler)
+                self.assertTrue(iscoroutinefunction(handler), middleware)
+            response = asyncio.run(handler(RequestFactory().get("/cambio/")))
+        self.assertIn("Server-Timing", response)
+
+    def test_async(self):
+        """The timer follows the request into the thread pool"""
+        request = RequestFactory().get("/cambio/")
+        timer = timing.start_timer()
+        try:
+            asyncio.run(views.index_async(request))
+        finally:
+            timing.stop_timer()
+        self.assertEqual(
+            set(timer.durations), {"inputs", "model", "traces", "plotly", "render"}
+        )
+
+
+class WarmUpTest(TestCase):
+    """
+    Testing the work done before the first request
+    """
+
+    def setUp(self):
+        result_cache.get_result_cache().clear()
+        get_panel_cache().clear()
+
+    def test_warm_up(self):
+        """After warming up, the first page is drawn from the caches"""
+        with self.assertLogs("cambio.startup", "INFO"):
+            warmup.warm_up()
+        panels = get_panel_cache()
+        drawn = panels.misses
+        self.assertGreater(drawn, 0)
+
+        response = self.client.get(reverse("index"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(panels.misses, drawn)
+        self.assertGreater(panels.hits, 0)